@@ -1,5 +1,8 @@
 import platform
 import os
+import re
+import threading
+import subprocess
 from os.path import expanduser
 
 try:
@@ -13,6 +16,20 @@ except ImportError:
     from colorama import init, Fore, Style
     init()
 
+try:
+    import pandas as pd
+except (ImportError, ModuleNotFoundError):
+    import genodownload
+    genodownload.getpandas()
+    import pandas as pd
+
+try:
+    import numpy as np
+except (ImportError, ModuleNotFoundError):
+    import genodownload
+    genodownload.getnumpy()
+    import numpy as np
+
 home = expanduser("~")
 bindir = os.path.join(home, 'software', 'bin')
 
@@ -34,6 +51,12 @@ else:
 
 
 def prep(admix_name):
+    import genobed
+    import genojobs
+    import genold
+    dataset = genobed.dataset(admix_name)
+    admix_name = genobed.bfile_name(dataset)
+
     import os
     import subprocess
     import sys
@@ -58,25 +81,45 @@ def prep(admix_name):
         else:
             import genodownload
             genodownload.admixture()
-    # If they are not on the cluster. Tell them to get it before they submit the jobs.
-    elif on_cluster in ("no", "n"):
-        print(Fore.RED + Style.BRIGHT + "Make sure to download the admixture program on the cluster and have it in the "
-                                        "same directory when you submit your jobs.")
+    # If they are not on the cluster, they can run it on this computer instead, or get admixture on the cluster before
+    # they submit the jobs.
+    run_here = 'n'
+    if on_cluster in ("no", "n"):
+        print(Fore.BLUE + Style.BRIGHT)
+        run_here = input('Would you like me to run ADMIXTURE on this computer instead? I will run as many K values at '
+                         'the same time as your cores and memory allow. (y/n): ').lower()
         print(Style.RESET_ALL)
+        if run_here in ("yes", "y"):
+            if not os.path.exists(os.path.join(bindir, 'admixture')):
+                import genodownload
+                genodownload.admixture()
+        else:
+            print(Fore.RED + Style.BRIGHT + "Make sure to download the admixture program on the cluster and have it in "
+                                            "the same directory when you submit your jobs.")
+            print(Style.RESET_ALL)
 
-    # I based this formatting off of PSU cluster users, so they need to have a PSU cluster allocation.
-    print(Fore.BLUE + Style.BRIGHT)
-    allocation_name = input('Please enter the name of your cluster allocation: ')
-
-    if allocation_name == "open":
-        walltime = "24:00:00"
-        print("Since you are on the open queue, you have a walltime limit of 24hrs. I'm not sure if the admixture will"
-              "finish by then, so after the job is done or gets killed you should check your log files to see which "
-              "finished. If any didn't finish, then modify the .pbs files to change the 'for K in {n..n}' part to "
-              "reflect the K values that did not complete. Then use qsub filename.pbs to resubmit the jobs.")
-    else:
-        walltime = "150:00:00"
-    print(Style.RESET_ALL)
+    # The cluster jobs (and the allocation they need) are only wanted if ADMIXTURE isn't being run on this computer.
+    jobs = None
+    if run_here not in ("yes", "y"):
+        # I based this formatting off of PSU cluster users, so they need to have a PSU cluster allocation.
+        print(Fore.BLUE + Style.BRIGHT)
+        allocation_name = input('Please enter the name of your cluster allocation: ')
+
+        if allocation_name == "open":
+            max_hours = 24
+            print("Since you are on the open queue, you have a walltime limit of 24hrs. I'm not sure if the admixture "
+                  "will finish by then, so after the job is done or gets killed you should check your log files to see "
+                  "which finished. If any didn't finish, then modify the .pbs files to change the '#PBS -t 3-9' line "
+                  "to the K values that did not complete. Then use qsub filename.pbs to resubmit the jobs.")
+        else:
+            max_hours = 150
+        print(Style.RESET_ALL)
+
+        # On the cluster the jobs are submitted for you, otherwise the PBS scripts are written for you to take there.
+        if on_cluster in ("yes", "y"):
+            jobs = genojobs.backend(None, allocation_name)
+        else:
+            jobs = genojobs.PBS(allocation_name)
 
     # Ask if they have relatives in their sample.
     print(Fore.MAGENTA + Style.BRIGHT)
@@ -85,81 +128,72 @@ def prep(admix_name):
     print(Style.RESET_ALL)
 
     # We want the LD correction to be the same for all sets, so do this on the full genotype file and put it in the
-    # Admixture file.
-    subprocess.check_output([plink, '--bfile', admix_name, '--indep-pairwise', '50', '10', '2', '--out',
-                             'Admixture/' + admix_name])
+    # Admixture file. (The same as plink --indep-pairwise 50 10 2.)
+    kept = genold.write_prune(dataset, 'Admixture/' + admix_name, 'pairwise', 50, 10, 2)
 
     if relative_check in ('y', 'yes'):
-        # If they have relatives in their sample, get a list of the filenames for each set of people.
+        # If they have relatives in their sample, split the people into sets with no relatives in the same set, using
+        # the IBD results.
+        import genorelatives
         print(Fore.GREEN)
-        user_sets = input('Please give me a comma separated list of your set list filenames (with file extension). '
-                          'I.e. dataset_setA.txt, dataset_setB.txt, etc. To do this, break up your entire dataset (not '
-                          'just related individuals) across sets, making sure that there are not related individuals '
-                          'within each set. These lists should be space or tab delimited with FID then IID. Please '
-                          'enter the comma separated list here: ')
+        genome_file = input('Please enter the name of your IBD results file (.genome, from genoprocess task 5). Press '
+                            'enter for IBD_Calculations/' + admix_name + '.genome: ').strip()
+        set_choice = input('Would you like to (1) split everyone across sets with no relatives in the same set, or (2) '
+                           'use one set of people who are not related to each other? Press enter for 1: ').strip()
         print(Style.RESET_ALL)
+        if genome_file == '':
+            genome_file = 'IBD_Calculations/' + admix_name + '.genome'
+
+        indptr, indices = genorelatives.related_graph(genome_file, dataset)
+        if set_choice == '2':
+            sets = np.where(genorelatives.maximal_unrelated(indptr, indices), 0, -1)
+        else:
+            sets = genorelatives.unrelated_sets(indptr, indices)
+        print(str(int((np.diff(indptr) > 0).sum())) + ' people have relatives. Made ' + str(sets.max() + 1)
+              + ' set(s) of unrelated people.')
 
-        # Convert the user given list to a python list.
-        set_list = user_sets.split(', ')
-        print(set_list)
+        # Sets are named SetA, SetB, SetC, etc.
+        set_names = [chr(ord('a') + i).upper() if i < 26 else str(i + 1) for i in range(0, sets.max() + 1)]
+
+        # Take each set's people and the SNPs not in LD out of the working genotype file, all in one read of it. These
+        # files are what the user should put on the cluster.
+        genobed.split(dataset.subset(variants=kept), [sets == i for i in range(0, len(set_names))],
+                      ['Admixture/' + admix_name + '_Set' + set_name + '_LDPruned' for set_name in set_names])
 
         # Perform the admixture prep separately on each set.
-        for i in range(0, len(set_list)):
-            # Tell the user what they gave as file names and what I'm going to output as file names (SetA, SetB, SetC,
-            # etc.)
-            set_name = chr(ord('a') + i).upper()
-            print(set_list[i] + ' = Set' + set_name)
-
-            # For each set, extract those people from the working genotype file and remove SNPs in LD. These files are
-            # what the user should put on the cluster.
-            subprocess.check_output([plink, '--bfile', admix_name, '--keep', set_list[i], '--extract',
-                                     'Admixture/' + admix_name + '.prune.in', '--make-bed', '--out',
-                                     'Admixture/' + admix_name + '_Set' + set_name + '_LDPruned'])
-
-            # For each set, write a pbs script for admixture k = 3..6
-            with open('Admixture/' + admix_name + '_Set' + set_name + '_Admixture_k3to6.pbs', 'w') as file:
-                file.write('#!/bin/bash\n'
-                           '#PBS -l walltime=' + walltime + '\n'
-                           '#PBS -l nodes=1:ppn=8\n'
-                           '#PBS -l pmem=8gb\n'
-                           '#PBS -A ' + allocation_name + '\n'
-                           '#PBS -j oe\n'
-                           'cd $PBS_O_WORKDIR\n'
-                           '\n'
-                           'for K in {3..6}; do admixture --cv '
-                           + admix_name + '_Set' + set_name + '_LDPruned.bed $K | tee '
-                           + admix_name + '_Set' + set_name + '_LDPruned.log${K}.out; done')
-
-            # For each set, write a pbs script for admixture k = 7..9
-            with open('Admixture/' + admix_name + '_Set' + set_name + '_Admixture_k7to9.pbs', 'w') as file:
-                file.write('#!/bin/bash\n'
-                           '#PBS -l walltime=' + walltime + '\n'
-                           '#PBS -l nodes=1:ppn=8\n'
-                           '#PBS -l pmem=8gb\n'
-                           '#PBS -A ' + allocation_name + '\n'
-                           '#PBS -j oe\n'
-                           'cd $PBS_O_WORKDIR\n'
-                           '\n'
-                           'for K in {7..9}; do admixture --cv '
-                           + admix_name + '_Set' + set_name + '_LDPruned.bed $K | tee '
-                           + admix_name + '_Set' + set_name + '_LDPruned.log${K}.out; done')
+        for i in range(0, len(set_names)):
+            set_name = set_names[i]
+            in_set = (sets == i)
+            print('Set' + set_name + ': ' + str(int(in_set.sum())) + ' people')
+
+            # For each set, write the list of people in it.
+            pd.DataFrame({'FID': dataset.fids[in_set], 'IID': dataset.iids[in_set]}).to_csv(
+                'Admixture/' + admix_name + '_Set' + set_name + '.txt', sep='\t', header=False, index=False)
+
+            # For each set, an array job with a task per K = 3..9.
+            if jobs is not None:
+                job = admixture_job('Admixture/' + admix_name + '_Set' + set_name + '_LDPruned.bed',
+                                    int(in_set.sum()), int(kept.sum()), max_hours)
+                if on_cluster in ("yes", "y"):
+                    jobs.submit(job)
+                else:
+                    genojobs.write(jobs, job)
 
         if on_cluster in ("yes", "y"):
-            os.chdir('Admixture')
-            # Submit the jobs
-            subprocess.call(['qsub', '*.pbs'], shell=True)
             print("Your admixture jobs have been submitted. You can check their status using qstat -u usrname. When "
                   "you get your results, you should evaluate them to see which makes sense given your study population"
                   "and which has the lowest CV value (located in the log)")
 
-        if on_cluster in ("no", "n"):
+        if run_here in ("yes", "y"):
+            for set_name in set_names:
+                run_local('Admixture/' + admix_name + '_Set' + set_name + '_LDPruned.bed')
+
+        elif on_cluster in ("no", "n"):
             # Tell the user it's finished and give them directions.
-            print("For each set, transfer the " + admix_name + "_LDPruned bed/bim/fam files, " + admix_name
-                  + "_Admixture_k3to6.pbs, and " + admix_name + "_Admixture_7to9.pbs files to the cluster Also make "
-                                                                "sure you have the admixture program in the same "
-                                                                "folder as these files on the cluster.\n"
-                  "For each set, submit them using qsub " + admix_name + "Admixture_k3to6.pbs and qsub " + admix_name
-                  + "Admixture_k7to9.pbs\n"
+            print("For each set, transfer the " + admix_name + "_Set<set>_LDPruned bed/bim/fam files and the "
+                  + admix_name + "_Set<set>_LDPruned_Admixture.pbs file to the cluster. Also make sure you have the "
+                                 "admixture program in the same folder as these files on the cluster.\n"
+                  "For each set, submit it using qsub " + admix_name + "_Set<set>_LDPruned_Admixture.pbs\n"
                   "When you get your results, you should evaluate them to see which makes sense given your study "
                   "population and which has the lowest CV value (located in the log).")
 
@@ -170,46 +204,144 @@ def prep(admix_name):
                                  'Admixture/' + admix_name + '.prune.in', '--make-bed', '--out',
                                  'Admixture/' + admix_name + '_LDPruned'])
 
-        # For all people, create a pbs file for admixture k = 3..6
-        with open('Admixture/' + admix_name + '_Admixture_k3to6.pbs', 'w') as file:
-            file.write('#!/bin/bash\n'
-                       '#PBS -l walltime=' + walltime + '\n'
-                       '#PBS -l nodes=1:ppn=8\n'
-                       '#PBS -l pmem=8gb\n'
-                       '#PBS -A ' + allocation_name + '\n'
-                       '#PBS -j oe\n'
-                       'cd $PBS_O_WORKDIR\n'
-                       '\n'
-                       'for K in {3..6}; do admixture --cv ' + admix_name + '_LDPruned.bed $K | tee '
-                       + admix_name + '_LDPruned.log${K}.out; done')
-
-        # For all people, create a pbs file for admixture k = 7..9
-        with open('Admixture/' + admix_name + '_Admixture_k7to9.pbs', 'w') as file:
-            file.write('#!/bin/bash\n'
-                       '#PBS -l walltime=' + walltime + '\n'
-                       '#PBS -l nodes=1:ppn=8\n'
-                       '#PBS -l pmem=8gb\n'
-                       '#PBS -A ' + allocation_name + '\n'
-                       '#PBS -j oe\n'
-                       'cd $PBS_O_WORKDIR\n'
-                       '\n'
-                       'for K in {7..9}; do admixture --cv ' + admix_name + '_LDPruned.bed $K | tee '
-                       + admix_name + '_LDPruned.log${K}.out; done')
+        # For all people, an array job with a task per K = 3..9.
+        if jobs is not None:
+            job = admixture_job('Admixture/' + admix_name + '_LDPruned.bed', dataset.n_samples, int(kept.sum()),
+                                max_hours)
+            if on_cluster in ("yes", "y"):
+                jobs.submit(job)
+            else:
+                genojobs.write(jobs, job)
 
         if on_cluster in ("yes", "y"):
-            os.chdir('Admixture')
-            # Submit the jobs
-            subprocess.call(['qsub', admix_name + '_Admixture_k3to6.pbs'], shell=True)
-            subprocess.call(['qsub', admix_name + '_Admixture_k7to9.pbs'], shell=True)
             print("Your admixture jobs have been submitted. You can check their status using qstat -u usrname. When "
                   "you get your results, you should evaluate them to see which makes sense given your study population"
                   "and which has the lowest CV value (located in the log)")
 
-        if on_cluster in ("no", "n"):
-            print("Transfer " + admix_name + "_LDPruned bed/bim/fam files, " + admix_name + "_Admixture_k3to6.pbs, and "
-                  + admix_name + "_Admixture_7to9.pbs files to the cluster. Also make sure you have the admixture "
-                                 "program in the same location as these files.\n"
-                  "Submit them using qsub " + admix_name + "Admixture_k3to6.pbs and qsub " + admix_name
-                  + "Admixture_k7to9.pbs\n"
-                    "When you get your results, you should evaluate them to see which makes sense given your study "
-                    "population and which has the lowest CV value (located in the log).")
+        if run_here in ("yes", "y"):
+            run_local('Admixture/' + admix_name + '_LDPruned.bed')
+
+        elif on_cluster in ("no", "n"):
+            print("Transfer " + admix_name + "_LDPruned bed/bim/fam files and the " + admix_name
+                  + "_LDPruned_Admixture.pbs file to the cluster. Also make sure you have the admixture program in the "
+                    "same location as these files.\n"
+                  "Submit it using qsub " + admix_name + "_LDPruned_Admixture.pbs\n"
+                  "When you get your results, you should evaluate them to see which makes sense given your study "
+                  "population and which has the lowest CV value (located in the log).")
+
+
+# What admixture prints at the end of a run. A log with a CV error in it is a run that finished.
+admixture_cv = re.compile(r'CV error \(K=(\d+)\): (\S+)')
+admixture_loglikelihood = re.compile(r'^Loglikelihood: (\S+)', re.MULTILINE)
+
+
+def admixture_result(log_file):
+    # (CV error, log likelihood) from an admixture log, or None if that run hasn't finished.
+    if not os.path.exists(log_file):
+        return None
+    with open(log_file, 'r') as f:
+        log = f.read()
+    cv = admixture_cv.search(log)
+    if cv is None:
+        return None
+    loglikelihood = admixture_loglikelihood.findall(log)
+    return float(cv.group(2)), float(loglikelihood[-1]) if loglikelihood else float('nan')
+
+
+def admixture_memory_mb(n_samples, n_variants, max_k):
+    # Roughly what one admixture run needs: a byte per genotype, plus the Q and P matrices and their copies.
+    return 256 + (n_samples * n_variants + 8 * 4 * max_k * (n_samples + n_variants)) // (1024 * 1024)
+
+
+def admixture_job(bed_file, n_samples, n_variants, max_hours, ks=range(3, 10), cores=8):
+    # genojobs.Job running admixture --cv on bed_file for each K (a task per K), in the folder bed_file is in, with
+    # the log of each written the same way as always: <name>.log<K>.out. The wall time is a rough guess from the size
+    # of the data and the biggest K, capped at max_hours (the queue's limit).
+    import genojobs
+    name = os.path.basename(bed_file)[:-4]
+    hours = genojobs.walltime(600 + 1e-5 * n_samples * n_variants * max(ks) / cores, max_hours=max_hours)
+    return genojobs.Job(name + '_Admixture',
+                        ['admixture --cv -j' + str(cores) + ' ' + name + '.bed $TASK | tee ' + name
+                         + '.log${TASK}.out'],
+                        cores=cores, mem_mb=admixture_memory_mb(n_samples, n_variants, max(ks)),
+                        walltime_hours=hours, tasks=ks, workdir=os.path.dirname(bed_file) or '.')
+
+
+def run_admixture(bed_file, k, seed, out_dir, threads):
+    # One admixture --cv run. Each seed gets its own folder (admixture names its .Q and .P files after the input and K
+    # only), and the log is written next to them the same way the pbs scripts tee it: <name>.log<K>.out
+    admixture = os.path.join(bindir, 'admixture') if os.path.exists(os.path.join(bindir, 'admixture')) else 'admixture'
+    run_dir = os.path.join(out_dir, 'seed' + str(seed))
+    log_file = os.path.join(run_dir, os.path.basename(bed_file)[:-4] + '.log' + str(k) + '.out')
+    with open(log_file, 'w') as log:
+        subprocess.check_call([admixture, '--cv', '-s', str(seed), '-j' + str(threads), os.path.abspath(bed_file),
+                               str(k)], stdout=log, stderr=subprocess.STDOUT, cwd=run_dir)
+    return admixture_result(log_file)
+
+
+def run_local(bed_file, ks=range(3, 10), seeds=(43,), workers=None, threads=None):
+    # Run the K sweep for bed_file on this computer, with admixture --cv for every K and seed (43 is admixture's own
+    # default). The runs go side by side (biggest K first), as many at once as the cores and memory allow, each with
+    # its share of the cores (-j). Runs whose logs show they already finished are skipped, so if this gets
+    # interrupted it picks up where it left off. The CV errors end up in one table, <name>_CV_Summary.txt, next to
+    # bed_file.
+    import genobed
+    import genopool
+
+    try:
+        import pandas as pd
+    except (ImportError, ModuleNotFoundError):
+        import genodownload
+        genodownload.getpandas()
+        import pandas as pd
+
+    out_dir = os.path.dirname(os.path.abspath(bed_file))
+    name = os.path.basename(bed_file)[:-4]
+    for seed in seeds:
+        if not os.path.exists(os.path.join(out_dir, 'seed' + str(seed))):
+            os.makedirs(os.path.join(out_dir, 'seed' + str(seed)))
+
+    runs = [(k, seed) for seed in seeds for k in ks]
+    results = {}
+    for k, seed in runs:
+        results[(k, seed)] = admixture_result(os.path.join(out_dir, 'seed' + str(seed), name + '.log' + str(k)
+                                                           + '.out'))
+    to_run = [run for run in runs if results[run] is None]
+    if len(to_run) < len(runs):
+        print(str(len(runs) - len(to_run)) + " of the " + str(len(runs)) + " ADMIXTURE runs for " + name
+              + " have already finished, so I'm skipping them.")
+
+    if to_run:
+        geno = genobed.load(bed_file[:-4])
+        mem_mb = admixture_memory_mb(geno.n_samples, geno.n_variants, max(ks))
+        if workers is None:
+            workers = genopool.worker_count(mem_per_worker_mb=mem_mb, threads_per_worker=threads or 1,
+                                            max_workers=len(to_run))
+        if threads is None:
+            threads = max(1, genopool.cores() // workers)
+        print("Running " + str(len(to_run)) + " ADMIXTURE runs for " + name + ", " + str(workers) + " at a time with "
+              + str(threads) + " thread(s) each.")
+
+        # Keep the user posted as runs finish.
+        finished = [0]
+        lock = threading.Lock()
+
+        def run(k, seed):
+            result = run_admixture(bed_file, k, seed, out_dir, threads)
+            with lock:
+                finished[0] += 1
+                print('K=' + str(k) + ' seed ' + str(seed) + ' finished (' + str(finished[0]) + '/' + str(len(to_run))
+                      + '), CV error ' + (str(result[0]) if result else 'missing, check its log'))
+            return result
+
+        for run_key, result in zip(to_run, genopool.run(run, to_run, workers, sizes=[k for k, seed in to_run])):
+            results[run_key] = result
+
+    summary = pd.DataFrame([[k, seed] + (list(results[(k, seed)]) if results[(k, seed)] else [None, None])
+                            for k, seed in runs], columns=['K', 'Seed', 'CV_Error', 'Loglikelihood'])
+    summary.to_csv(os.path.join(out_dir, name + '_CV_Summary.txt'), sep='\t', header=True, index=False)
+    mean_cv = summary.groupby('K')['CV_Error'].mean()
+    if mean_cv.notna().any():
+        print("Finished " + name + ". The lowest CV error is for K = " + str(mean_cv.idxmin()) + " ("
+              + str(round(mean_cv.min(), 5)) + "). All the CV errors are in " + name + "_CV_Summary.txt")
+    return summary
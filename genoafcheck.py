@@ -0,0 +1,65 @@
+try:
+    import numpy as np
+except (ImportError, ModuleNotFoundError):
+    import genodownload
+    genodownload.getnumpy()
+    import numpy as np
+
+# Allele frequency check used after harmonizing with 1000G. Everything here works on plain numeric numpy arrays:
+# alleles are coded as small integers, the allele match is a boolean mask, and the difference against all five
+# superpopulations is one broadcast instead of a pair of string columns per population.
+
+# The 1000G Phase 3 superpopulation columns, in the order the diff columns are returned.
+POPULATIONS = ['AFR', 'AMR', 'EAS', 'EUR', 'SAS']
+
+# Integer codes for single base alleles. Anything else (indels, '0' for monomorphic, etc.) is coded 0.
+ALLELE_CODES = {'A': 1, 'C': 2, 'G': 3, 'T': 4}
+ALLELE_NAMES = np.array(['0', 'A', 'C', 'G', 'T'], dtype=object)
+
+
+def encode_alleles(alleles):
+    # Turn a list/Series/array of allele strings into int8 codes.
+    alleles = np.asarray(alleles).astype(str)
+    codes = np.zeros(len(alleles), dtype=np.int8)
+    for base, code in ALLELE_CODES.items():
+        codes[alleles == base] = code
+    return codes
+
+
+def decode_alleles(codes):
+    # Turn int8 allele codes back into allele strings.
+    return ALLELE_NAMES[np.asarray(codes)]
+
+
+def af_check(dataset_a1, dataset_a2, dataset_a1_frq, reference_a0, reference_a1, reference_afs, threshold=0.2,
+             min_pops=5):
+    # Compare the study allele frequencies with the 1000G superpopulation frequencies.
+    #   dataset_a1, dataset_a2, reference_a0, reference_a1 - integer allele codes (see encode_alleles)
+    #   dataset_a1_frq - frequency of the study A1 allele
+    #   reference_afs - one row per SNP, one column per superpopulation (POPULATIONS order), frequency of reference a1
+    #   threshold, min_pops - a SNP is removed when its AF difference is > threshold in at least min_pops of the
+    #       superpopulations (the default is all five, i.e. keep it if it is within 0.2 of any superpopulation).
+    # Returns the keep mask, the remove mask, and the AF differences (NaN where the alleles don't match either way).
+    dataset_a1 = np.asarray(dataset_a1)
+    dataset_a2 = np.asarray(dataset_a2)
+    reference_a0 = np.asarray(reference_a0)
+    reference_a1 = np.asarray(reference_a1)
+    dataset_a1_frq = np.asarray(dataset_a1_frq, dtype=np.float64)
+    reference_afs = np.asarray(reference_afs, dtype=np.float64)
+
+    # Alleles in the same order in the study and reference, and alleles that are flipped.
+    match = (dataset_a1 == reference_a1) & (dataset_a2 == reference_a0) & (reference_a1 > 0)
+    flip = (dataset_a1 == reference_a0) & (dataset_a2 == reference_a1) & (reference_a0 > 0)
+
+    # Frequency of the study allele that lines up with the reference a1 allele.
+    dataset_frq = np.where(match, dataset_a1_frq, 1 - dataset_a1_frq)
+
+    # One broadcast over all of the superpopulations.
+    af_diffs = np.abs(dataset_frq[:, np.newaxis] - reference_afs)
+    af_diffs[~(match | flip)] = np.nan
+
+    # NaN never counts as too different, so SNPs whose alleles don't line up are kept, the same as before.
+    too_different = (af_diffs > threshold).sum(axis=1)
+    remove = too_different >= min_pops
+
+    return ~remove, remove, af_diffs
@@ -0,0 +1,629 @@
+import os
+import json
+import hashlib
+import functools
+
+try:
+    import pandas as pd
+except (ImportError, ModuleNotFoundError):
+    import genodownload
+    genodownload.getpandas()
+    import pandas as pd
+
+try:
+    import numpy as np
+except (ImportError, ModuleNotFoundError):
+    import genodownload
+    genodownload.getnumpy()
+    import numpy as np
+
+# Reads plink bed/bim/fam files directly, so simple things like allele frequencies don't need a plink run and a text
+# file round trip.
+# The .bed file starts with 3 magic bytes, then has one block per variant (SNP-major), each block being
+# ceil(number of people / 4) bytes. Every byte holds 4 genotypes, 2 bits each, starting from the low bits:
+#   00 - homozygous A1, 01 - missing, 10 - heterozygous, 11 - homozygous A2
+# The unused bits at the end of each block are 0.
+
+BED_MAGIC = b'\x6c\x1b\x01'
+
+# Plink's numeric codes for the non-autosomes.
+CHR_CODES = {'X': 23, 'Y': 24, 'XY': 25, 'MT': 26}
+
+# Lookup tables indexed by a packed byte (0-255).
+#   _GENOTYPES - the 4 genotype codes in the byte (0-3, see above)
+#   _A1_COUNT - number of A1 alleles in the byte, counting every genotype as diploid
+#   _OBS_COUNT - number of non-missing genotypes in the byte
+_GENOTYPES = np.array([[(byte >> (2 * k)) & 3 for k in range(0, 4)] for byte in range(0, 256)], dtype=np.int8)
+_A1_COUNT = np.array([sum((2, 0, 1, 0)[g] for g in _GENOTYPES[byte]) for byte in range(0, 256)], dtype=np.uint8)
+_OBS_COUNT = np.array([sum(g != 1 for g in _GENOTYPES[byte]) for byte in range(0, 256)], dtype=np.uint8)
+
+# Number of A1 alleles for each genotype code, with -1 for missing.
+_A1_DOSAGE = np.array([2, -1, 1, 0], dtype=np.int8)
+
+# How much of the bed file to decode at a time.
+CHUNK_BYTES = 64 * 1024 * 1024
+
+
+def read_bim(bfile):
+    return pd.read_csv(bfile + '.bim', sep='\s+', header=None, names=['CHR', 'SNP', 'cM', 'position', 'A1', 'A2'],
+                       dtype={'CHR': str, 'SNP': str, 'cM': float, 'position': int, 'A1': str, 'A2': str})
+
+
+def read_fam(bfile):
+    return pd.read_csv(bfile + '.fam', sep='\s+', header=None, names=['FID', 'IID', 'PID', 'MID', 'Sex', 'Pheno'],
+                       dtype={'FID': str, 'IID': str, 'PID': str, 'MID': str, 'Sex': int, 'Pheno': str})
+
+
+def chr_codes(chromosomes):
+    # Turn the bim chromosome column into plink's numeric codes (X = 23, Y = 24, XY = 25, MT = 26).
+    chromosomes = pd.Series(chromosomes).astype(str).str.replace('^chr', '', regex=True)
+    return chromosomes.replace(CHR_CODES).astype(int).values
+
+
+def open_bed(bfile, n_variants, n_people):
+    # Memory-map the genotype blocks of the .bed file as a (variants x bytes per variant) array.
+    bytes_per_variant = (n_people + 3) // 4
+    with open(bfile + '.bed', 'rb') as f:
+        magic = f.read(3)
+    if magic != BED_MAGIC:
+        raise ValueError(bfile + '.bed is not a SNP-major plink bed file')
+    expected = 3 + n_variants * bytes_per_variant
+    if os.path.getsize(bfile + '.bed') != expected:
+        raise ValueError(bfile + '.bed is not the size the bim and fam files say it should be')
+    if n_variants == 0 or bytes_per_variant == 0:
+        return np.zeros((n_variants, bytes_per_variant), dtype=np.uint8)
+    return np.memmap(bfile + '.bed', dtype=np.uint8, mode='r', offset=3, shape=(n_variants, bytes_per_variant))
+
+
+def unpack(packed, n_people):
+    # Turn packed variant blocks into a (variants x people) array of genotype codes.
+    return _GENOTYPES[packed].reshape(packed.shape[0], -1)[:, :n_people]
+
+
+def pack(genotypes):
+    # Turn a (variants x people) array of genotype codes back into packed variant blocks.
+    genotypes = np.asarray(genotypes, dtype=np.uint8)
+    n_variants, n_people = genotypes.shape
+    padded = np.zeros((n_variants, ((n_people + 3) // 4) * 4), dtype=np.uint8)
+    padded[:, :n_people] = genotypes
+    padded = padded.reshape(n_variants, -1, 4)
+    return padded[:, :, 0] | (padded[:, :, 1] << 2) | (padded[:, :, 2] << 4) | (padded[:, :, 3] << 6)
+
+
+def _stamp(bfile):
+    # Size and modification time of the three files, so we know when a cached dataset is out of date.
+    return tuple((os.path.getsize(bfile + ext), os.path.getmtime(bfile + ext)) for ext in ('.bed', '.bim', '.fam'))
+
+
+def _select(index, selection, length):
+    # Apply a selection (boolean mask or row numbers, relative to the current view) to a view's row numbers.
+    selection = np.asarray(selection)
+    if selection.dtype == bool:
+        if len(selection) != length:
+            raise ValueError('Boolean selection is the wrong length')
+        selection = np.flatnonzero(selection)
+    if index is None:
+        return selection.astype(np.int64)
+    return index[selection]
+
+
+class PlinkDataset(object):
+    # A plink bed/bim/fam fileset. The .bed file is memory-mapped, not read, and the .bim and .fam files are only
+    # parsed the first time something from them is needed, into numpy arrays:
+    #   chromosomes - int8 plink chromosome codes (X = 23 etc.), positions - uint32, cm - float64,
+    #   snps, a1, a2, fids, iids, pids, mids, phenotypes - strings, sexes - int8.
+    # subset() gives a view of some of the SNPs and/or people that shares all of this with the original, so nothing is
+    # copied until the view is written out.
+
+    def __init__(self, bfile):
+        self.name = bfile
+        self._root = self
+        self._variants = None
+        self._samples = None
+        self._written = True
+        self._stamp = _stamp(bfile)
+        self._bim = None
+        self._fam = None
+        self._bed = None
+
+    # Parsing .bim and .fam, once per fileset.
+    def _bim_arrays(self):
+        root = self._root
+        if root._bim is None:
+            bim = read_bim(root.name)
+            root._bim = {'chromosomes': chr_codes(bim['CHR']).astype(np.int8),
+                         'snps': np.asarray(bim['SNP'], dtype=object), 'cm': bim['cM'].values.astype(np.float64),
+                         'positions': bim['position'].values.astype(np.uint32),
+                         'a1': np.asarray(bim['A1'], dtype=object), 'a2': np.asarray(bim['A2'], dtype=object)}
+        return root._bim
+
+    def _fam_arrays(self):
+        root = self._root
+        if root._fam is None:
+            fam = read_fam(root.name)
+            root._fam = {'fids': np.asarray(fam['FID'], dtype=object), 'iids': np.asarray(fam['IID'], dtype=object),
+                         'pids': np.asarray(fam['PID'], dtype=object), 'mids': np.asarray(fam['MID'], dtype=object),
+                         'sexes': fam['Sex'].values.astype(np.int8),
+                         'phenotypes': np.asarray(fam['Pheno'], dtype=object)}
+        return root._fam
+
+    def _variant_column(self, column):
+        values = self._bim_arrays()[column]
+        return values if self._variants is None else values[self._variants]
+
+    def _sample_column(self, column):
+        values = self._fam_arrays()[column]
+        return values if self._samples is None else values[self._samples]
+
+    chromosomes = property(lambda self: self._variant_column('chromosomes'))
+    snps = property(lambda self: self._variant_column('snps'))
+    cm = property(lambda self: self._variant_column('cm'))
+    positions = property(lambda self: self._variant_column('positions'))
+    a1 = property(lambda self: self._variant_column('a1'))
+    a2 = property(lambda self: self._variant_column('a2'))
+    fids = property(lambda self: self._sample_column('fids'))
+    iids = property(lambda self: self._sample_column('iids'))
+    pids = property(lambda self: self._sample_column('pids'))
+    mids = property(lambda self: self._sample_column('mids'))
+    sexes = property(lambda self: self._sample_column('sexes'))
+    phenotypes = property(lambda self: self._sample_column('phenotypes'))
+
+    @property
+    def n_variants(self):
+        if self._variants is not None:
+            return len(self._variants)
+        return len(self._bim_arrays()['snps'])
+
+    @property
+    def n_samples(self):
+        if self._samples is not None:
+            return len(self._samples)
+        return len(self._fam_arrays()['iids'])
+
+    @property
+    def all_samples(self):
+        # True if the view has every person in the fileset, so the packed blocks can be used as they are.
+        return self._samples is None
+
+    @property
+    def bed(self):
+        # The memory-mapped genotype blocks of the whole fileset (every SNP, every person).
+        root = self._root
+        if root._bed is None:
+            root._bed = open_bed(root.name, len(root._bim_arrays()['snps']), len(root._fam_arrays()['iids']))
+        return root._bed
+
+    def packed(self, start=0, end=None):
+        # Packed blocks for SNPs start to end of the view, with every person in the fileset.
+        end = self.n_variants if end is None else end
+        if self._variants is None:
+            return np.asarray(self.bed[start:end])
+        return self.bed[self._variants[start:end]]
+
+    def genotypes(self, start=0, end=None):
+        # Genotype codes (see the top of this file) for SNPs start to end of the view, one column per person in it.
+        codes = unpack(self.packed(start, end), len(self._root._fam_arrays()['iids']))
+        return codes if self._samples is None else codes[:, self._samples]
+
+    def chunks(self, chunk_bytes=CHUNK_BYTES):
+        # (start, end) ranges of the view's SNPs, about chunk_bytes of the .bed file at a time.
+        chunk_size = max(1, chunk_bytes // max(1, self.bed.shape[1]))
+        for start in range(0, self.n_variants, chunk_size):
+            yield start, min(start + chunk_size, self.n_variants)
+
+    def subset(self, variants=None, samples=None, name=None):
+        # A view of some of the SNPs and/or people. variants and samples can be boolean masks or row numbers, relative
+        # to this view. name is where the view gets written if it's ever needed as a fileset on disk (by default,
+        # the original name with _subset added).
+        view = PlinkDataset.__new__(PlinkDataset)
+        view.__dict__.update(self.__dict__)
+        if variants is not None:
+            view._variants = _select(self._variants, variants, self.n_variants)
+        if samples is not None:
+            view._samples = _select(self._samples, samples, self.n_samples)
+        view.name = name if name is not None else self._root.name + '_subset'
+        view._written = False
+        return view
+
+    def key(self):
+        # sha1 that identifies what's in the view: the fileset it comes from (as it is on disk now) and which of its
+        # SNPs and people it has. Used to cache results worked out from a dataset.
+        digest = hashlib.sha1(json.dumps([os.path.abspath(self._root.name), self._stamp]).encode())
+        for index in (self._variants, self._samples):
+            digest.update(b'all' if index is None else np.asarray(index, dtype=np.int64).tobytes())
+        return digest.hexdigest()
+
+    def bim_frame(self):
+        return pd.DataFrame({'CHR': self.chromosomes, 'SNP': self.snps, 'cM': self.cm, 'position': self.positions,
+                             'A1': self.a1, 'A2': self.a2})
+
+    def fam_frame(self):
+        return pd.DataFrame({'FID': self.fids, 'IID': self.iids, 'PID': self.pids, 'MID': self.mids,
+                             'Sex': self.sexes, 'Pheno': self.phenotypes})
+
+    def write(self, out, max_missing=None, chunk_bytes=CHUNK_BYTES):
+        # Write the view out as a bed/bim/fam fileset. The allele order is kept as it is (like --keep-allele-order).
+        # If max_missing is given, SNPs with a missing call rate above it (among the people in the view) are left out
+        # as they're written, the same as plink's --geno.
+        kept = np.ones(self.n_variants, dtype=bool)
+        with open(out + '.bed', 'wb') as f:
+            f.write(BED_MAGIC)
+            for start, end in self.chunks(chunk_bytes):
+                if self.all_samples and max_missing is None:
+                    f.write(self.packed(start, end).tobytes())
+                    continue
+                codes = self.genotypes(start, end)
+                if max_missing is not None:
+                    kept[start:end] = variant_missing_rate(codes, self.chromosomes[start:end], self.sexes) \
+                        <= max_missing
+                    codes = codes[kept[start:end]]
+                f.write(pack(codes).tobytes())
+        self.bim_frame()[kept].to_csv(out + '.bim', sep='\t', header=False, index=False)
+        self.fam_frame().to_csv(out + '.fam', sep=' ', header=False, index=False)
+        return load(out)
+
+    def bfile(self):
+        # Prefix to give plink (--bfile). A view gets written to its name the first time this is needed.
+        if not self._written:
+            self.write(self.name)
+            self._written = True
+        return self.name
+
+
+# Filesets that have already been opened, so that the .bim and .fam files are only parsed once per run.
+_datasets = {}
+
+
+def load(bfile):
+    # Open a plink fileset, reusing the one we already have if the files haven't changed since.
+    key = os.path.abspath(bfile)
+    stamp = _stamp(bfile)
+    if key not in _datasets or _datasets[key]._stamp != stamp:
+        _datasets[key] = PlinkDataset(bfile)
+    return _datasets[key]
+
+
+def bfile_name(geno):
+    # Every module takes either a fileset name or a PlinkDataset. This gives back the name to hand to plink. plink can
+    # only read filesets on disk, so a view (see PlinkDataset.subset) is written out to its own fileset the first time
+    # (PlinkDataset.bfile); only the steps that read through dataset() work on a view without copying it.
+    if isinstance(geno, PlinkDataset):
+        return geno.bfile()
+    return geno
+
+
+def takes_bfile(func):
+    # Decorator for functions that just hand their first argument, a fileset name, to plink: they get
+    # bfile_name(geno) instead, so they take a PlinkDataset as well.
+    @functools.wraps(func)
+    def wrapper(geno, *args, **kwargs):
+        return func(bfile_name(geno), *args, **kwargs)
+    return wrapper
+
+
+def dataset(geno):
+    # The other way round: a PlinkDataset for either a fileset name or a PlinkDataset.
+    if isinstance(geno, PlinkDataset):
+        return geno
+    return load(geno)
+
+
+def split(geno, samples, outs, chunk_bytes=CHUNK_BYTES):
+    # Write several filesets, one per selection of people in samples (boolean masks or row numbers, relative to geno)
+    # with every SNP in geno, to the names in outs, in one pass over the .bed file. Each person's genotype is found
+    # straight from the packed bytes: which byte of the SNP's block it is in, and how far to shift it (worked out
+    # once, up front). The SNPs in geno are worked out once per chunk, the same way, for every output. Allele order is
+    # kept as it is.
+    geno = dataset(geno)
+    columns = [_select(geno._samples, selection, geno.n_samples) for selection in samples]
+    byte_index = [column >> 2 for column in columns]
+    shift = [((column & 3) * 2).astype(np.uint8) for column in columns]
+
+    files = [open(out + '.bed', 'wb') for out in outs]
+    try:
+        for f in files:
+            f.write(BED_MAGIC)
+        for start, end in geno.chunks(chunk_bytes):
+            packed = geno.packed(start, end)
+            for k in range(0, len(files)):
+                files[k].write(pack((packed[:, byte_index[k]] >> shift[k]) & 3).tobytes())
+    finally:
+        for f in files:
+            f.close()
+
+    bim = geno.bim_frame()
+    fam = geno._root.fam_frame()
+    for k in range(0, len(outs)):
+        bim.to_csv(outs[k] + '.bim', sep='\t', header=False, index=False)
+        fam.iloc[columns[k]].to_csv(outs[k] + '.fam', sep=' ', header=False, index=False)
+    return [load(out) for out in outs]
+
+
+def split_chromosomes(geno, chromosomes, outs, chunk_bytes=CHUNK_BYTES):
+    # Write one fileset per chromosome (plink codes, X = 23) to the names in outs, with every person in geno, in one
+    # pass over the .bed file, instead of a plink --chr run per chromosome that each read all of it. Each SNP's packed
+    # block is copied to its chromosome's file as it is. A chromosome with no SNPs in geno gets a fileset with none.
+    geno = dataset(geno)
+    all_chromosomes = geno.chromosomes
+    files = [open(out + '.bed', 'wb') for out in outs]
+    try:
+        for f in files:
+            f.write(BED_MAGIC)
+        for start, end in geno.chunks(chunk_bytes):
+            packed = geno.packed(start, end) if geno.all_samples else pack(geno.genotypes(start, end))
+            on_chromosome = all_chromosomes[start:end]
+            for k in range(0, len(files)):
+                rows = on_chromosome == chromosomes[k]
+                if rows.any():
+                    files[k].write(packed[rows].tobytes())
+    finally:
+        for f in files:
+            f.close()
+
+    bim = geno.bim_frame()
+    fam = geno.fam_frame()
+    for k in range(0, len(outs)):
+        bim[all_chromosomes == chromosomes[k]].to_csv(outs[k] + '.bim', sep='\t', header=False, index=False)
+        fam.to_csv(outs[k] + '.fam', sep=' ', header=False, index=False)
+    return [load(out) for out in outs]
+
+
+def allele_counts(geno, chunk_bytes=CHUNK_BYTES, founders_only=True):
+    # Count the A1 alleles and the observed alleles for every variant, reading the .bed file chunk by chunk.
+    # Like plink, males are haploid on chrX (and their heterozygous calls are missing), only males are counted on chrY,
+    # and everybody is haploid on MT. Also like plink, only founders are counted unless founders_only is False (or
+    # nobody is a founder). Returns the dataset (the view that was counted), the A1 counts, and the observed allele
+    # counts.
+    geno = dataset(geno)
+    if founders_only:
+        founders = _founders(geno)
+        if not founders.all():
+            geno = geno.subset(samples=founders, name=geno.name)
+    codes = geno.chromosomes
+    n_people = geno.n_samples
+
+    # The unused genotypes at the end of each block are coded 00 (homozygous A1), so take them back out.
+    padding = geno.bed.shape[1] * 4 - n_people
+
+    males = (geno.sexes == 1)
+    a1_counts = np.zeros(geno.n_variants, dtype=np.int64)
+    obs_counts = np.zeros(geno.n_variants, dtype=np.int64)
+    for start, end in geno.chunks(chunk_bytes):
+        chunk_codes = codes[start:end]
+        diploid = ~np.isin(chunk_codes, (23, 24, 26))
+
+        # Autosomes (and XY): straight table lookups on the packed bytes, as long as the view has everyone in it.
+        if diploid.any() and geno.all_samples:
+            rows = geno.packed(start, end)[diploid]
+            a1_counts[start:end][diploid] = _A1_COUNT[rows].sum(axis=1, dtype=np.int64) - 2 * padding
+            obs_counts[start:end][diploid] = 2 * (_OBS_COUNT[rows].sum(axis=1, dtype=np.int64) - padding)
+            if diploid.all():
+                continue
+
+        # X, Y and MT (and everything, for a view of some of the people): unpack, since how a genotype counts depends
+        # on who it belongs to.
+        unpacked = ~diploid if geno.all_samples else np.ones(len(chunk_codes), dtype=bool)
+        if not unpacked.any():
+            continue
+        dosage = _A1_DOSAGE[geno.genotypes(start, end)[unpacked]].astype(np.int64)
+        unpacked_codes = chunk_codes[unpacked][:, np.newaxis]
+        haploid = (np.isin(unpacked_codes, (23, 24)) & males) | (unpacked_codes == 26)
+        counted = (unpacked_codes != 24) | males
+        observed = counted & (dosage >= 0) & ~(haploid & (dosage == 1))
+        a1 = np.where(haploid, dosage // 2, dosage)
+        a1_counts[start:end][unpacked] = np.where(observed, a1, 0).sum(axis=1)
+        obs_counts[start:end][unpacked] = np.where(observed, np.where(haploid, 1, 2), 0).sum(axis=1)
+
+    return geno, a1_counts, obs_counts
+
+
+def _counted(chromosomes, sexes):
+    # Which genotypes count towards missing call rates, as a (SNPs x people) mask: everything except women's (and
+    # unknown sex) chrY genotypes, which plink ignores.
+    on_y = (np.asarray(chromosomes) == 24)[:, np.newaxis]
+    return ~(on_y & (np.asarray(sexes) != 1)[np.newaxis, :])
+
+
+def variant_missing_rate(codes, chromosomes, sexes):
+    # Missing call rate of each SNP in a (SNPs x people) array of genotype codes.
+    counted = _counted(chromosomes, sexes)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return ((codes == 1) & counted).sum(axis=1) / counted.sum(axis=1).astype(np.float64)
+
+
+def sample_missing_rate(geno, chunk_bytes=CHUNK_BYTES):
+    # Missing call rate of each person, over every SNP (like plink's --mind and .imiss), in one pass over the .bed.
+    geno = dataset(geno)
+    missing = np.zeros(geno.n_samples, dtype=np.int64)
+    total = np.zeros(geno.n_samples, dtype=np.int64)
+    for start, end in geno.chunks(chunk_bytes // 4):
+        codes = geno.genotypes(start, end)
+        counted = _counted(geno.chromosomes[start:end], geno.sexes)
+        missing += ((codes == 1) & counted).sum(axis=0)
+        total += counted.sum(axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return missing / total.astype(np.float64)
+
+
+def missing_filter(geno, max_variant_missing=0.1, max_sample_missing=0.1, chunk_bytes=CHUNK_BYTES):
+    # Which SNPs and people pass --geno max_variant_missing followed by --mind max_sample_missing, as boolean masks,
+    # without writing the in-between fileset. A SNP's missing call rate only depends on that SNP, so the SNP filter is
+    # decided chunk by chunk in the same pass that adds up each person's missing calls over the SNPs that passed it.
+    geno = dataset(geno)
+    kept = np.zeros(geno.n_variants, dtype=bool)
+    missing = np.zeros(geno.n_samples, dtype=np.int64)
+    total = np.zeros(geno.n_samples, dtype=np.int64)
+    for start, end in geno.chunks(chunk_bytes // 4):
+        codes = geno.genotypes(start, end)
+        counted = _counted(geno.chromosomes[start:end], geno.sexes)
+        missed = (codes == 1) & counted
+        with np.errstate(invalid='ignore', divide='ignore'):
+            passed = missed.sum(axis=1) / counted.sum(axis=1).astype(np.float64) <= max_variant_missing
+        kept[start:end] = passed
+        missing += missed[passed].sum(axis=0)
+        total += counted[passed].sum(axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return kept, ~(missing / total.astype(np.float64) > max_sample_missing)
+
+
+def _founders(geno):
+    # People with no parents in the dataset (everybody, if that's nobody).
+    founders = (geno.pids == '0') & (geno.mids == '0')
+    if not founders.any():
+        founders = np.ones(geno.n_samples, dtype=bool)
+    return founders
+
+
+def _homozygosity(codes, p):
+    # Observed homozygous genotypes, non-missing genotypes and expected homozygous genotypes (1 - 2pq summed over
+    # each person's non-missing SNPs) for every person in a (SNPs x people) array of genotype codes, where p is the A1
+    # frequency of each SNP. Monomorphic SNPs are skipped.
+    polymorphic = (p > 0) & (p < 1)
+    codes = codes[polymorphic]
+    expected = 1 - 2 * p[polymorphic] * (1 - p[polymorphic])
+    nonmissing = (codes != 1)
+    return ((codes == 0) | (codes == 3)).sum(axis=0), nonmissing.sum(axis=0), expected.dot(nonmissing)
+
+
+def _f_statistic(o_hom, e_hom, n_nm):
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return (o_hom - e_hom) / (n_nm - e_hom)
+
+
+class _HetTotals(object):
+    # Running totals per person for heterozygosity(), so qc_scan can build them up in the same pass as everything else.
+
+    def __init__(self, geno, max_missing):
+        self.founders = _founders(geno)
+        self.max_missing = max_missing
+        self.o_hom = np.zeros(geno.n_samples, dtype=np.int64)
+        self.n_nm = np.zeros(geno.n_samples, dtype=np.int64)
+        self.e_hom = np.zeros(geno.n_samples, dtype=np.float64)
+        self.kept = np.ones(geno.n_variants, dtype=bool)
+
+    def add(self, codes, chromosomes, sexes, start, end, missing_rate=None):
+        if self.max_missing is not None:
+            if missing_rate is None:
+                missing_rate = variant_missing_rate(codes, chromosomes, sexes)
+            self.kept[start:end] = missing_rate <= self.max_missing
+        use = self.kept[start:end] & (chromosomes >= 1) & (chromosomes <= 22)
+        if not use.any():
+            return
+        codes = codes[use]
+        founder_codes = codes[:, self.founders]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            p = _A1_DOSAGE[founder_codes].clip(0).sum(axis=1) / (2.0 * (founder_codes != 1).sum(axis=1))
+        o_hom, n_nm, e_hom = _homozygosity(codes, p)
+        self.o_hom += o_hom
+        self.n_nm += n_nm
+        self.e_hom += e_hom
+
+    def table(self, geno):
+        return pd.DataFrame({'FID': geno.fids, 'IID': geno.iids, 'O(HOM)': self.o_hom,
+                             'E(HOM)': _significant(self.e_hom), 'N(NM)': self.n_nm,
+                             'F': _significant(_f_statistic(self.o_hom, self.e_hom, self.n_nm))})
+
+
+def heterozygosity(geno, max_missing=None, chunk_bytes=CHUNK_BYTES):
+    # Same table as plink --het writes to the .het file (FID, IID, O(HOM), E(HOM), N(NM), F), worked out in one pass
+    # over the .bed file with running totals per person. Like plink, only autosomes are used, the expected
+    # homozygosity of each SNP (1 - 2pq) comes from the founders' allele frequencies, and monomorphic SNPs are
+    # skipped. If max_missing is given, SNPs with a missing call rate above it are skipped too (plink's --geno, which
+    # plink applies after --mind, so filter the people first). Also returns which SNPs passed max_missing.
+    geno = dataset(geno)
+    totals = _HetTotals(geno, max_missing)
+    for start, end in geno.chunks(chunk_bytes // 4):
+        totals.add(geno.genotypes(start, end), geno.chromosomes[start:end], geno.sexes, start, end)
+    return totals.table(geno), totals.kept
+
+
+def qc_scan(geno, max_missing=None, chunk_bytes=CHUNK_BYTES):
+    # One pass over the .bed file that collects everything the QC steps need:
+    #   sample_missing, sample_total - missing and counted genotypes per person (plink's .imiss)
+    #   variant_missing, variant_total - missing and counted genotypes per SNP (plink's .lmiss)
+    #   x_o_hom, x_e_hom, x_n_nm - chrX homozygosity per person, for the sex check F statistic (everyone is treated as
+    #       diploid here, and the allele frequencies come from the founders with males counted as haploid, like plink
+    #       --check-sex). Nothing is LD pruned, so this is F over all of chrX.
+    #   y_count - non-missing chrY genotypes per person
+    #   het, het_kept - heterozygosity(geno, max_missing) over everybody in geno
+    # Women's chrY genotypes don't count towards the missing call rates, the same as plink.
+    geno = dataset(geno)
+    sexes = geno.sexes
+    males = (sexes == 1)
+    founders = _founders(geno)
+    result = {'sample_missing': np.zeros(geno.n_samples, dtype=np.int64),
+              'sample_total': np.zeros(geno.n_samples, dtype=np.int64),
+              'variant_missing': np.zeros(geno.n_variants, dtype=np.int64),
+              'variant_total': np.zeros(geno.n_variants, dtype=np.int64),
+              'x_o_hom': np.zeros(geno.n_samples, dtype=np.int64),
+              'x_n_nm': np.zeros(geno.n_samples, dtype=np.int64),
+              'x_e_hom': np.zeros(geno.n_samples, dtype=np.float64),
+              'y_count': np.zeros(geno.n_samples, dtype=np.int64)}
+    het = _HetTotals(geno, max_missing)
+
+    for start, end in geno.chunks(chunk_bytes // 4):
+        codes = geno.genotypes(start, end)
+        chromosomes = geno.chromosomes[start:end]
+
+        # Missing call rates.
+        counted = _counted(chromosomes, sexes)
+        missing = (codes == 1) & counted
+        result['sample_missing'] += missing.sum(axis=0)
+        result['sample_total'] += counted.sum(axis=0)
+        result['variant_missing'][start:end] = missing.sum(axis=1)
+        result['variant_total'][start:end] = counted.sum(axis=1)
+
+        # chrX homozygosity.
+        on_x = (chromosomes == 23)
+        if on_x.any():
+            x_codes = codes[on_x]
+            dosage = _A1_DOSAGE[x_codes].astype(np.int64)
+            founder_calls = (dosage >= 0) & ~(males & (dosage == 1)) & founders
+            alleles = np.where(founder_calls, np.where(males, 1, 2), 0).sum(axis=1)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                p = np.where(founder_calls, np.where(males, dosage // 2, dosage), 0).sum(axis=1) / alleles.astype(
+                    np.float64)
+            o_hom, n_nm, e_hom = _homozygosity(x_codes, p)
+            result['x_o_hom'] += o_hom
+            result['x_n_nm'] += n_nm
+            result['x_e_hom'] += e_hom
+
+        # chrY calls.
+        on_y = (chromosomes == 24)
+        if on_y.any():
+            result['y_count'] += (codes[on_y] != 1).sum(axis=0)
+
+        # Heterozygosity, using the missing call rates we just worked out.
+        with np.errstate(invalid='ignore', divide='ignore'):
+            missing_rate = result['variant_missing'][start:end] / result['variant_total'][start:end].astype(np.float64)
+        het.add(codes, chromosomes, sexes, start, end, missing_rate)
+
+    result['x_f'] = _f_statistic(result['x_o_hom'], result['x_e_hom'], result['x_n_nm'])
+    result['het'] = het.table(geno)
+    result['het_kept'] = het.kept
+    return result
+
+
+def _significant(values, digits=4):
+    # Round to a number of significant digits, which is what plink prints in the .frq file.
+    values = np.asarray(values, dtype=np.float64)
+    rounded = values.copy()
+    nonzero = np.isfinite(values) & (values != 0)
+    scale = 10.0 ** (digits - 1 - np.floor(np.log10(np.abs(values[nonzero]))))
+    rounded[nonzero] = np.round(values[nonzero] * scale) / scale
+    return rounded
+
+
+def frequencies(geno, chunk_bytes=CHUNK_BYTES, founders_only=True):
+    # Same table as plink --freq writes to the .frq file (CHR, SNP, A1, A2, MAF, NCHROBS), but computed straight from
+    # the .bed file. As in plink, only founders are counted (see allele_counts), A1 is the minor allele (the bim order
+    # is kept on a tie) and MAF is rounded to 4 significant digits. MAF is NaN when there are no observed alleles.
+    geno, a1_counts, obs_counts = allele_counts(geno, chunk_bytes, founders_only)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        a1_frq = a1_counts / obs_counts.astype(np.float64)
+    swap = a1_frq > 0.5
+    freq = pd.DataFrame({'CHR': geno.chromosomes.astype(int), 'SNP': geno.snps,
+                         'A1': np.where(swap, geno.a2, geno.a1), 'A2': np.where(swap, geno.a1, geno.a2),
+                         'MAF': _significant(np.where(swap, 1 - a1_frq, a1_frq)), 'NCHROBS': obs_counts})
+    return freq
+
@@ -4,6 +4,7 @@ import glob
 import shutil
 import subprocess
 from os.path import expanduser
+import genobed
 
 try:
     import colorama
@@ -36,7 +37,16 @@ else:
     genodownload.plink()
 
 
-def cluster(geno_name, allocation_name, harmonizer_path, vcf_path, legend_path, fasta_path):
+def harmonize_resources(n_variants, n_samples):
+    # Memory (MB) and wall time (hours) to ask for to harmonize one chromosome with n_variants SNPs. Genotype Harmonizer
+    # holds the study genotypes in memory (give it about 4 bytes a genotype on top of 1GB), and most of its time goes
+    # into reading the 1000G VCF plus a part that grows with the genotypes. These are rough, with room to spare.
+    import genojobs
+    heap_mb = 1024 + n_variants * n_samples // (256 * 1024)
+    return heap_mb, heap_mb + 512, genojobs.walltime(1800 + n_variants * n_samples / 50000.0)
+
+
+def cluster(geno_name, allocation_name, harmonizer_path, vcf_path, legend_path, fasta_path, scheduler=None):
     # Using 1000 Genomes as a reference(based off Perl script by W.Rayner, 2015, wrayner @ well.ox.ac.uk)
     #   -Removes SNPs with MAF < 5% in study dataset
     #   -Removes SNPs not in 1000 Genomes Phase 3
@@ -48,6 +58,21 @@ def cluster(geno_name, allocation_name, harmonizer_path, vcf_path, legend_path,
     #   -Removes SNPs with HWE p-value < 0.01
     #   -Updates the reference allele to match 1000G
     #   -Outputs new files per chromosome, in plink bed/bim/fam format.
+    # The autosomes are one array job (a task per chromosome), chrX is its own job, and the post processing waits for
+    # both. scheduler is 'pbs', 'slurm' or 'local' (see genojobs.backend), by default whichever this machine has.
+    import genojobs
+
+    try:
+        import numpy as np
+    except (ImportError, ModuleNotFoundError):
+        import genodownload
+        genodownload.getnumpy()
+        import numpy as np
+
+    jobs = genojobs.backend(scheduler, allocation_name)
+    geno = genobed.dataset(geno_name)
+    geno_name = genobed.bfile_name(geno_name)
+    chr_sizes = np.bincount(geno.chromosomes, minlength=27)[1:24].astype(int)
 
     # Make new folder where the harmonized files will be located.
     if not os.path.exists('Harmonized_To_1000G'):
@@ -58,63 +83,161 @@ def cluster(geno_name, allocation_name, harmonizer_path, vcf_path, legend_path,
     shutil.copy2(geno_name + '.bim', 'Harmonized_To_1000G')
     shutil.copy2(geno_name + '.fam', 'Harmonized_To_1000G')
 
-    # Copy post processing script to Harmonized_To_1000G folder
+    # Copy post processing script, and the modules it uses (allele frequency check, legend cache and bed reader), to
+    # Harmonized_To_1000G folder
     shutil.copy2('harmonize_postprocess.py', 'Harmonized_To_1000G')
+    shutil.copy2('genoafcheck.py', 'Harmonized_To_1000G')
+    shutil.copy2('genolegend.py', 'Harmonized_To_1000G')
+    shutil.copy2('genobed.py', 'Harmonized_To_1000G')
 
-    # Switch to this directory.
+    # Switch to this directory, and split the genotypes into one fileset per chromosome there (in one read of the .bed
+    # file) for the jobs to start from.
     os.chdir('Harmonized_To_1000G')
+    genobed.split_chromosomes(geno_name, range(1, 24), [geno_name + '.chr' + str(x) for x in range(1, 24)])
+
+    # Autosomes, one array task per chromosome. Every task gets what the biggest chromosome needs.
+    heap_mb, mem_mb, hours = harmonize_resources(int(chr_sizes[:22].max()), geno.n_samples)
+    autosomes = genojobs.Job(geno_name + '_HarmonizeTo1000G', [
+        plink + ' --bfile ' + geno_name + '.chr$TASK --hardy --hwe 0.01 --maf 0.05 --make-bed --out ' + geno_name
+        + '_MAF_HWE_Filter_chr$TASK',
+        'java -Xmx' + str(heap_mb) + 'm -jar "' + harmonizer_path + '/GenotypeHarmonizer.jar" --input ' + geno_name
+        + '_MAF_HWE_Filter_chr$TASK --ref '
+        + os.path.join(vcf_path, 'ALL.chr$TASK.phase3_shapeit2_mvncall_integrated_v5a.20130502.genotypes.vcf.gz')
+        + ' --refType VCF --update-id --debug --mafAlign 0 --update-reference-allele --outputType PLINK_BED'
+          ' --output ' + geno_name + '_chr${TASK}_Harmonized',
+        'rm ' + geno_name + '_MAF_HWE_Filter_chr$TASK.*',
+        'rm ' + geno_name + '.chr$TASK.*'],
+        cores=1, mem_mb=mem_mb, walltime_hours=hours, tasks=range(1, 23))
+
+    heap_mb, mem_mb, hours = harmonize_resources(int(chr_sizes[22]), geno.n_samples)
+    chr_x = genojobs.Job(geno_name + '_HarmonizeTo1000G_chrX', [
+        # Special handling for chrX: Make list of females
+        "awk -v OFS='\\t' '$5==2 {print $1, $2}' " + geno_name + '.fam > ' + geno_name + '_Females.txt',
+        # Make hwe statistics just using the females
+        plink + ' --bfile ' + geno_name + '.chr23 --hardy --keep ' + geno_name + '_Females.txt --out ' + geno_name
+        + '_chr23',
+        # Get list of SNPs with HWE p-value < 0.01
+        'awk \'$9<0.01 {print $2}\' ' + geno_name + '_chr23.hwe > ' + geno_name + '_chr23_RemHWE.txt',
+        # Remove these from plink file
+        plink + ' --bfile ' + geno_name + '.chr23 --maf 0.05 --exclude ' + geno_name + '_chr23_RemHWE.txt '
+        '--make-bed --out ' + geno_name + '_MAF_HWE_Filter_chr23',
+        # Use awk to replace 23 with X
+        "awk -v OFS='\\t' '{gsub(\"23\", \"X\", $1)}1' " + geno_name + '_MAF_HWE_Filter_chr23.bim > chr23.tmp && '
+        'mv chr23.tmp ' + geno_name + '_MAF_HWE_Filter_chr23.bim',
+        'java -Xmx' + str(heap_mb) + 'm -jar "' + harmonizer_path + '/GenotypeHarmonizer.jar" --input ' + geno_name
+        + '_MAF_HWE_Filter_chr23 --ref '
+        + os.path.join(vcf_path, 'ALL.chrX.phase3_shapeit2_mvncall_integrated_v1b.20130502.genotypes.vcf.gz')
+        + ' --refType VCF --update-id --debug --mafAlign 0 --update-reference-allele --outputType PLINK_BED'
+          ' --output ' + geno_name + '_chr23_Harmonized',
+        'rm ' + geno_name + '_MAF_HWE_Filter_chr23.*',
+        'rm ' + geno_name + '_chr23.*',
+        'rm ' + geno_name + '_chr23_RemHWE.txt',
+        'rm ' + geno_name + '.chr23.*'],
+        cores=1, mem_mb=mem_mb, walltime_hours=hours)
+
+    # The post processing reads every chromosome's genotypes and the legend files.
+    postprocess = genojobs.Job(geno_name + '_HarmonizeTo1000G_Postprocess', [
+        'python harmonize_postprocess.py ' + geno_name + ' ' + legend_path + ' ' + fasta_path],
+        cores=1, mem_mb=4096 + geno.n_variants * geno.n_samples // (1024 * 1024),
+        walltime_hours=genojobs.walltime(1800 + geno.n_variants * geno.n_samples / 500000.0))
+
+    # Submit these jobs
+    after = [jobs.submit(autosomes), jobs.submit(chr_x)]
+    jobs.submit(postprocess, after=after)
+    jobs.wait()
+
+
+def harmonize_chr(i, geno_name, harmonizer_path, vcf_path, worker_mem=1024, threads=None, workers=1):
+    # Filter and harmonize one chromosome (i = 0 is chr1, i = 22 is chrX), then read in its logs. This is one worker's
+    # job when local() harmonizes several chromosomes at the same time. It works from the chromosome's own fileset,
+    # geno_name.chr<i + 1> (see genobed.split_chromosomes), which is removed once it's done with.
 
-    # Write script to harmonize.
-    with open(geno_name + '_HarmonizeTo1000G.pbs', 'w') as file:
-        file.write('#!/bin/bash\n'
-                   '#PBS -l walltime=24:00:00\n'
-                   '#PBS -l nodes=1:ppn=8\n'
-                   '#PBS -l pmem=8gb\n'
-                   '#PBS -A ' + allocation_name
-                   + '\n'
-                     '#PBS -j oe\n'
-                     'cd $PBS_O_WORKDIR\n'
-                     'for i in {1..22}; do '
-                   + plink + ' --bfile ' + geno_name + ' --chr $i --hardy --hwe 0.01 --maf 0.05 --make-bed --out ' +
-                   geno_name + '_MAF_HWE_Filter_chr$[i]\n'
-                   + 'java -Xmx1g -jar "' + harmonizer_path + '/GenotypeHarmonizer.jar" $* --input ' + geno_name +
-                   '_MAF_HWE_Filter_chr$[i] --ref ' +
-                   os.path.join(vcf_path,
-                                'ALL.chr$[i].phase3_shapeit2_mvncall_integrated_v5a.20130502.genotypes.vcf.gz') +
-                   ' --refType VCF --update-id --debug --mafAlign 0 --update-reference-allele --outputType PLINK_BED'
-                     ' --output ' + geno_name + '_chr$[i]_Harmonized\n'
-                   + 'rm ' + geno_name + '_MAF_HWE_Filter_chr$[i].*; done\n'
-                   # Special handling of chrX
-                   # Special handling for chrX: Make list of females
-                   + "awk -v OFS='\\t' '$5==2 {print $1, $2}' " + geno_name + '.fam > ' + geno_name +
-                   '_Females.txt\n'
-                   # Make hwe statistics just using the females
-                   + plink + ' --bfile ' + geno_name + ' --chr X --hardy --keep ' + geno_name + '_Females.txt --out ' +
-                   geno_name + '_chr23\n'
-                   # Get list of SNPs with HWE p-value < 0.01
-                   + 'awk \'$9<0.01 {print $2}\' ' + geno_name + '_chr23.hwe > ' + geno_name + '_chr23_RemHWE.txt\n'
-                   # Remove these from plink file
-                   + plink + ' --bfile ' + geno_name + ' --chr X --maf 0.05 --exclude ' + geno_name +
-                   '_chr23_RemHWE.txt --make-bed --out ' + geno_name + '_MAF_HWE_Filter_chr23\n'
-                   # Use awk to replace 23 with X
-                   + "awk -v OFS='\\t' '{gsub(\"23\", \"X\", $1)}1' " + geno_name +
-                   '_MAF_HWE_Filter_chr23.bim > chr23.tmp && mv chr23.tmp ' + geno_name + '_MAF_HWE_Filter_chr23.bim\n'
-                   + 'java -Xmx1g -jar "' + harmonizer_path + '/GenotypeHarmonizer.jar" $* --input ' + geno_name
-                   + '_MAF_HWE_Filter_chr23 --ref '
-                   + os.path.join(vcf_path,
-                                  'ALL.chrX.phase3_shapeit2_mvncall_integrated_v1b.20130502.genotypes.vcf.gz')
-                   + ' --refType VCF --update-id --debug --mafAlign 0 --update-reference-allele --outputType PLINK_BED'
-                     ' --output ' + geno_name + '_chr23_Harmonized\n'
-                   + 'rm ' + geno_name + '_MAF_HWE_Filter_chr23.*\n'
-                   + 'rm ' + geno_name + '_chr23.*\n'
-                   + 'rm ' + geno_name + '_chr23_RemHWE.txt\n'
-                   + 'python harmonize_postprocess.py ' + geno_name + ' ' + legend_path + ' ' + fasta_path + '\n')
-
-    # Submit this job
-    subprocess.check_output(['qsub', geno_name + '_HarmonizeTo1000G.pbs'])
-
-
-def local(geno_name, harmonizer_path, vcf_path, legend_path, fasta_path):
+    try:
+        import pandas as pd
+    except (ImportError, ModuleNotFoundError):
+        import genodownload
+        genodownload.getpandas()
+        import pandas as pd
+
+    if i < 22:
+        vcf_file_name = 'ALL.chr%d.phase3_shapeit2_mvncall_integrated_v5a.20130502.genotypes.vcf.gz' % (i + 1)
+    elif i == 22:
+        vcf_file_name = 'ALL.chrX.phase3_shapeit2_mvncall_integrated_v1b.20130502.genotypes.vcf.gz'
+    else:
+        # Not sys.exit: this runs in a genopool worker thread, and only an Exception stops the other chromosomes.
+        raise RuntimeError("Something is wrong with the number/name of reference files")
+    harmonized_geno_name = geno_name + '_chr%d_Harmonized' % (i + 1)
+    chr_geno_name = geno_name + '.chr' + str(i + 1)
+
+    # When several chromosomes run at once, each plink only gets its share of the memory and cores.
+    plink_limits = []
+    if workers > 1:
+        plink_limits = ['--memory', str(worker_mem)]
+        if threads:
+            plink_limits.extend(['--threads', str(threads)])
+
+    # Call genotype harmonizer for autosomes
+    if i < 22:
+        # Remove SNPs with HWE p-value < 0.01 and SNPs with MAF < 0.05
+        subprocess.check_output([plink, '--bfile', chr_geno_name, '--hardy', '--hwe', '0.01', '--maf', '0.05',
+                                 '--make-bed', '--out', geno_name + '_MAF_HWE_Filter_chr' + str(i+1)] + plink_limits)
+        subprocess.check_output('java -Xmx' + str(worker_mem) + 'm -jar "' + harmonizer_path
+                                + '/GenotypeHarmonizer.jar" $* --input '
+                                + geno_name + '_MAF_HWE_Filter_chr' + str(i+1) + ' --ref "'
+                                + os.path.join(vcf_path, vcf_file_name)
+                                + '" --refType VCF --update-id --debug --mafAlign 0 --update-reference-allele '
+                                  '--outputType PLINK_BED --output ' + harmonized_geno_name, shell=True)
+        subprocess.call(rm + geno_name + '_MAF_HWE_Filter_chr' + str(i + 1) + '.*', shell=True)
+
+    else:
+        # Special handling for chrX
+        # Make list of females
+        geno = genobed.load(geno_name)
+        pd.Series(geno.iids[geno.sexes == 2]).to_csv(geno_name + '_Females.txt', sep='\t', header=None, index=False)
+        # Make hwe statistics using just females
+        subprocess.check_output([plink, '--bfile', chr_geno_name, '--hardy', '--keep', geno_name + '_Females.txt',
+                                 '--out', geno_name + '_chr23'] + plink_limits)
+        # Get list of SNPs with HWE p-values < 0.01
+        hwe = pd.read_csv(geno_name + '_chr23.hwe', sep='\t', header=None, skiprows=1)
+        hweremove = hwe.loc[hwe[8] <= 0.01]
+        hweremove[1].to_csv(geno_name + '_chr23_RemHWE.txt', sep='\t', header=None, index=False)
+        # Remove these from plink file
+        subprocess.check_output([plink, '--bfile', chr_geno_name, '--maf', '0.05', '--exclude',
+                                 geno_name + '_chr23_RemHWE.txt', '--make-bed', '--out',
+                                 geno_name + '_MAF_HWE_Filter_chr23'] + plink_limits)
+        # Read chrX file into pandas
+        bim_file = pd.read_csv(geno_name + '_MAF_HWE_Filter_chr23.bim', sep='\t', header=None)
+        # Replace '23' with 'X', which is how genotype harmonizer calls X
+        bim_file.iloc[:, 0].replace(23, 'X', inplace=True)
+        # Write new genotype
+        bim_file.to_csv(geno_name + '_MAF_HWE_Filter_chr23.bim', sep='\t', header=False, index=False, na_rep='NA')
+        # Call genotype harmonizer for X chromosome
+        subprocess.check_output('java -Xmx' + str(worker_mem) + 'm -jar "' + harmonizer_path
+                                + '/GenotypeHarmonizer.jar" $* --input '
+                                + geno_name + '_MAF_HWE_Filter_chr23 --ref "'
+                                + os.path.join(vcf_path, vcf_file_name)
+                                + '" --refType VCF --update-id --debug --mafAlign 0 --update-reference-allele '
+                                  '--outputType PLINK_BED --output ' + harmonized_geno_name, shell=True)
+        subprocess.call(rm + geno_name + '_MAF_HWE_Filter_chr23.*', shell=True)
+        # Only remove the hwe files here, the harmonized chrX files also start with _chr23.
+        subprocess.call(rm + geno_name + '_chr23.*', shell=True)
+        subprocess.call(rm + geno_name + '_chr23_RemHWE.txt*', shell=True)
+
+    subprocess.call(rm + chr_geno_name + '.*', shell=True)
+
+    id_update = pd.read_csv(harmonized_geno_name + '_idUpdates.txt', sep='\t', header=0,
+                            dtype={'chr': str, 'pos': int, 'originalId': str, 'newId': str})
+    snp_log = pd.read_csv(harmonized_geno_name + '_snpLog.log', sep='\t', header=0,
+                          dtype={'chr': str, 'pos': int, 'id': str, 'alleles': str, 'action': str, 'message': str})
+
+    print('Harmonized chr' + str(i + 1))
+
+    return id_update, snp_log
+
+
+@genobed.takes_bfile
+def local(geno_name, harmonizer_path, vcf_path, legend_path, fasta_path, workers=1, worker_mem=1024, af_threshold=0.2,
+          af_min_pops=5):
     # Using 1000 Genomes as a reference(based off Perl script by W.Rayner, 2015, wrayner @ well.ox.ac.uk)
     #   -Removes SNPs with MAF < 5% in study dataset
     #   -Removes SNPs not in 1000 Genomes Phase 3
@@ -126,11 +249,17 @@ def local(geno_name, harmonizer_path, vcf_path, legend_path, fasta_path):
     #   -Removes SNPs with HWE p-value < 0.01
     #   -Updates the reference allele to match 1000G
     #   -Outputs new files per chromosome, in plink bed/bim/fam format.
+    # workers is how many chromosomes to harmonize at the same time, worker_mem is the memory (in MB) each one gets for
+    # Genotype Harmonizer and plink. A SNP is removed in the allele frequency check if its AF difference is
+    # > af_threshold in at least af_min_pops of the five 1000G superpopulations.
 
     # Needed modules
     import sys
     import csv
     import gzip
+    import genopool
+    import genoafcheck
+    import genolegend
 
     try:
         import pandas as pd
@@ -172,73 +301,27 @@ def local(geno_name, harmonizer_path, vcf_path, legend_path, fasta_path):
     id_update_names = [s + '_idUpdates.txt' for s in harmonized_geno_names]
     snp_logs = [s + '_snpLog.log' for s in harmonized_geno_names]
     snp_log_names = [s + '_snpLog.log' for s in harmonized_geno_names]
-    freq_file_names = [geno_name + '_chr%d_Harmonized.frq' % x for x in range(1, 24)]
     af_diff_removed_by_chr = ['chr%d_SNPsRemoved_AFDiff' % x for x in range(1, 24)]
     final_snps_by_chr = ['chr%d_SNPsKept' % x for x in range(1, 24)]
     final_snp_lists = ['chr%d_SNPsKept.txt' % x for x in range(1, 24)]
     af_checked_names = [geno_name + '_chr%d_HarmonizedTo1000G' % x for x in range(1, 24)]
 
-    # Harmonize for each chromosome
-    for i in range(0, len(vcf_file_names)):
-        # Call genotype harmonizer for autosomes
-        if i < 22:
-            # Remove SNPs with HWE p-value < 0.01 and SNPs with MAF < 0.05
-            subprocess.check_output([plink, '--bfile', geno_name, '--chr', str(i+1), '--hardy', '--hwe', '0.01',
-                                     '--maf', '0.05', '--make-bed', '--out',
-                                     geno_name + '_MAF_HWE_Filter_chr' + str(i+1)])
-            subprocess.check_output('java -Xmx1g -jar "' + harmonizer_path + '/GenotypeHarmonizer.jar" $* --input '
-                                    + geno_name + '_MAF_HWE_Filter_chr' + str(i+1) + ' --ref "'
-                                    + os.path.join(vcf_path, vcf_file_names[i])
-                                    + '" --refType VCF --update-id --debug --mafAlign 0 --update-reference-allele '
-                                      '--outputType PLINK_BED --output ' + harmonized_geno_names[i], shell=True)
-            subprocess.call(rm + geno_name + '_MAF_HWE_Filter_chr' + str(i + 1) + '.*', shell=True)
-            id_updates[i] = pd.read_csv(id_update_names[i], sep='\t', header=0,
-                                        dtype={'chr': str, 'pos': int, 'originalId': str, 'newId': str})
-            snp_logs[i] = pd.read_table(snp_log_names[i], sep='\t', header=0,
-                                        dtype={'chr': str, 'pos': int, 'id': str, 'alleles': str, 'action': str,
-                                               'message': str})
-
-        elif i == 22:
-            # Special handling for chrX
-            # Make list of females
-            fam_file = pd.read_csv(geno_name + '.fam', sep=' ', header=None)
-            females = fam_file.loc[fam_file[4] == 2]
-            females[1].to_csv(geno_name + '_Females.txt', sep='\t', header=None, index=False)
-            # Make hwe statistics using just females
-            subprocess.check_output([plink, '--bfile', geno_name, '--chr', 'X', '--hardy', '--keep',
-                                     geno_name + '_Females.txt', '--out', geno_name + '_chr23'])
-            # Get list of SNPs with HWE p-values < 0.01
-            hwe = pd.read_csv(geno_name + '_chr23.hwe', sep='\t', header=None, skiprows=1)
-            hweremove = hwe.loc[hwe[8] <= 0.01]
-            hweremove[1].to_csv(geno_name + '_chr23_RemHWE.txt', sep='\t', header=None, index=False)
-            # Remove these from plink file
-            subprocess.check_output([plink, '--bfile', geno_name, '--chr', 'X', '--maf', '0.05', '--exclude',
-                                     geno_name + '_chr23_RemHWE.txt', '--make-bed', '--out',
-                                     geno_name + '_MAF_HWE_Filter_chr23'])
-            # Read chrX file into pandas
-            bim_file = pd.read_csv(geno_name + '_MAF_HWE_Filter_chr23.bim', sep='\t', header=None)
-            # Replace '23' with 'X', which is how genotype harmonizer calls X
-            bim_file.iloc[:, 0].replace(23, 'X', inplace=True)
-            # Write new genotype
-            bim_file.to_csv(geno_name + '_MAF_HWE_Filter_chr23.bim', sep='\t', header=False, index=False, na_rep='NA')
-            # Call genotype harmonizer for X chromosome
-            subprocess.check_output('java -Xmx1g -jar "' + harmonizer_path + '/GenotypeHarmonizer.jar" $* --input '
-                                    + geno_name + '_MAF_HWE_Filter_chr23 --ref "'
-                                    + os.path.join(vcf_path, vcf_file_names[i])
-                                    + '" --refType VCF --update-id --debug --mafAlign 0 --update-reference-allele '
-                                      '--outputType PLINK_BED --output ' + harmonized_geno_names[i], shell=True)
-            subprocess.call(rm + geno_name + '_MAF_HWE_Filter_chr23.*', shell=True)
-            subprocess.call(rm + geno_name + '_chr23*', shell=True)
-            subprocess.call(rm + geno_name + '_chr23_RemHWE.txt*', shell=True)
-
-            id_updates[i] = pd.read_csv(id_update_names[i], sep='\t', header=0,
-                                        dtype={'chr': str, 'pos': int, 'originalId': str, 'newId': str})
-            snp_logs[i] = pd.read_csv(snp_log_names[i], sep='\t', header=0,
-                                      dtype={'chr': str, 'pos': int, 'id': str, 'alleles': str, 'action': str,
-                                             'message': str})
-        else:
-            print(Fore.RED + Style.BRIGHT)
-            sys.exit("Something is wrong with the number/name of reference files")
+    # Split the genotypes into one fileset per chromosome, in one read of the .bed file, for the workers to start from.
+    # Count how many variants are on each chromosome so the biggest chromosomes get started first.
+    geno = genobed.load(geno_name)
+    genobed.split_chromosomes(geno, range(1, 24), [geno_name + '.chr' + str(x) for x in range(1, 24)])
+    chr_sizes = list(np.bincount(geno.chromosomes, minlength=27)[1:24].astype(int))
+
+    # Leave room for the other workers when plink picks how many threads to use.
+    threads = max(1, genopool.cores() // workers)
+
+    # Harmonize each chromosome. With more than one worker the chromosomes are run at the same time, but the results
+    # are collected in chromosome order so the output is the same as running them one at a time.
+    harmonized = genopool.run(harmonize_chr, [(i, geno_name, harmonizer_path, vcf_path, worker_mem, threads, workers)
+                                              for i in range(0, len(vcf_file_names))],
+                              workers=workers, sizes=chr_sizes)
+    for i in range(0, len(harmonized)):
+        id_updates[i], snp_logs[i] = harmonized[i]
 
     # Concatenate all of the id updates into one file.
     all_id_updates = pd.concat([id_updates[0], id_updates[1], id_updates[2], id_updates[3], id_updates[4],
@@ -271,12 +354,9 @@ def local(geno_name, harmonizer_path, vcf_path, legend_path, fasta_path):
     # of any superpopulation frequency, keep variant. Frequency file is expected to be a Plink frequency file with the
     # same number of variants as the bim file.
     for i in range(0, len(harmonized_geno_names)):
-        # Create plink file
-        subprocess.check_output([plink, '--bfile', harmonized_geno_names[i], '--freq', '--out',
-                                 harmonized_geno_names[i]])
-        # Read freq file into python
-        freq_file = pd.read_csv(freq_file_names[i], sep='\s+', header=0, usecols=[0, 1, 2, 3, 4],
-                                dtype={'CHR': int, 'SNP': str, 'A1': str, 'A2': str, 'MAF': float})
+        # Allele frequencies, computed straight from the bed file instead of running plink --freq and reading the .frq
+        # file back in. Same columns as the .frq file, and A1 is the minor allele like in plink.
+        freq_file = genobed.frequencies(harmonized_geno_names[i]).drop(columns='NCHROBS')
         # Rename columns of freq file.
         freq_file.rename(columns={'A1': 'dataset_a1', 'A2': 'dataset_a2', 'MAF': 'dataset_a1_frq'}, inplace=True)
         # Calculate the frequency of the second allele, since it's not given in the freq file.
@@ -286,107 +366,29 @@ def local(geno_name, harmonizer_path, vcf_path, legend_path, fasta_path):
                                names=['CHR', 'SNP', 'position'])
         # Merge frequency file with bim file to get position for each SNP
         freq_file_with_position = pd.merge(left=freq_file, right=bim_file, how='inner', on=['CHR', 'SNP'])
-        # Read in legend file.
-        legend_file = pd.read_csv(os.path.join(legend_path, legend_file_names[i]), compression="gzip", sep=" ",
-                                  header=0, dtype={'id': str, 'position': int, 'a0': str, 'a1': str, 'TYPE': str,
-                                                   'AFR': float, 'AMR': float, 'EAS': float, 'EUR': float, 'SAS': float,
-                                                   'ALL': float})
-        # Rename columns of legend file
-        legend_file.rename(columns={'id': 'reference_id', 'a0': 'reference_a0', 'a1': 'reference_a1'}, inplace=True)
-
-        # To Remove A/T or G/C SNPs in reference file that have an MAF > 40%, first identify which are AT/GC SNPs.
-        legend_file['ATGC_SNP'] = np.where(
-            ((legend_file['reference_a0'] == 'A') & (legend_file['reference_a1'] == 'T')) |
-            ((legend_file['reference_a0'] == 'T') & (legend_file['reference_a1'] == 'A')) |
-            ((legend_file['reference_a0'] == 'C') & (legend_file['reference_a1'] == 'G')) |
-            ((legend_file['reference_a0'] == 'G') & (legend_file['reference_a1'] == 'C')), 'ATGC', 'Fine')
-        # For each superpopulation, create a new column with the MAF. If the AF in that column is less than 0.5, then
-        # that is the MAF, if not then 1-AF is MAF
-        legend_file['AFR_MAF'] = np.where(legend_file['AFR'] < 0.5, legend_file['AFR'], 1 - legend_file['AFR'])
-        legend_file['AMR_MAF'] = np.where(legend_file['AMR'] < 0.5, legend_file['AMR'], 1 - legend_file['AMR'])
-        legend_file['EAS_MAF'] = np.where(legend_file['EAS'] < 0.5, legend_file['EAS'], 1 - legend_file['EAS'])
-        legend_file['EUR_MAF'] = np.where(legend_file['EUR'] < 0.5, legend_file['EUR'], 1 - legend_file['EUR'])
-        legend_file['SAS_MAF'] = np.where(legend_file['SAS'] < 0.5, legend_file['SAS'], 1 - legend_file['SAS'])
-
-        # Create column in legend file with decision about whether to keep or remove SNP, if it is an ATGC SNP where
-        # the MAF in all superpopulations is greater than 40%, then remove it.
-        legend_file['MAF_Decision'] = np.where((legend_file['ATGC_SNP'] == 'ATGC') & (legend_file['AFR_MAF'] > 0.4) &
-                                               (legend_file['AMR_MAF'] > 0.4) & (legend_file['EAS_MAF'] > 0.4) &
-                                               (legend_file['EUR_MAF'] > 0.4) & (legend_file['SAS_MAF'] > 0.4),
-                                               'Remove', 'Keep')
-
-        # Make new legend file with just the SNPs that pass this threshold.
-        legend_file = legend_file[legend_file['MAF_Decision'] == 'Keep']
-
-        legend_file.drop(labels=['ATGC_SNP', 'AFR_MAF', 'AMR_MAF', 'EAS_MAF', 'EUR_MAF', 'SAS_MAF', 'MAF_Decision'],
-                         axis=1, inplace=True)
-
-        # Merge freq file with positions with legend file to get overlap. This file contains only SNPs with matches in
+        # Match on position with the legend for this chromosome, using the sorted position index in the legend cache
+        # (built once from the legend.gz files). The legend cache only has biallelic SNPs, and A/T or G/C SNPs with an
+        # MAF > 40% in all superpopulations have already been taken out. This file contains only SNPs with matches in
         # 1000G
-        merged_file = pd.merge(left=freq_file_with_position, right=legend_file, how='inner', on='position')
-        merged_file = merged_file[merged_file['TYPE'] == 'Biallelic_SNP']
+        merged_file = genolegend.join(freq_file_with_position, legend_path, i)
 
         # The MAF column in the frq file is the allele frequency of the A1 allele (which is usually minor, but
         # possibly not in my case because I just updated the reference to match 1000G.
         # The AF columns in the legend file are the allele frequencies of the a1 allele in that file.
-        # Need to match based on A1 alleles (hopefully this has already been done in the harmonization step, then
-        # calculate the allele frequency difference.
-        # For each population group, match the alleles where they aren't flipped (i.e. in the same order in house and
-        # ref datasets..
-        merged_file['AFR_Match_Diff'] = np.where((merged_file['dataset_a1'] == merged_file['reference_a1']) &
-                                                 (merged_file['dataset_a2'] == merged_file['reference_a0']),
-                                                 abs(merged_file['dataset_a1_frq'] - merged_file['AFR']), '')
-        merged_file['AMR_Match_Diff'] = np.where((merged_file['dataset_a1'] == merged_file['reference_a1']) &
-                                                 (merged_file['dataset_a2'] == merged_file['reference_a0']),
-                                                 abs(merged_file['dataset_a1_frq'] - merged_file['AMR']), '')
-        merged_file['EAS_Match_Diff'] = np.where((merged_file['dataset_a1'] == merged_file['reference_a1']) &
-                                                 (merged_file['dataset_a2'] == merged_file['reference_a0']),
-                                                 abs(merged_file['dataset_a1_frq'] - merged_file['EAS']), '')
-        merged_file['EUR_Match_Diff'] = np.where((merged_file['dataset_a1'] == merged_file['reference_a1']) &
-                                                 (merged_file['dataset_a2'] == merged_file['reference_a0']),
-                                                 abs(merged_file['dataset_a1_frq'] - merged_file['EUR']), '')
-        merged_file['SAS_Match_Diff'] = np.where((merged_file['dataset_a1'] == merged_file['reference_a1']) &
-                                                 (merged_file['dataset_a2'] == merged_file['reference_a0']),
-                                                 abs(merged_file['dataset_a1_frq'] - merged_file['SAS']), '')
-        # For each population group, match the flipped alleles.
-        merged_file['AFR_FlipMatch_Diff'] = np.where((merged_file['dataset_a1'] == merged_file['reference_a0']) &
-                                                     (merged_file['dataset_a2'] == merged_file['reference_a1']),
-                                                     abs(merged_file['dataset_a2_frq'] - merged_file['AFR']), '')
-        merged_file['AMR_FlipMatch_Diff'] = np.where((merged_file['dataset_a1'] == merged_file['reference_a0']) &
-                                                     (merged_file['dataset_a2'] == merged_file['reference_a1']),
-                                                     abs(merged_file['dataset_a2_frq'] - merged_file['AMR']), '')
-        merged_file['EAS_FlipMatch_Diff'] = np.where((merged_file['dataset_a1'] == merged_file['reference_a0']) &
-                                                     (merged_file['dataset_a2'] == merged_file['reference_a1']),
-                                                     abs(merged_file['dataset_a2_frq'] - merged_file['EAS']), '')
-        merged_file['EUR_FlipMatch_Diff'] = np.where((merged_file['dataset_a1'] == merged_file['reference_a0']) &
-                                                     (merged_file['dataset_a2'] == merged_file['reference_a1']),
-                                                     abs(merged_file['dataset_a2_frq'] - merged_file['EUR']), '')
-        merged_file['SAS_FlipMatch_Diff'] = np.where((merged_file['dataset_a1'] == merged_file['reference_a0']) &
-                                                     (merged_file['dataset_a2'] == merged_file['reference_a1']),
-                                                     abs(merged_file['dataset_a2_frq'] - merged_file['SAS']), '')
-        # Add the nonflipped and flipped columns together to find out which files have an allele frequency
-        # difference > 0.2
-        merged_file['AFR_Diff'] = merged_file['AFR_Match_Diff'] + merged_file['AFR_FlipMatch_Diff']
-        merged_file['AMR_Diff'] = merged_file['AMR_Match_Diff'] + merged_file['AMR_FlipMatch_Diff']
-        merged_file['EAS_Diff'] = merged_file['EAS_Match_Diff'] + merged_file['EAS_FlipMatch_Diff']
-        merged_file['EUR_Diff'] = merged_file['EUR_Match_Diff'] + merged_file['EUR_FlipMatch_Diff']
-        merged_file['SAS_Diff'] = merged_file['SAS_Match_Diff'] + merged_file['SAS_FlipMatch_Diff']
-
-        # Delete these columns because we don't need them anymore
-        merged_file.drop(labels=['AFR_Match_Diff', 'AFR_FlipMatch_Diff', 'AMR_Match_Diff', 'AMR_FlipMatch_Diff',
-                                 'EAS_Match_Diff', 'EAS_FlipMatch_Diff', 'EUR_Match_Diff', 'EUR_FlipMatch_Diff',
-                                 'SAS_Match_Diff', 'SAS_FlipMatch_Diff'], axis=1, inplace=True)
-
-        # Make allele freuqency columns numeric.
-        merged_file[['AFR_Diff', 'AMR_Diff', 'EAS_Diff', 'EUR_Diff', 'SAS_Diff']] = \
-            merged_file[['AFR_Diff', 'AMR_Diff', 'EAS_Diff', 'EUR_Diff', 'SAS_Diff']].apply(pd.to_numeric,
-                                                                                            errors='coerce')
-
-        # Make new column 'AF_Decision' where you remove alleles that have allele frequency differences > 0.2 from all
-        # population groups.
-        merged_file['AF_Decision'] = np.where((merged_file['AFR_Diff'] > 0.2) & (merged_file['AMR_Diff'] > 0.2) &
-                                              (merged_file['EAS_Diff'] > 0.2) & (merged_file['EUR_Diff'] > 0.2) &
-                                              (merged_file['SAS_Diff'] > 0.2), 'Remove', 'Keep')
+        # Match on the A1 alleles (either in the same order or flipped) and calculate the allele frequency difference
+        # for every superpopulation at once, using integer coded alleles.
+        _, af_remove, af_diffs = genoafcheck.af_check(
+            genoafcheck.encode_alleles(merged_file['dataset_a1']),
+            genoafcheck.encode_alleles(merged_file['dataset_a2']),
+            merged_file['dataset_a1_frq'].values, genoafcheck.encode_alleles(merged_file['reference_a0']),
+            genoafcheck.encode_alleles(merged_file['reference_a1']), merged_file[genoafcheck.POPULATIONS].values,
+            threshold=af_threshold, min_pops=af_min_pops)
+        for j in range(0, len(genoafcheck.POPULATIONS)):
+            merged_file[genoafcheck.POPULATIONS[j] + '_Diff'] = af_diffs[:, j]
+
+        # Make new column 'AF_Decision' where you remove alleles that have allele frequency differences > the
+        # threshold in all (or the chosen number of) population groups.
+        merged_file['AF_Decision'] = np.where(af_remove, 'Remove', 'Keep')
 
         # Drop duplicate SNPs
         merged_file.drop_duplicates(subset=['SNP'], keep=False, inplace=True)
@@ -0,0 +1,232 @@
+import os
+import math
+import shutil
+import subprocess
+import threading
+
+import genopool
+
+# One place that knows how to run a batch job, instead of every module writing its own PBS script. A job is a list of
+# shell commands plus what it needs (cores, memory, wall time); a backend turns that into a script for its scheduler
+# and submits it:
+#   PBS   - qsub (Torque, like the Penn State ACI-B cluster)
+#   Slurm - sbatch
+#   Local - runs the jobs on this computer, side by side as far as the cores and memory allow. Handy for testing a
+#           pipeline on a laptop (with stand-in programs on the PATH) before it goes to the cluster.
+# Array jobs run the same commands once per task, with $TASK set to the task's value (e.g. the chromosome number), so
+# one submission replaces a script per chromosome. Jobs can wait for other jobs to finish OK (after).
+# The resources should be worked out from the size of the input (number of variants, people...) by whoever makes the
+# job, so each step asks for what it needs rather than the same fixed amount every time.
+
+
+class Job(object):
+    # name - name of the job, also used for its script (<name>.pbs, .slurm or .sh) and log
+    # commands - shell commands, one per line. In an array job, $TASK is this task's value.
+    # cores, mem_mb, walltime_hours - what one task needs
+    # tasks - the task values (ints) for an array job, or None for a single job
+    # workdir - folder the job runs in. Its script and log go there too.
+    def __init__(self, name, commands, cores=1, mem_mb=1024, walltime_hours=24, tasks=None, workdir='.'):
+        self.name = name
+        self.commands = list(commands)
+        self.cores = max(1, int(cores))
+        self.mem_mb = max(1, int(mem_mb))
+        self.walltime_hours = max(1, int(math.ceil(walltime_hours)))
+        self.tasks = None if tasks is None else [int(x) for x in tasks]
+        self.workdir = workdir
+
+    def script_path(self, extension):
+        return os.path.join(self.workdir, self.name + extension)
+
+
+def walltime(seconds, safety=2.0, min_hours=1, max_hours=None):
+    # Turn an estimate of how long something takes (in seconds) into hours to ask for, with room to spare.
+    hours = max(min_hours, int(math.ceil(seconds * safety / 3600.0)))
+    return hours if max_hours is None else min(hours, max_hours)
+
+
+def _task_list(tasks):
+    # Task values the way qsub -t and sbatch --array want them, e.g. 1-22 or 1,3,5.
+    if tasks == list(range(tasks[0], tasks[-1] + 1)):
+        return str(tasks[0]) + '-' + str(tasks[-1])
+    return ','.join(str(x) for x in tasks)
+
+
+class PBS(object):
+    extension = '.pbs'
+
+    def __init__(self, allocation):
+        self.allocation = allocation
+        # Array jobs have to be waited for with afterokarray instead of afterok.
+        self._arrays = set()
+
+    def script(self, job):
+        lines = ['#!/bin/bash',
+                 '#PBS -N ' + job.name,
+                 '#PBS -l walltime=' + str(job.walltime_hours) + ':00:00',
+                 '#PBS -l nodes=1:ppn=' + str(job.cores),
+                 '#PBS -l pmem=' + str(int(math.ceil(job.mem_mb / float(job.cores)))) + 'mb',
+                 '#PBS -A ' + self.allocation,
+                 '#PBS -j oe']
+        if job.tasks is not None:
+            lines.append('#PBS -t ' + _task_list(job.tasks))
+        lines.extend(['cd $PBS_O_WORKDIR', ''])
+        if job.tasks is not None:
+            lines.append('TASK=$PBS_ARRAYID')
+        return '\n'.join(lines + job.commands) + '\n'
+
+    def submit(self, job, after=()):
+        command = ['qsub']
+        if after:
+            depend = [kind + ':' + ':'.join(ids) for kind, ids in
+                      (('afterok', [x for x in after if x not in self._arrays]),
+                       ('afterokarray', [x for x in after if x in self._arrays])) if ids]
+            command.extend(['-W', 'depend=' + ','.join(depend)])
+        job_id = subprocess.check_output(command + [os.path.basename(write(self, job))], cwd=job.workdir) \
+            .decode().strip()
+        if job.tasks is not None:
+            self._arrays.add(job_id)
+        return job_id
+
+    def wait(self):
+        pass
+
+
+class Slurm(object):
+    extension = '.slurm'
+
+    def __init__(self, account=None, partition=None):
+        self.account = account
+        self.partition = partition
+
+    def script(self, job):
+        lines = ['#!/bin/bash',
+                 '#SBATCH --job-name=' + job.name,
+                 '#SBATCH --time=' + str(job.walltime_hours) + ':00:00',
+                 '#SBATCH --nodes=1',
+                 '#SBATCH --cpus-per-task=' + str(job.cores),
+                 '#SBATCH --mem=' + str(job.mem_mb) + 'M',
+                 '#SBATCH --output=' + job.name + ('_%A_%a.log' if job.tasks is not None else '_%j.log')]
+        if self.account:
+            lines.append('#SBATCH --account=' + self.account)
+        if self.partition:
+            lines.append('#SBATCH --partition=' + self.partition)
+        if job.tasks is not None:
+            lines.append('#SBATCH --array=' + _task_list(job.tasks))
+        lines.extend(['cd $SLURM_SUBMIT_DIR', ''])
+        if job.tasks is not None:
+            lines.append('TASK=$SLURM_ARRAY_TASK_ID')
+        return '\n'.join(lines + job.commands) + '\n'
+
+    def submit(self, job, after=()):
+        command = ['sbatch', '--parsable']
+        if after:
+            command.append('--dependency=afterok:' + ':'.join(after))
+        return subprocess.check_output(command + [os.path.basename(write(self, job))], cwd=job.workdir) \
+            .decode().strip().split(';')[0]
+
+    def wait(self):
+        pass
+
+
+class Local(object):
+    # Every task gets a thread that waits for the jobs it depends on, then for enough free cores and memory, and then
+    # runs the script with bash. Call wait() to block until everything submitted has finished.
+    extension = '.sh'
+
+    def __init__(self, cores=None, mem_mb=None):
+        self.cores = cores or genopool.cores()
+        self.mem_mb = mem_mb or genopool.available_memory_mb() or 4096
+        self._free_cores = self.cores
+        self._free_mem = self.mem_mb
+        self._free = threading.Condition()
+        self._threads = []
+        self._done = {}
+        self._failed = []
+
+    def script(self, job):
+        return '\n'.join(['#!/bin/bash', 'cd "$(dirname "$0")"', ''] + job.commands) + '\n'
+
+    def _run(self, job, script, task, after, done):
+        try:
+            for job_id in after:
+                self._done[job_id].wait()
+            if any(job_id in self._failed for job_id in after):
+                raise RuntimeError(job.name + ' did not run because a job it needs failed')
+            cores = min(job.cores, self.cores)
+            mem_mb = min(job.mem_mb, self.mem_mb)
+            with self._free:
+                self._free.wait_for(lambda: self._free_cores >= cores and self._free_mem >= mem_mb)
+                self._free_cores -= cores
+                self._free_mem -= mem_mb
+            try:
+                env = dict(os.environ)
+                if task is not None:
+                    env['TASK'] = str(task)
+                log = job.script_path('' if task is None else '_' + str(task)) + '.log'
+                with open(log, 'w') as f:
+                    subprocess.check_call(['bash', os.path.abspath(script)], stdout=f, stderr=subprocess.STDOUT,
+                                          env=env)
+            finally:
+                with self._free:
+                    self._free_cores += cores
+                    self._free_mem += mem_mb
+                    self._free.notify_all()
+        except Exception as error:
+            self._failed.append(done.job_id)
+            print(job.name + (' task ' + str(task) if task is not None else '') + ' failed: ' + str(error))
+        finally:
+            with self._free:
+                done.remaining -= 1
+                if done.remaining == 0:
+                    done.set()
+
+    def submit(self, job, after=()):
+        script = write(self, job)
+        done = threading.Event()
+        done.job_id = 'local' + str(len(self._done) + 1)
+        done.remaining = len(job.tasks) if job.tasks is not None else 1
+        self._done[done.job_id] = done
+        for task in (job.tasks if job.tasks is not None else [None]):
+            thread = threading.Thread(target=self._run, args=(job, script, task, list(after), done))
+            thread.start()
+            self._threads.append(thread)
+        return done.job_id
+
+    def wait(self):
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        if self._failed:
+            failed = list(self._failed)
+            self._failed = []
+            raise RuntimeError(str(len(failed)) + ' job(s) failed, see their .log files')
+
+
+def write(backend, job):
+    # Write the job's script for this backend (without submitting it) and return its path.
+    path = job.script_path(backend.extension)
+    with open(path, 'w') as f:
+        f.write(backend.script(job))
+    return path
+
+
+def backend(kind=None, account=None):
+    # 'pbs', 'slurm' or 'local'. By default, whichever scheduler this machine has (sbatch or qsub on the PATH). If it
+    # has neither, that's an error rather than quietly running everything here: the default is only used once the
+    # user has said they're on the cluster. Ask for 'local' to run the jobs on this computer.
+    if kind is None:
+        if shutil.which('sbatch'):
+            kind = 'slurm'
+        elif shutil.which('qsub'):
+            kind = 'pbs'
+        else:
+            raise RuntimeError("I can't find sbatch or qsub on this computer, so I can't submit the jobs. Run this "
+                               "from the cluster, or say you aren't on the cluster to get the job scripts to take "
+                               "there.")
+    if kind == 'pbs':
+        return PBS(account)
+    if kind == 'slurm':
+        return Slurm(account)
+    if kind == 'local':
+        return Local()
+    raise ValueError('Unknown job backend ' + str(kind) + ', use pbs, slurm or local')
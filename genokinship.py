@@ -0,0 +1,236 @@
+import platform
+import os
+import glob
+import subprocess
+from os.path import expanduser
+home = expanduser("~")
+bindir = os.path.join(home, 'software', 'bin')
+
+try:
+    import argparse
+except (ImportError, ModuleNotFoundError):
+    import genodownload
+    genodownload.getargparse()
+    import argparse
+
+try:
+    import pandas as pd
+except (ImportError, ModuleNotFoundError):
+    import genodownload
+    genodownload.getpandas()
+    import pandas as pd
+
+try:
+    import numpy as np
+except (ImportError, ModuleNotFoundError):
+    import genodownload
+    genodownload.getnumpy()
+    import numpy as np
+
+import genobed
+import genold
+
+# Since we use plink a lot, I'm going to go ahead and set a plink variable with the system-specific plink name.
+system_check = platform.system()
+if system_check in ("Linux", "Darwin"):
+    plink = "plink"
+elif system_check == "Windows":
+    plink = 'plink.exe'
+
+# Relatedness for big samples. plink --genome works out PI_HAT for every pair of people, which is n^2 work and can't
+# be split up. Instead this does it in two steps:
+#   1) Screen: a KING-robust kinship estimate for every pair of people, from bit-packed genotypes over LD pruned
+#      autosomal SNPs. For each person there are three rows of bits, one bit per SNP:
+#        het - heterozygous, hom1 - homozygous A1, hom2 - homozygous A2
+#      and for a pair of people, the number of SNPs where both are het (HETHET), the number where they are opposite
+#      homozygotes (IBS0) and the number of het SNPs each of them has where the other is typed are all popcounts of
+#      two of those rows ANDed together. kinship = (HETHET - 2 IBS0) / (het SNPs of the first + het SNPs of the second).
+#      Pairs over min_kinship are the candidates.
+#   2) PI_HAT: plink --genome on just the people in a candidate pair, with the allele frequencies from the founders of
+#      the whole sample (--read-freq), which is what plink would have used in the full run, so the answer is the same.
+# The people are cut into blocks of block_size, and the screen works on pairs of blocks, so it can be split into jobs
+# (run on different machines if needed) that each write their own candidate file. merge puts them back together and
+# runs step 2.
+#
+# To run it split up (job is 0 to jobs - 1):
+#   python genokinship.py screen <bfile> <out> --job <job> --jobs <jobs> [--extract <prune.in>]
+#   python genokinship.py merge <bfile> <out> --jobs <jobs> [--extract <prune.in>]
+
+# KING's cutoff between 3rd and 4th degree relatives. A PI_HAT of 0.1875 is a kinship of about 0.094, so screening at
+# this leaves plenty of room for the kinship estimate being a bit off.
+KING_THIRD_DEGREE = 0.0442
+# People per block.
+BLOCK_SIZE = 1024
+# Most SNPs used for the screen. Kinship is well estimated long before this, and the screen's time goes up with it.
+SCREEN_SNPS = 20000
+# Above this many people, genorelatives.ibd screens first instead of running plink --genome on everybody.
+SCREEN_SAMPLES = 5000
+
+
+def screening_snps(geno, variants=None, max_snps=SCREEN_SNPS):
+    # Boolean mask of the SNPs to screen with: the variants given (by default, a plink --indep 50 5 2 prune, the same
+    # one genorelatives.ibd uses), autosomes only, thinned evenly to max_snps.
+    geno = genobed.dataset(geno)
+    if variants is None:
+        variants = genold.prune(geno, 'vif', 50, 5, 2)
+    use = np.asarray(variants) & (geno.chromosomes >= 1) & (geno.chromosomes <= 22)
+    if use.sum() > max_snps:
+        picked = np.flatnonzero(use)
+        use = np.zeros(geno.n_variants, dtype=bool)
+        use[picked[np.linspace(0, len(picked) - 1, max_snps).astype(np.int64)]] = True
+    return use
+
+
+def _bitplanes(geno):
+    # The het, hom1 and hom2 rows of bits (see the top of this file) for every person in geno, each a (people x words)
+    # uint64 array. The .bed is read 64 SNPs (one word) at a time or more, so the chunks line up with the words.
+    snps_per_chunk = max(64, (genobed.CHUNK_BYTES // 4 // max(1, geno.n_samples)) // 64 * 64)
+    chunks = []
+    for start in range(0, geno.n_variants, snps_per_chunk):
+        codes = geno.genotypes(start, min(start + snps_per_chunk, geno.n_variants)).T
+        chunks.append([genold.pack_bits(codes == code) for code in (2, 0, 3)])
+    return [np.hstack(plane) for plane in zip(*chunks)]
+
+
+def block_pairs(n_samples, block_size=BLOCK_SIZE):
+    # Every pair of blocks (including a block with itself) as (first person, second person) block starts.
+    starts = range(0, n_samples, block_size)
+    return [(i, j) for i in starts for j in starts if j >= i]
+
+
+def screen(geno, variants=None, min_kinship=KING_THIRD_DEGREE, job=0, jobs=1, block_size=BLOCK_SIZE):
+    # Kinship screen of geno (a fileset name or genobed.PlinkDataset) over screening_snps(geno, variants). Only every
+    # jobs-th pair of blocks, starting at job, is done. Returns the pairs with kinship >= min_kinship, as a table like
+    # plink2's .kin0 (FID1, IID1, FID2, IID2, NSNP, HETHET, IBS0, KINSHIP; HETHET and IBS0 as proportions of NSNP).
+    geno = genobed.dataset(geno)
+    planes = _bitplanes(geno.subset(variants=screening_snps(geno, variants)))
+    n_samples = geno.n_samples
+    fids, iids = geno.fids, geno.iids
+
+    pairs = []
+    for k, (i, j) in enumerate(block_pairs(n_samples, block_size)):
+        if k % jobs != job:
+            continue
+        first = np.arange(i, min(i + block_size, n_samples))
+        second = np.arange(j, min(j + block_size, n_samples))
+        counts = genold.and_counts(np.vstack([plane[first] for plane in planes]),
+                                   np.vstack([plane[second] for plane in planes]))
+        (het_het, het_hom1, het_hom2), (hom1_het, hom1_hom1, hom1_hom2), (hom2_het, hom2_hom1, hom2_hom2) = \
+            [np.split(block, 3, axis=1) for block in np.split(counts, 3, axis=0)]
+        ibs0 = hom1_hom2 + hom2_hom1
+        n_snps = het_het + het_hom1 + het_hom2 + hom1_het + hom1_hom1 + hom1_hom2 + hom2_het + hom2_hom1 + hom2_hom2
+        hets = (het_het + het_hom1 + het_hom2) + (het_het + hom1_het + hom2_het)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            kinship = (het_het - 2 * ibs0) / hets.astype(np.float64)
+
+        # A block paired with itself has each pair twice (and everybody with themselves), so only keep one of them.
+        related = kinship >= min_kinship
+        if i == j:
+            related &= first[:, np.newaxis] < second[np.newaxis, :]
+        a, b = np.nonzero(related)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            pairs.append(pd.DataFrame({'FID1': fids[first[a]], 'IID1': iids[first[a]], 'FID2': fids[second[b]],
+                                       'IID2': iids[second[b]], 'NSNP': n_snps[a, b],
+                                       'HETHET': het_het[a, b] / n_snps[a, b].astype(np.float64),
+                                       'IBS0': ibs0[a, b] / n_snps[a, b].astype(np.float64),
+                                       'KINSHIP': kinship[a, b]}))
+    if not pairs:
+        return pd.DataFrame(columns=['FID1', 'IID1', 'FID2', 'IID2', 'NSNP', 'HETHET', 'IBS0', 'KINSHIP'])
+    return pd.concat(pairs, ignore_index=True)
+
+
+def job_file(out, job, jobs):
+    return out + '_' + str(job + 1) + 'of' + str(jobs) + '.kin0'
+
+
+def screen_job(geno, out, job, jobs, variants=None, min_kinship=KING_THIRD_DEGREE):
+    # One job of a split up screen. Writes its candidate pairs to job_file(out, job, jobs).
+    candidates = screen(geno, variants, min_kinship, job, jobs)
+    candidates.to_csv(job_file(out, job, jobs), sep='\t', header=True, index=False)
+    return candidates
+
+
+def pi_hat(geno, out, candidates, variants=None, min_pi_hat=0.1875):
+    # Step 2: plink --genome on the people in the candidate pairs, over the variants given (by default, the same prune
+    # as screening_snps), using allele frequencies from the founders in geno, like a plink --genome run on all of
+    # geno would. The result is out.genome.
+    geno = genobed.dataset(geno)
+    if variants is None:
+        variants = genold.prune(geno, 'vif', 50, 5, 2)
+    variants = np.asarray(variants)
+    geno_name = genobed.bfile_name(geno)
+
+    # Nobody to check, so write a .genome without any pairs in it.
+    if len(candidates) == 0:
+        with open(out + '.genome', 'w') as f:
+            f.write(' '.join(['FID1', 'IID1', 'FID2', 'IID2', 'RT', 'EZ', 'Z0', 'Z1', 'Z2', 'PI_HAT', 'PHE', 'DST',
+                              'PPC', 'RATIO']) + '\n')
+        return out + '.genome'
+
+    people = pd.concat([candidates[['FID1', 'IID1']].set_axis(['FID', 'IID'], axis=1),
+                        candidates[['FID2', 'IID2']].set_axis(['FID', 'IID'], axis=1)]).drop_duplicates()
+    people.to_csv(out + '_candidates.txt', sep='\t', header=False, index=False)
+    with open(out + '_ibd_snps.txt', 'w') as f:
+        f.writelines(snp + '\n' for snp in geno.snps[variants])
+    genobed.frequencies(geno.subset(variants=variants)).to_csv(out + '_ibd.frq', sep='\t', header=True, index=False,
+                                                                  na_rep='NA')
+
+    subprocess.check_output([plink, '--bfile', geno_name, '--extract', out + '_ibd_snps.txt', '--keep',
+                             out + '_candidates.txt', '--read-freq', out + '_ibd.frq', '--genome', '--min',
+                             str(min_pi_hat), '--out', out])
+    return out + '.genome'
+
+
+def relatives(geno, out, variants=None, min_pi_hat=0.1875, min_kinship=KING_THIRD_DEGREE):
+    # Both steps in this process: screen everybody, write the candidates to out.kin0, and PI_HAT them into out.genome.
+    candidates = screen(geno, variants, min_kinship)
+    candidates.to_csv(out + '.kin0', sep='\t', header=True, index=False)
+    print(str(len(candidates)) + " pairs of people have a kinship of at least " + str(min_kinship)
+          + ", working out PI_HAT for them.")
+    return pi_hat(geno, out, candidates, variants, min_pi_hat)
+
+
+def merge(geno, out, jobs, variants=None, min_pi_hat=0.1875):
+    # Put the candidate files from every job together into out.kin0 and PI_HAT them into out.genome.
+    missing = [job_file(out, job, jobs) for job in range(0, jobs) if not os.path.exists(job_file(out, job, jobs))]
+    if missing:
+        raise IOError('These screening jobs have not finished: ' + ', '.join(missing))
+    candidates = pd.concat([pd.read_csv(job_file(out, job, jobs), sep='\t', dtype={'FID1': str, 'IID1': str,
+                                                                                   'FID2': str, 'IID2': str})
+                            for job in range(0, jobs)], ignore_index=True)
+    candidates.to_csv(out + '.kin0', sep='\t', header=True, index=False)
+    genome = pi_hat(geno, out, candidates, variants, min_pi_hat)
+    for job_output in glob.glob(out + '_*of' + str(jobs) + '.kin0'):
+        os.remove(job_output)
+    return genome
+
+
+def _variants(geno, extract):
+    # SNP mask from a plink style SNP list (e.g. a .prune.in file), or None to use the default prune.
+    if extract is None:
+        return None
+    with open(extract, 'r') as f:
+        keep = set(line.strip() for line in f)
+    return np.array([snp in keep for snp in genobed.dataset(geno).snps], dtype=bool)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("command", choices=['screen', 'merge'], help="screen: run one screening job, merge: put the "
+                                                                      "jobs together and work out PI_HAT")
+    parser.add_argument("bfile", help="Plink fileset (without bed/bim/fam extension)")
+    parser.add_argument("out", help="Output name")
+    parser.add_argument("--job", type=int, default=0, help="Which screening job this is (0 to jobs - 1)")
+    parser.add_argument("--jobs", type=int, default=1, help="How many screening jobs there are")
+    parser.add_argument("--extract", default=None, help="SNPs to use (e.g. a .prune.in file)")
+    parser.add_argument("--min", type=float, default=0.1875, help="Smallest PI_HAT to report")
+    parser.add_argument("--min-kinship", type=float, default=KING_THIRD_DEGREE, help="Smallest kinship to screen in")
+    args = parser.parse_args()
+
+    variants = _variants(args.bfile, args.extract)
+    if args.command == 'screen':
+        candidates = screen_job(args.bfile, args.out, args.job, args.jobs, variants, args.min_kinship)
+        print("Finished. " + str(len(candidates)) + " candidate pairs are in " + job_file(args.out, args.job,
+                                                                                        args.jobs))
+    else:
+        print("Finished. Your IBD results are in " + merge(args.bfile, args.out, args.jobs, variants, args.min))
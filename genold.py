@@ -0,0 +1,259 @@
+import os
+from os.path import expanduser
+
+try:
+    import numpy as np
+except (ImportError, ModuleNotFoundError):
+    import genodownload
+    genodownload.getnumpy()
+    import numpy as np
+
+import genobed
+
+# LD pruning without plink, shared by every module that needs it (IBD and ADMIXTURE prep). The result
+# of a prune is kept in ~/software/cache/ldprune under the dataset's key (see genobed.PlinkDataset.key) and the prune
+# settings, so asking for the same prune of the same data again costs nothing.
+#
+# r between two SNPs is worked out from bit-packed genotypes. Each SNP is stored as three rows of bits, one bit per
+# person:
+#   a - has at least one A1 allele, b - has two A1 alleles, m - not missing
+# so the A1 dosage is a + b, and every sum the correlation needs (number of people typed for both SNPs, the sum of
+# each SNP's dosages and squared dosages over them, and the sum of the dosage products) is a popcount of two of those
+# rows ANDed together. Like plink, only people typed for both SNPs are used.
+#
+# Methods (window and step are numbers of SNPs):
+#   pairwise - plink --indep-pairwise. In each window, if a pair of SNPs has r^2 > threshold the one with the lower
+#       MAF is removed.
+#   vif - plink --indep. In each window the SNP with the highest variance inflation factor is removed until none are
+#       over threshold.
+# plink --indep-pairphase isn't here: it needs phased haplotype r^2, which can't be worked out from these counts, so
+# the sex check still has plink do it.
+#
+# The bit rows are read from the .bed as the windows move along a chromosome, and only the ones from the start of the
+# current window on are kept, so memory depends on the window size and the number of people, not the chromosome size.
+
+home = expanduser("~")
+cache_path = os.path.join(home, 'software', 'cache', 'ldprune')
+
+METHODS = ('pairwise', 'vif')
+
+# Number of 1 bits in each byte, for numpy versions without np.bitwise_count.
+_POPCOUNT = np.array([bin(byte).count('1') for byte in range(0, 256)], dtype=np.uint8)
+
+# Largest (rows x columns x words) block of bits ANDed together at once, about 32MB.
+TILE_WORDS = 4 * 1024 * 1024
+# Most SNP pairs r is worked out for at once.
+MAX_PAIRS = 1024 * 1024
+
+
+def pack_bits(mask):
+    # Pack each row of a 2D boolean array into bits, as a (rows x words) uint64 array padded with 0s.
+    packed = np.packbits(mask, axis=1)
+    padding = (-packed.shape[1]) % 8
+    if padding:
+        packed = np.hstack([packed, np.zeros((len(packed), padding), dtype=np.uint8)])
+    return np.ascontiguousarray(packed).view(np.uint64)
+
+
+def _bitplanes(codes):
+    # The a, b and m rows of bits (see the top of this file) for a (SNPs x people) array of genotype codes.
+    return [pack_bits(plane) for plane in ((codes == 0) | (codes == 2), codes == 0, codes != 1)]
+
+
+def popcount(words):
+    # Number of 1 bits along the last axis.
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(words).sum(axis=-1, dtype=np.int64)
+    return _POPCOUNT[words.view(np.uint8)].sum(axis=-1, dtype=np.int64)
+
+
+def and_counts(x, y):
+    # popcount(x[i] & y[j]) for every row i of x and row j of y, worked out a tile at a time.
+    counts = np.zeros((len(x), len(y)), dtype=np.int64)
+    words = max(1, x.shape[1])
+    columns = max(1, min(len(y), TILE_WORDS // words))
+    rows = max(1, TILE_WORDS // (words * columns))
+    for i in range(0, len(x), rows):
+        for j in range(0, len(y), columns):
+            both = x[i:i + rows, np.newaxis, :] & y[np.newaxis, j:j + columns, :]
+            counts[i:i + rows, j:j + columns] = popcount(both)
+    return counts
+
+
+class _WindowPlanes(object):
+    # The a, b and m rows of bits of one chromosome's SNPs (view), read from the .bed as the windows move along. Only
+    # SNPs from the start of the current window on are held. maf has the MAF of every SNP read so far.
+
+    def __init__(self, view, chunk_bytes=genobed.CHUNK_BYTES // 4):
+        self.view = view
+        self.n_snps = view.n_variants
+        self.maf = np.zeros(self.n_snps)
+        self.first = 0
+        self.planes = _bitplanes(np.zeros((0, view.n_samples), dtype=np.uint8))
+        self.chunk_size = max(1, chunk_bytes // max(1, view.n_samples))
+
+    def move(self, start, end):
+        # Hold SNPs start to end. The ones before start are only dropped once they are half of what is held, so they
+        # aren't copied around on every step.
+        loaded = self.first + len(self.planes[0])
+        new = []
+        for chunk_start in range(loaded, end, self.chunk_size):
+            chunk = _bitplanes(self.view.genotypes(chunk_start, min(chunk_start + self.chunk_size, end)))
+            a_count, b_count, m_count = [popcount(plane) for plane in chunk]
+            with np.errstate(invalid='ignore', divide='ignore'):
+                p = (a_count + b_count) / (2.0 * m_count)
+            self.maf[chunk_start:chunk_start + len(p)] = np.nan_to_num(np.minimum(p, 1 - p))
+            new.append(chunk)
+        drop = start - self.first if 2 * (start - self.first) >= max(1, end - self.first) else 0
+        if new or drop:
+            self.planes = [np.vstack([plane[drop:]] + [chunk[k] for chunk in new])
+                           for k, plane in enumerate(self.planes)]
+            self.first += drop
+
+    def take(self, rows):
+        # The a, b and m rows of SNPs rows (which have to be held).
+        return [plane[np.asarray(rows) - self.first] for plane in self.planes]
+
+
+def _correlation(planes, rows, columns):
+    # r between SNPs rows and SNPs columns (SNP numbers in planes, a _WindowPlanes), as a (rows x columns) array. SNPs
+    # with no variance among the people typed for both get r = 0.
+    if len(rows) > 1 and len(rows) * len(columns) > MAX_PAIRS:
+        block = max(1, MAX_PAIRS // max(1, len(columns)))
+        return np.vstack([_correlation(planes, rows[i:i + block], columns) for i in range(0, len(rows), block)])
+    # All nine popcounts in one go: stack the a, b and m rows of each side, and cut the result back up into blocks.
+    counts = and_counts(np.vstack(planes.take(rows)), np.vstack(planes.take(columns)))
+    (a_a, a_b, a_xm), (b_a, b_b, b_xm), (a_ym, b_ym, n) = [np.split(block, 3, axis=1)
+                                                          for block in np.split(counts, 3, axis=0)]
+    n = n.astype(np.float64)
+    s_xy = a_a + a_b + b_a + b_b
+    s_x = a_xm + b_xm
+    s_y = a_ym + b_ym
+    variance = (n * (a_xm + 3 * b_xm) - s_x ** 2) * (n * (a_ym + 3 * b_ym) - s_y ** 2)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(variance > 0, (n * s_xy - s_x * s_y) / np.sqrt(variance), 0)
+
+
+def _prune_pairwise(planes, window, step, threshold):
+    # Kept SNPs (boolean mask) for pairwise pruning of one chromosome.
+    n_snps = planes.n_snps
+    kept = np.ones(n_snps, dtype=bool)
+    # r^2 is never over 1.
+    if threshold >= 1:
+        return kept
+    # A pair of SNPs that are both still in has already passed, so each window only needs the pairs where the second
+    # SNP is one that wasn't in the last window. checked is the first of those.
+    checked = 0
+    for start in range(0, n_snps, step):
+        end = min(start + window, n_snps)
+        planes.move(start, end)
+        maf = planes.maf
+        if end > checked:
+            candidates = start + np.flatnonzero(kept[start:end])
+            new = np.arange(checked, end)
+            # Pairs over the threshold, in the order plink goes through them (by the first SNP, then the second).
+            firsts, seconds = [], []
+            block = max(1, MAX_PAIRS // len(candidates))
+            for k in range(0, len(new), block):
+                r2 = _correlation(planes, candidates, new[k:k + block]) ** 2
+                before = candidates[:, np.newaxis] < new[np.newaxis, k:k + block]
+                first, second = np.nonzero((r2 > threshold) & before)
+                firsts.append(candidates[first])
+                seconds.append(new[k + second])
+            firsts, seconds = np.concatenate(firsts), np.concatenate(seconds)
+            order = np.lexsort((seconds, firsts))
+            for i, j in zip(firsts[order], seconds[order]):
+                if kept[i] and kept[j]:
+                    if maf[i] < maf[j]:
+                        kept[i] = False
+                    else:
+                        kept[j] = False
+            checked = end
+        if end == n_snps:
+            break
+    return kept
+
+
+def _prune_vif(planes, window, step, threshold):
+    # Kept SNPs (boolean mask) for VIF pruning of one chromosome. r for the SNPs in a window is carried over to the
+    # next one, so each pair is only worked out once.
+    n_snps = planes.n_snps
+    kept = np.ones(n_snps, dtype=bool)
+    r = np.zeros((0, 0))
+    previous = 0
+    for start in range(0, n_snps, step):
+        end = min(start + window, n_snps)
+        size = end - start
+        planes.move(start, end)
+        carried = max(0, min(r.shape[0], previous + r.shape[0] - start))
+        window_r = np.zeros((size, size))
+        window_r[:carried, :carried] = r[r.shape[0] - carried:, r.shape[0] - carried:]
+        live = np.flatnonzero(kept[start:end])
+        new = live[live >= carried]
+        if len(new):
+            block = _correlation(planes, start + new, start + live)
+            window_r[np.ix_(new, live)] = block
+            window_r[np.ix_(live, new)] = block.T
+        r, previous = window_r, start
+
+        live_r = window_r[np.ix_(live, live)]
+        np.fill_diagonal(live_r, 1)
+        while len(live) > 1:
+            vif = np.diag(np.linalg.pinv(live_r))
+            worst = np.argmax(vif)
+            if vif[worst] <= threshold:
+                break
+            kept[start + live[worst]] = False
+            others = np.arange(len(live)) != worst
+            live = live[others]
+            live_r = live_r[np.ix_(others, others)]
+        if end == n_snps:
+            break
+    return kept
+
+
+def prune(geno, method, window, step, threshold, chromosomes=None, cache_path=cache_path):
+    # LD prune geno (a fileset name or genobed.PlinkDataset). Returns a boolean mask of the SNPs that are kept (plink's
+    # prune.in). Only the chromosomes listed (plink codes, X = 23) are pruned if chromosomes is given; SNPs on the
+    # others are all kept.
+    if method not in METHODS:
+        raise ValueError('Unknown LD pruning method ' + str(method) + ', use one of ' + ', '.join(METHODS))
+    geno = genobed.dataset(geno)
+    settings = [method, int(window), int(step), float(threshold),
+                None if chromosomes is None else sorted(int(x) for x in chromosomes)]
+    cache_file = os.path.join(cache_path, geno.key() + '_' + '_'.join(str(x) for x in settings[:4]) + '_'
+                              + ('all' if chromosomes is None else '-'.join(str(x) for x in settings[4])) + '.npy')
+    if os.path.exists(cache_file):
+        return np.load(cache_file)
+
+    kept = np.ones(geno.n_variants, dtype=bool)
+    for chromosome in np.unique(geno.chromosomes):
+        if chromosomes is not None and chromosome not in settings[4]:
+            continue
+        on_chromosome = np.flatnonzero(geno.chromosomes == chromosome)
+        planes = _WindowPlanes(geno.subset(variants=on_chromosome))
+        if method == 'vif':
+            kept[on_chromosome] = _prune_vif(planes, window, step, threshold)
+        else:
+            kept[on_chromosome] = _prune_pairwise(planes, window, step, threshold)
+
+    # Write to a temporary name first, so a prune that gets interrupted is never picked up as finished.
+    if not os.path.exists(cache_path):
+        os.makedirs(cache_path)
+    with open(cache_file + '.tmp', 'wb') as f:
+        np.save(f, kept)
+    os.replace(cache_file + '.tmp', cache_file)
+    return kept
+
+
+def write_prune(geno, out, method, window, step, threshold, chromosomes=None):
+    # Same as prune, and also write out.prune.in and out.prune.out (one SNP ID per line) the way plink does, for
+    # --extract/--exclude. Returns the kept SNP mask.
+    geno = genobed.dataset(geno)
+    kept = prune(geno, method, window, step, threshold, chromosomes)
+    snps = geno.snps
+    with open(out + '.prune.in', 'w') as f:
+        f.writelines(snp + '\n' for snp in snps[kept])
+    with open(out + '.prune.out', 'w') as f:
+        f.writelines(snp + '\n' for snp in snps[~kept])
+    return kept
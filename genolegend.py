@@ -0,0 +1,261 @@
+import os
+import json
+import time
+import hashlib
+from os.path import expanduser
+
+try:
+    import argparse
+except (ImportError, ModuleNotFoundError):
+    import genodownload
+    genodownload.getargparse()
+    import argparse
+
+try:
+    import pandas as pd
+except (ImportError, ModuleNotFoundError):
+    import genodownload
+    genodownload.getpandas()
+    import pandas as pd
+
+try:
+    import numpy as np
+except (ImportError, ModuleNotFoundError):
+    import genodownload
+    genodownload.getnumpy()
+    import numpy as np
+
+import genoafcheck
+
+# Pre-parsed copy of the 1000G Phase 3 legend files. Reading a legend.gz with pandas means decompressing and parsing
+# millions of rows of text every time we harmonize. Instead, each legend is converted once into a folder of numpy
+# arrays (one file per column) that can be memory-mapped:
+#   position.npy  - uint32 position
+#   a0.npy, a1.npy - int8 allele codes (see genoafcheck.ALLELE_CODES)
+#   afs.npy       - float64 allele frequencies, one column per superpopulation (genoafcheck.POPULATIONS order). These
+#                   stay float64 so the AF check's > threshold comparisons come out the same as on the parsed text.
+#   all.npy       - float64 allele frequency in ALL
+#   id.npy        - fixed width variant ids
+#   ambiguous.npy - True for A/T and G/C SNPs with MAF > 40% in every superpopulation (the ones harmonization drops)
+#   order.npy     - row numbers that put the non-ambiguous rows in position order (the position index used by join)
+#   meta.json     - size/time of the legend.gz it was built from, so the cache knows when it is out of date.
+# Only biallelic SNPs are kept, since those are the only rows the allele frequency check ever uses.
+# The cache goes in a legend_cache folder next to the legend files, or under ~/software/cache/legend_cache if the
+# legend folder can't be written to (e.g. a shared copy of the reference files).
+
+# Bump this if the layout of the cache changes, so old caches get rebuilt.
+CACHE_VERSION = 3
+
+# Roughly how many bytes of legend.gz each row takes (chr1 is about 20). On the low side, so estimates from the file
+# size come out high rather than low.
+LEGEND_BYTES_PER_ROW = 16
+
+home = expanduser("~")
+
+legend_file_names = ['1000GP_Phase3_chr%d.legend.gz' % x for x in range(1, 23)]
+legend_file_names.extend(['1000GP_Phase3_chrX_NONPAR.legend.gz'])
+
+
+def default_cache_path(legend_path):
+    # legend_cache next to the legend files if it can be written there, otherwise a folder for this legend_path in
+    # ~/software/cache/legend_cache.
+    next_to = os.path.join(legend_path, 'legend_cache')
+    if os.access(next_to if os.path.exists(next_to) else legend_path, os.W_OK):
+        return next_to
+    return os.path.join(home, 'software', 'cache', 'legend_cache',
+                        hashlib.sha1(os.path.abspath(legend_path).encode()).hexdigest()[:16])
+
+
+def cache_dir(legend_path, i, cache_path=None):
+    # Folder the cache for chromosome i (0 = chr1, 22 = chrX) lives in. By default, see default_cache_path.
+    if cache_path is None:
+        cache_path = default_cache_path(legend_path)
+    return os.path.join(cache_path, 'chr%d' % (i + 1))
+
+
+def _source_stamp(legend_file):
+    # Size and modification time of the legend.gz, used to tell if the cache is stale.
+    stat = os.stat(legend_file)
+    return {'version': CACHE_VERSION, 'source': os.path.basename(legend_file), 'size': stat.st_size,
+            'mtime': int(stat.st_mtime)}
+
+
+def is_current(legend_path, i, cache_path=None):
+    # True if the cache for chromosome i exists and was built from the legend file that is there now.
+    meta_file = os.path.join(cache_dir(legend_path, i, cache_path), 'meta.json')
+    if not os.path.exists(meta_file):
+        return False
+    with open(meta_file, 'r') as f:
+        meta = json.load(f)
+    stamp = _source_stamp(os.path.join(legend_path, legend_file_names[i]))
+    return all(meta.get(key) == value for key, value in stamp.items())
+
+
+def build_chr(legend_path, i, cache_path=None):
+    # Convert one legend.gz into the cache. This is the only place the legend text is ever parsed.
+    legend_file = os.path.join(legend_path, legend_file_names[i])
+    out_dir = cache_dir(legend_path, i, cache_path)
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+
+    legend = pd.read_csv(legend_file, compression="gzip", sep=" ", header=0,
+                         dtype={'id': str, 'position': int, 'a0': str, 'a1': str, 'TYPE': str, 'AFR': float,
+                                'AMR': float, 'EAS': float, 'EUR': float, 'SAS': float, 'ALL': float})
+    n_total = len(legend)
+    legend = legend[legend['TYPE'] == 'Biallelic_SNP']
+
+    a0 = genoafcheck.encode_alleles(legend['a0'])
+    a1 = genoafcheck.encode_alleles(legend['a1'])
+    afs = legend[genoafcheck.POPULATIONS].values
+
+    # A/T or G/C SNPs (A=1, C=2, G=3, T=4, so the complementary pairs add up to 5) where the MAF is > 40% in every
+    # superpopulation. These can't be strand checked so harmonization removes them.
+    mafs = np.where(afs < 0.5, afs, 1 - afs)
+    ambiguous = ((a0 + a1) == 5) & (a0 > 0) & (a1 > 0) & np.all(mafs > 0.4, axis=1)
+
+    np.save(os.path.join(out_dir, 'position.npy'), legend['position'].values.astype(np.uint32))
+    np.save(os.path.join(out_dir, 'a0.npy'), a0)
+    np.save(os.path.join(out_dir, 'a1.npy'), a1)
+    np.save(os.path.join(out_dir, 'afs.npy'), afs.astype(np.float64))
+    np.save(os.path.join(out_dir, 'all.npy'), legend['ALL'].values.astype(np.float64))
+    np.save(os.path.join(out_dir, 'id.npy'), legend['id'].values.astype(np.bytes_))
+    np.save(os.path.join(out_dir, 'ambiguous.npy'), ambiguous)
+    # Sorted position index over the rows harmonization uses. The legend files are already in position order, but I
+    # don't rely on that. A stable sort keeps rows that share a position in the same order they are in the legend.
+    usable = np.flatnonzero(~ambiguous).astype(np.uint32)
+    order = usable[np.argsort(legend['position'].values[usable], kind='mergesort')]
+    np.save(os.path.join(out_dir, 'order.npy'), order)
+
+    # Write the meta file last, so a half-written cache is never mistaken for a finished one.
+    meta = _source_stamp(legend_file)
+    meta['n_snps'] = int(len(legend))
+    meta['n_total'] = int(n_total)
+    with open(os.path.join(out_dir, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+
+    print('Built legend cache for chr' + str(i + 1))
+
+
+def build(legend_path, cache_path=None, force=False):
+    # One time step: build (or rebuild, if the legend files changed) the cache for every chromosome.
+    for i in range(0, len(legend_file_names)):
+        if not os.path.exists(os.path.join(legend_path, legend_file_names[i])):
+            print('No ' + legend_file_names[i] + ' in ' + legend_path + ', skipping it')
+            continue
+        if force or not is_current(legend_path, i, cache_path):
+            build_chr(legend_path, i, cache_path)
+
+
+def load(legend_path, i, cache_path=None):
+    # Memory-map the cache for chromosome i, building it first if needed. Returns a dict of arrays.
+    if not is_current(legend_path, i, cache_path):
+        build_chr(legend_path, i, cache_path)
+    in_dir = cache_dir(legend_path, i, cache_path)
+    legend = {}
+    for column in ('position', 'a0', 'a1', 'afs', 'all', 'id', 'ambiguous', 'order'):
+        legend[column] = np.load(os.path.join(in_dir, column + '.npy'), mmap_mode='r')
+    with open(os.path.join(in_dir, 'meta.json'), 'r') as f:
+        legend['meta'] = json.load(f)
+    return legend
+
+
+def legend_frame(legend_path, i, cache_path=None):
+    # The legend for chromosome i the way harmonization wants it: biallelic SNPs only, ambiguous A/T G/C SNPs removed,
+    # and the columns named the same as they always have been.
+    legend = load(legend_path, i, cache_path)
+    keep = ~np.asarray(legend['ambiguous'])
+    frame = pd.DataFrame({'reference_id': legend['id'][keep].astype(str),
+                          'position': legend['position'][keep].astype(np.int64),
+                          'reference_a0': genoafcheck.decode_alleles(legend['a0'][keep]),
+                          'reference_a1': genoafcheck.decode_alleles(legend['a1'][keep]),
+                          'TYPE': 'Biallelic_SNP'})
+    afs = legend['afs'][keep]
+    for j in range(0, len(genoafcheck.POPULATIONS)):
+        frame[genoafcheck.POPULATIONS[j]] = afs[:, j]
+    frame['ALL'] = legend['all'][keep]
+    return frame
+
+
+def join(left, legend_path, i, cache_path=None):
+    # Same result as pd.merge(left=left, right=legend_frame(legend_path, i), how='inner', on='position'), but instead
+    # of building the whole legend as a DataFrame and hashing it, each position in left (the small side) is looked up
+    # in the sorted position index with a binary search, and only the legend rows that matched are pulled out of the
+    # cache.
+    legend = load(legend_path, i, cache_path)
+    order = np.asarray(legend['order'])
+    sorted_positions = np.asarray(legend['position'])[order]
+
+    # Every legend row at a position is a match, so the range [start, end) in the index is all of them.
+    positions = left['position'].values
+    start = np.searchsorted(sorted_positions, positions, side='left')
+    end = np.searchsorted(sorted_positions, positions, side='right')
+    counts = end - start
+
+    # Positions can be in the legend more than once (e.g. a multi-allelic site written as several biallelic SNPs). Like
+    # the merge, a SNP gets one row per legend record at its position, here by repeating the left row once per match
+    # and stepping through its range in the index. Those SNPs then show up as duplicates and are dropped by the
+    # drop_duplicates on SNP afterwards, the same as before.
+    left_rows = np.repeat(np.arange(len(positions)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    legend_rows = order[np.repeat(start, counts) + offsets]
+
+    merged = left.iloc[left_rows].reset_index(drop=True)
+    merged['reference_id'] = legend['id'][legend_rows].astype(str)
+    merged['reference_a0'] = genoafcheck.decode_alleles(legend['a0'][legend_rows])
+    merged['reference_a1'] = genoafcheck.decode_alleles(legend['a1'][legend_rows])
+    merged['TYPE'] = 'Biallelic_SNP'
+    afs = legend['afs'][legend_rows]
+    for j in range(0, len(genoafcheck.POPULATIONS)):
+        merged[genoafcheck.POPULATIONS[j]] = afs[:, j]
+    merged['ALL'] = legend['all'][legend_rows]
+    return merged
+
+
+def benchmark(legend_path, i=0, n_snps=500000, cache_path=None):
+    # Time join against the pd.merge it replaced, for a made up array of n_snps SNPs on chromosome i (0 = chr1). Most
+    # of the positions are picked from the legend, and some are ones the legend doesn't have.
+    legend = load(legend_path, i, cache_path)
+    positions = np.asarray(legend['position'])
+    rng = np.random.RandomState(1)
+    picked = np.sort(np.concatenate([rng.choice(positions, size=int(n_snps * 0.9), replace=False),
+                                     rng.randint(1, positions.max(), size=n_snps - int(n_snps * 0.9))]))
+    left = pd.DataFrame({'SNP': ['snp' + str(x) for x in range(0, len(picked))], 'position': picked.astype(np.int64)})
+
+    start = time.time()
+    merged = pd.merge(left=left, right=legend_frame(legend_path, i, cache_path), how='inner', on='position')
+    merge_time = time.time() - start
+
+    start = time.time()
+    joined = join(left, legend_path, i, cache_path)
+    join_time = time.time() - start
+
+    same = merged.reset_index(drop=True).equals(joined[merged.columns])
+    print('chr' + str(i + 1) + ': ' + str(len(positions)) + ' legend SNPs, ' + str(len(left)) + ' study SNPs, '
+          + str(len(joined)) + ' matches')
+    print('pd.merge: ' + '%.2f' % merge_time + 's, join: ' + '%.2f' % join_time + 's, same result: ' + str(same))
+
+
+def variant_count(legend_path, i, cache_path=None):
+    # Number of variants (of every type) in the legend for chromosome i, without reading the legend itself. This comes
+    # from the cache if it's built, and is otherwise estimated from the size of the legend.gz (see
+    # LEGEND_BYTES_PER_ROW), so sizing jobs with it never builds the cache.
+    if is_current(legend_path, i, cache_path):
+        with open(os.path.join(cache_dir(legend_path, i, cache_path), 'meta.json'), 'r') as f:
+            return json.load(f)['n_total']
+    return os.path.getsize(os.path.join(legend_path, legend_file_names[i])) // LEGEND_BYTES_PER_ROW
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("legend_path", help="Path to 1000G hg19 legend files")
+    parser.add_argument("--cache-path", default=None, help="Where to put the cache (default: legend_cache folder in "
+                                                           "legend_path, or in ~/software/cache if it's read-only)")
+    parser.add_argument("--force", action='store_true', help="Rebuild even if the cache is up to date")
+    parser.add_argument("--benchmark", action='store_true', help="Time the position index join against pd.merge on "
+                                                                 "chr1 after building")
+    args = parser.parse_args()
+
+    build(args.legend_path, args.cache_path, args.force)
+    print("Finished building the legend cache")
+    if args.benchmark:
+        benchmark(args.legend_path, 0, cache_path=args.cache_path)
@@ -1,5 +1,10 @@
 import platform
 import os
+import re
+import json
+import shutil
+import hashlib
+import threading
 from os.path import expanduser
 try:
     import colorama
@@ -31,8 +36,209 @@ else:
     import genodownload
     genodownload.plink()
 
+import genopool
 
-def merge1000g(harmonized_name, harmonized_path):
+try:
+    import pandas as pd
+except (ImportError, ModuleNotFoundError):
+    import genodownload
+    genodownload.getpandas()
+    import pandas as pd
+
+try:
+    import numpy as np
+except (ImportError, ModuleNotFoundError):
+    import genodownload
+    genodownload.getnumpy()
+    import numpy as np
+
+import genobed
+
+
+# Full (every SNP) plink filesets of the 1000G VCFs are kept here, so each VCF only ever has to be converted once.
+# Every VCF gets its own folder, named by a checksum of the VCF and the conversion options, so if the VCF or the
+# options change it just gets converted again into a new folder.
+reference_store = os.path.join(home, 'software', 'cache', '1000G_Phase3_bed')
+vcf_conversion = ['--double-id', '--biallelic-only', 'strict', '--vcf-require-gt']
+# Several VCFs can be checked at the same time, so only let one of them update checksums.json at a time.
+checksum_lock = threading.Lock()
+
+
+def vcf_checksum(vcf_file, store_path=reference_store):
+    # sha1 of a VCF. Reading a whole 1000G VCF takes a while, so the checksum is remembered in the store along with
+    # the size and modification time of the VCF, and only worked out again if one of those changes.
+    checksum_file = os.path.join(store_path, 'checksums.json')
+    checksums = {}
+    if os.path.exists(checksum_file):
+        with open(checksum_file, 'r') as f:
+            checksums = json.load(f)
+
+    key = os.path.abspath(vcf_file)
+    stat = os.stat(vcf_file)
+    known = checksums.get(key)
+    if known and known['size'] == stat.st_size and known['mtime'] == int(stat.st_mtime):
+        return known['sha1']
+
+    sha1 = hashlib.sha1()
+    with open(vcf_file, 'rb') as f:
+        for block in iter(lambda: f.read(16 * 1024 * 1024), b''):
+            sha1.update(block)
+
+    with checksum_lock:
+        # Read it again, in case another VCF was added while we were reading this one.
+        if os.path.exists(checksum_file):
+            with open(checksum_file, 'r') as f:
+                checksums = json.load(f)
+        checksums[key] = {'size': stat.st_size, 'mtime': int(stat.st_mtime), 'sha1': sha1.hexdigest()}
+        if not os.path.exists(store_path):
+            os.makedirs(store_path)
+        with open(checksum_file + '.tmp', 'w') as f:
+            json.dump(checksums, f, indent=1)
+        os.replace(checksum_file + '.tmp', checksum_file)
+    return sha1.hexdigest()
+
+
+def reference_bed(vcf_file, store_path=reference_store, limits=None):
+    # Plink fileset with every SNP in vcf_file, from the store. If it isn't there yet, the VCF is converted (once) and
+    # added. Returns the fileset name to use with --bfile. limits are extra plink options (see plink_limits).
+    import subprocess
+
+    key = hashlib.sha1((vcf_checksum(vcf_file, store_path) + ' ' + ' '.join(vcf_conversion)).encode()).hexdigest()
+    folder = os.path.join(store_path, key)
+    if not os.path.exists(folder):
+        print('Converting ' + os.path.basename(vcf_file) + ' to plink format. This only needs to happen once.')
+        # Build it somewhere else first and move it in when it's done, so a half converted VCF never looks finished.
+        building = folder + '.building'
+        if os.path.exists(building):
+            shutil.rmtree(building)
+        os.makedirs(building)
+        subprocess.check_output([plink, '--vcf', vcf_file] + vcf_conversion + (limits or [])
+                                + ['--make-bed', '--out', os.path.join(building, 'reference')])
+        with open(os.path.join(building, 'source.txt'), 'w') as f:
+            f.write(os.path.abspath(vcf_file) + '\n')
+        os.rename(building, folder)
+    return os.path.join(folder, 'reference')
+
+
+def plink_limits(workers, mem_mb):
+    # --threads and --memory for one of several plink runs going at the same time, so they share the machine instead
+    # of each one trying to use all of it. Nothing extra when plink is running by itself.
+    if workers <= 1:
+        return []
+    return ['--threads', str(max(1, genopool.cores() // workers)), '--memory', str(mem_mb)]
+
+
+def extract_reference(vcf_file, extract_file, out_name, limits):
+    # One chromosome of 1000G, with just the SNPs in extract_file.
+    import subprocess
+    subprocess.check_output([plink, '--bfile', reference_bed(vcf_file, limits=limits), '--extract', extract_file]
+                            + limits + ['--make-bed', '--out', out_name])
+
+
+def exclude_snps(geno_name, exclude_file, limits):
+    # Rebuild one fileset without the SNPs in exclude_file.
+    import subprocess
+    subprocess.check_output([plink, '--bfile', geno_name, '--exclude', exclude_file, '--geno', '0.01'] + limits
+                            + ['--make-bed', '--out', geno_name])
+
+
+def file_sizes(names, ext=''):
+    # Sizes of files (0 if missing), so genopool.run can start the biggest ones first.
+    return [os.path.getsize(name + ext) if os.path.exists(name + ext) else 0 for name in names]
+
+
+# Complementary bases, for flipping strands. Anything that isn't a single base can't be flipped.
+complement = {'A': 'T', 'C': 'G', 'G': 'C', 'T': 'A', '0': '0'}
+
+
+def _allele_count(alleles):
+    # Number of different alleles in each row of a (SNPs x n) array of allele strings, not counting '0' (missing).
+    count = np.zeros(alleles.shape[0], dtype=np.int64)
+    for k in range(0, alleles.shape[1]):
+        new = alleles[:, k] != '0'
+        for j in range(0, k):
+            new &= alleles[:, k] != alleles[:, j]
+        count += new
+    return count
+
+
+def reconcile(study_bim, reference_bim):
+    # Compare the house dataset's bim with the 1000G bim before merging, and work out ahead of time what plink --bmerge
+    # would complain about. Both are bim DataFrames like genobed.read_bim gives. Returns:
+    #   flips - SNPs whose alleles only match 1000G on the other strand, to be flipped in the house dataset
+    #   excludes - SNPs to take out of both: ones on a different chromosome/position in the two datasets, ones that
+    #       are in either dataset more than once, and ones with 3+ alleles between the two even after flipping.
+    study = study_bim[['CHR', 'SNP', 'position', 'A1', 'A2']].copy()
+    reference = reference_bim[['CHR', 'SNP', 'position', 'A1', 'A2']].copy()
+    duplicated = set(study.loc[study['SNP'].duplicated(), 'SNP']) | set(reference.loc[reference['SNP'].duplicated(),
+                                                                                      'SNP'])
+    study['CHR'] = genobed.chr_codes(study['CHR'])
+    reference['CHR'] = genobed.chr_codes(reference['CHR'])
+    both = pd.merge(left=study.drop_duplicates(subset=['SNP'], keep=False),
+                    right=reference.drop_duplicates(subset=['SNP'], keep=False), how='inner', on='SNP',
+                    suffixes=('_study', '_reference'))
+
+    # Same name but a different place (plink gives a warning for these).
+    moved = (both['CHR_study'].values != both['CHR_reference'].values) \
+        | (both['position_study'].values != both['position_reference'].values)
+
+    # Alleles. Fine if there are only 2 alleles between the two datasets, otherwise try the other strand.
+    study_alleles = np.column_stack([both['A1_study'].astype(str).values, both['A2_study'].astype(str).values])
+    reference_alleles = np.column_stack([both['A1_reference'].astype(str).values,
+                                         both['A2_reference'].astype(str).values])
+    flipped_alleles = np.column_stack([both['A1_study'].astype(str).map(complement).fillna('?').values,
+                                       both['A2_study'].astype(str).map(complement).fillna('?').values])
+    matches = _allele_count(np.column_stack([study_alleles, reference_alleles])) <= 2
+    flip_matches = (_allele_count(np.column_stack([flipped_alleles, reference_alleles])) <= 2) \
+        & np.all(flipped_alleles != '?', axis=1)
+
+    flips = both.loc[~moved & ~matches & flip_matches, 'SNP'].tolist()
+    excludes = both.loc[moved | (~matches & ~flip_matches), 'SNP'].tolist()
+    excludes = list(dict.fromkeys(excludes + sorted(duplicated)))
+    return flips, excludes
+
+
+# A plink merge warning names the SNP it's about in quotes in its 7th word, for example
+# "Warning: Multiple positions seen for variant 'rs123'." These are the SNPs we take out before merging again.
+merge_warning = re.compile(r"^Warning:(?: [^ ]*){5} [^ ']*'([^ ']+)")
+
+
+def merge_problems(out_name):
+    # Go through the log of a plink merge (--out out_name) line by line, and read its -merge.missnp file if there is
+    # one. Returns the SNPs that threw warnings, the SNPs in the missnp file (each without repeats, in the order they
+    # first show up), and how many warning lines there were in total.
+    warnings = []
+    seen = set()
+    warning_lines = 0
+    with open(out_name + '.log', 'r') as f:
+        for line in f:
+            if not line.startswith('Warning:'):
+                continue
+            warning_lines += 1
+            match = merge_warning.match(line.strip())
+            if match and match.group(1) not in seen:
+                seen.add(match.group(1))
+                warnings.append(match.group(1))
+
+    missnp = []
+    if os.path.exists(out_name + '-merge.missnp'):
+        with open(out_name + '-merge.missnp', 'r') as f:
+            missnp = list(dict.fromkeys(line.strip() for line in f if line.strip()))
+
+    return warnings, missnp, warning_lines
+
+
+def write_snp_list(snps, file_name):
+    # One SNP per line, for plink's --exclude/--extract/--flip.
+    with open(file_name, 'w') as f:
+        for snp in snps:
+            f.write(snp + '\n')
+
+
+@genobed.takes_bfile
+def merge1000g(harmonized_name, harmonized_path, workers=None):
+    # workers is how many chromosomes of 1000G to work on at the same time (converting, pulling out the house SNPs, and
+    # rebuilding them after merge warnings). By default it's worked out from the cores and memory available.
     import os
     import sys
     import subprocess
@@ -117,11 +323,20 @@ def merge1000g(harmonized_name, harmonized_path):
         # Change to directory where we're going to merge the files.
         os.chdir('Merged_With_1000G')
 
-        # Convert vcf files to plink format.
-        for i in range(0, len(ref_file_names)):
-            subprocess.check_output([plink, '--vcf', os.path.join(vcf_path, ref_file_names[i]), '--double-id',
-                                     '--biallelic-only', 'strict', '--vcf-require-gt', '--extract',
-                                     'SNPs_Kept_List.txt', '--make-bed', '--out', chr_1000g_phase3_names[i]])
+        # Each chromosome's plink run gets its share of the cores and memory.
+        if workers is None:
+            workers = genopool.worker_count(mem_per_worker_mb=2048, max_workers=len(ref_file_names))
+        workers = max(1, min(int(workers), len(ref_file_names)))
+        free_mem = genopool.available_memory_mb()
+        limits = plink_limits(workers, max(1024, (free_mem or 2048 * workers) // workers))
+        ref_file_paths = [os.path.join(vcf_path, x) for x in ref_file_names]
+
+        # Get the 1000G SNPs that are in the house dataset. Each VCF is only converted to plink format once, and kept in
+        # the reference store, so all we do here is pull the SNPs we need out of the full fileset. Several chromosomes
+        # run at the same time, biggest VCF first. The merge list below is still written in chromosome order.
+        genopool.run(extract_reference, [(ref_file_paths[i], 'SNPs_Kept_List.txt', chr_1000g_phase3_names[i], limits)
+                                         for i in range(0, len(ref_file_names))],
+                     workers=workers, sizes=file_sizes(ref_file_paths))
         subprocess.call(rm + '*~', shell=True)
 
         # Create list of files to be merged into one large file.
@@ -129,74 +344,69 @@ def merge1000g(harmonized_name, harmonized_path):
             wr = csv.writer(f, delimiter="\n")
             wr.writerow(chr_1000g_phase3_names)
 
+        # Compare the house dataset with these 1000G SNPs before merging anything. Finding the SNPs that would need to
+        # be flipped or removed now means the house dataset and 1000G merge in one go, instead of merging, reading the
+        # errors, rewriting both datasets and merging again (up to three times).
+        flips, excludes = reconcile(genobed.read_bim(os.path.join(orig_wd, harmonized_name)),
+                                    pd.concat([genobed.read_bim(x) for x in chr_1000g_phase3_names], ignore_index=True))
+        write_snp_list(flips, harmonized_name + '_1000G_flip.txt')
+        write_snp_list(excludes, harmonized_name + '_1000G_exclude.txt')
+        print(str(len(flips)) + ' SNPs will be flipped and ' + str(len(excludes)) + ' SNPs removed so the house '
+              'dataset merges with 1000G.')
+        # The SNPs to remove are taken out of 1000G while its chromosomes are merged, so it's only written once.
+        reference_exclude = ['--exclude', harmonized_name + '_1000G_exclude.txt'] if excludes else []
+
         # Use plink to merge those files into one large file.
-        subprocess.check_output([plink, '--merge-list', '1000GMergeList.txt', '--geno', '0.01', '--make-bed', '--out',
-                                 '1000G_Phase3'])
+        subprocess.check_output([plink, '--merge-list', '1000GMergeList.txt', '--geno', '0.01'] + reference_exclude
+                                + ['--make-bed', '--out', '1000G_Phase3'])
 
-        # Read in log file from merge.
-        logfile = pd.DataFrame()
-        # Format the log file into a pandas dataframe.
-        with open('1000G_Phase3.log', 'r') as f:
-            for line in f:
-                logfile = pd.concat([logfile, pd.DataFrame([tuple(line.strip().split(" "))])], ignore_index=True)
+        # Read the log file (and missnp file) from the merge.
+        rsid_warnings, missnp, warning_lines = merge_problems('1000G_Phase3')
 
         # If the logfile contains warnings, write a text file '1000G_MergeWarnings.txt' with the SNPs that threw
         # warnings.
-        rsid_warnings = []
-        if logfile[0].str.contains('Warning:').any():
-            rsid_warnings = logfile.loc[logfile[0] == 'Warning:', 6].str.split("'", expand=True)
-            rsid_warnings[1].dropna(how='any').to_csv('1000G_MergeWarnings.txt', sep='\t', header=False, index=False)
+        if rsid_warnings:
+            write_snp_list(rsid_warnings, '1000G_MergeWarnings.txt')
 
         # If the text file 1000G_MergeWarnings exists...
         if os.path.exists('1000G_MergeWarnings.txt'):
             # If merge warnings and missnps exist, exclude both from 1000G completely (there are plenty of other snps)
             if os.path.exists('1000G_Phase3-merge.missnp'):
-                # Read in missnp file
-                missnp = pd.read_csv('1000G_Phase3-merge.missnp', sep='\t', header=None)
-                # Merge the warning snps with the missnps
-                warnings_missnp = pd.concat([rsid_warnings, missnp], axis=0)
-                # Drop duplicates and write to a file to be used in plink.
-                warnings_missnp[1].dropna(how='any').to_csv('1000G_warnings_missnp.txt', sep='\t',
-                                                            header=False, index=False)
+                # Merge the warning snps with the missnps, drop duplicates and write to a file to be used in plink.
+                write_snp_list(list(dict.fromkeys(rsid_warnings + missnp)), '1000G_warnings_missnp.txt')
                 # Remove these snps from plink files and create new plink files.
-                for i in range(0, len(chr_1000g_phase3_names)):
-                    subprocess.check_output([plink, '--bfile', chr_1000g_phase3_names[i], '--exclude',
-                                             '1000G_warnings_missnp.txt', '--geno', '0.01', '--make-bed', '--out',
-                                             chr_1000g_phase3_names[i]])
+                genopool.run(exclude_snps, [(x, '1000G_warnings_missnp.txt', limits) for x in chr_1000g_phase3_names],
+                             workers=workers, sizes=file_sizes(chr_1000g_phase3_names, '.bed'))
                 # Remove old plink files.
                 subprocess.call(rm + '*~', shell=True)
                 # Retry the merge
-                subprocess.check_output([plink, '--merge-list', '1000GMergeList.txt', '--geno', '0.01', '--make-bed',
-                                         '--out', '1000G_Phase3'])
+                subprocess.check_output([plink, '--merge-list', '1000GMergeList.txt', '--geno', '0.01']
+                                         + reference_exclude + ['--make-bed', '--out', '1000G_Phase3'])
                 # The merge should be successful this time, but the user should double check.
                 print("Successfully merged 1000G, though you should double-check the log file to be sure.")
 
             else:  # If only merge warnings exist, exclude from 1000G completely
                 # Use plink to exclude the merge warning snps.
-                for i in range(0, len(chr_1000g_phase3_names)):
-                    subprocess.check_output([plink, '--bfile', chr_1000g_phase3_names[i], '--exclude',
-                                             '1000G_MergeWarnings.txt', '--geno', '0.01', '--make-bed', '--out',
-                                             chr_1000g_phase3_names[i]])
+                genopool.run(exclude_snps, [(x, '1000G_MergeWarnings.txt', limits) for x in chr_1000g_phase3_names],
+                             workers=workers, sizes=file_sizes(chr_1000g_phase3_names, '.bed'))
                 # Remove old plink files.
                 subprocess.call(rm + '*~', shell=True)
                 # Try merge again.
-                subprocess.check_output([plink, '--merge-list', '1000GMergeList.txt', '--geno', '0.01', '--make-bed',
-                                         '--out', '1000G_Phase3'])
+                subprocess.check_output([plink, '--merge-list', '1000GMergeList.txt', '--geno', '0.01']
+                                         + reference_exclude + ['--make-bed', '--out', '1000G_Phase3'])
                 # Merge should be successful this time, but the user should double check.
                 print("Successfully merged 1000G, though you should double-check the log file to be sure.")
 
         # If only the missnps exist, remove them in 1000G.
-        elif os.path.exists('1000G_Phase3-merge.missnp') and os.path.getsize('1000G_MergeWarnings.txt') == 0:
+        elif os.path.exists('1000G_Phase3-merge.missnp'):
             # Use plink to remove the missnps
-            for i in range(0, len(chr_1000g_phase3_names)):
-                subprocess.check_output([plink, '--bfile', chr_1000g_phase3_names[i], '--exclude',
-                                         '1000G_Phase3-merge.missnp', '--geno', '0.01', '--make-bed', '--out',
-                                         chr_1000g_phase3_names[i]])
+            genopool.run(exclude_snps, [(x, '1000G_Phase3-merge.missnp', limits) for x in chr_1000g_phase3_names],
+                         workers=workers, sizes=file_sizes(chr_1000g_phase3_names, '.bed'))
             # Remove old plink files
             subprocess.call(rm + '*~', shell=True)
             # Retry the merge
-            subprocess.check_output([plink, '--merge-list', '1000GMergeList.txt', '--geno', '0.01', '--make-bed',
-                                     '--out', '1000G_Phase3'])
+            subprocess.check_output([plink, '--merge-list', '1000GMergeList.txt', '--geno', '0.01']
+                                     + reference_exclude + ['--make-bed', '--out', '1000G_Phase3'])
             # Merge should be successful this time, but the user should double check.
             print("Successfully merged 1000G, though you should double check the log file to be sure.")
 
@@ -217,24 +427,29 @@ def merge1000g(harmonized_name, harmonized_path):
         shutil.copy2(os.path.join(orig_wd, harmonized_name + '.bim'), os.getcwd())
         shutil.copy2(os.path.join(orig_wd, harmonized_name + '.fam'), os.getcwd())
 
+        # Flip and remove the SNPs the comparison with 1000G found, so the merge should work the first time. If plink
+        # still finds problems, the rounds below take care of them like before.
+        if flips or excludes:
+            fixes = []
+            if flips:
+                fixes.extend(['--flip', harmonized_name + '_1000G_flip.txt'])
+            if excludes:
+                fixes.extend(['--exclude', harmonized_name + '_1000G_exclude.txt'])
+            subprocess.check_output([plink, '--bfile', harmonized_name] + fixes + ['--make-bed', '--out',
+                                                                                  harmonized_name])
+            subprocess.call(rm + '*~', shell=True)
+
         # Perform initial merge
         subprocess.check_output([plink, '--bfile', harmonized_name, '--bmerge', '1000G_Phase3', '--geno', '0.01',
                                  '--make-bed', '--out', harmonized_name + '_1000G'])
 
-        # Read in log file to see if anything went wrong
-        logfile = pd.DataFrame()
-        # Concatenate log file to pandas dataframe.
-        with open(harmonized_name + '_1000G.log', 'r') as f:
-            for line in f:
-                logfile = pd.concat([logfile, pd.DataFrame([tuple(line.strip().split(" "))])], ignore_index=True)
+        # Read in log file to see if anything went wrong, and identify the snps that made warnings.
+        rsid_warnings, missnp, warning_lines = merge_problems(harmonized_name + '_1000G')
 
         # Check to see if the logfile has warnings
-        if logfile[0].str.contains('Warning:').any():
-            # Identify the snps that made the warning.
-            rsid_warnings = logfile.loc[logfile[0] == 'Warning:', 6].str.split("'", expand=True)
+        if rsid_warnings:
             # Put those SNPs in a file so we can remove them.
-            rsid_warnings[1].dropna(how='any').to_csv(harmonized_name + '_1000G_MergeWarnings.txt', sep='\t',
-                                                      header=False, index=False)
+            write_snp_list(rsid_warnings, harmonized_name + '_1000G_MergeWarnings.txt')
         # If there are merge warnings
         if os.path.exists(harmonized_name + '_1000G_MergeWarnings.txt'):
             # and if there are triallelic snps that need to be flipped (missnp)
@@ -302,32 +517,20 @@ def merge1000g(harmonized_name, harmonized_path):
 
         # If we had to perform a second merge because of one of the reasons above.
         if os.path.exists(harmonized_name + '_1000G_merge2.log'):
-            # Read in log file
-            logfile = pd.DataFrame()
-            # Convert log file to pandas dataframe
-            with open(harmonized_name + '_1000G_merge2.log', 'r') as f:
-                for line in f:
-                    logfile = pd.concat([logfile, pd.DataFrame([tuple(line.strip().split(" "))])], ignore_index=True)
+            # Read in log file, and figure out what snps caused warnings.
+            rsid_warnings, missnp, warning_lines = merge_problems(harmonized_name + '_1000G_merge2')
 
             # Check to see if the logfile has warnings
-            if logfile[0].str.contains('Warning:').any():
-                # Figure out what snps caused the warnings.
-                rsid_warnings = logfile.loc[logfile[0] == 'Warning:', 6].str.split("'", expand=True)
+            if rsid_warnings:
                 # Write these warnings to a text file for plink to use.
-                rsid_warnings[1].dropna(how='any').to_csv(harmonized_name + '_1000G_merge2_warnings.txt', sep='\t',
-                                                          header=False,
-                                                          index=False)
+                write_snp_list(rsid_warnings, harmonized_name + '_1000G_merge2_warnings.txt')
             # If warnings exist
             if os.path.exists(harmonized_name + '_1000G_merge2_warnings.txt'):
                 # And if there are still triallelic snps
                 if os.path.exists(harmonized_name + '_1000G_merge2-merge.missnp'):
-                    # Import missnp file to pandas
-                    missnp = pd.read_csv(harmonized_name + '_1000G_merge2-merge.missnp', sep='\t', header=None)
-                    # Merge this with merge warnings snps
-                    warnings_missnp = pd.concat([rsid_warnings, missnp], axis=0)
-                    # Write to text file for plink to use.
-                    warnings_missnp[1].dropna(how='any').to_csv(harmonized_name + '_1000G_merge2_warnings_missnp.txt',
-                                                                sep='\t', header=False, index=False)
+                    # Merge the missnps with merge warnings snps, and write to text file for plink to use.
+                    write_snp_list(list(dict.fromkeys(rsid_warnings + missnp)),
+                                   harmonized_name + '_1000G_merge2_warnings_missnp.txt')
                     # Remove all of these snps from 1000G dataset.
                     subprocess.check_output([plink, '--bfile', '1000G_Phase3', '--exclude',
                                              harmonized_name + '_1000G_merge2_warnings_missnp.txt', '--geno', '0.01',
@@ -393,17 +596,14 @@ def merge1000g(harmonized_name, harmonized_path):
                          "I'm sorry!")
 
         if os.path.exists(harmonized_name + '_1000G_merge3.log'):
-            # If merge 3 log exists, read it into pandas dataframe.
-            logfile = pd.DataFrame()
-            with open(harmonized_name + '_1000G_merge3.log', 'r') as f:
-                for line in f:
-                    logfile = pd.concat([logfile, pd.DataFrame([tuple(line.strip().split(" "))])], ignore_index=True)
+            # If merge 3 log exists, read it in.
+            rsid_warnings, missnp, warning_lines = merge_problems(harmonized_name + '_1000G_merge3')
 
             # If the bim file doesn't exist, try to figure out why.
             if not os.path.exists(harmonized_name + '_1000G_merge3.bim'):
                 # If logfile still has warnings, or there are still missnps, the user will need to identify them and
                 # take care of them manually.
-                if logfile[0].str.contains('Warning:').any() \
+                if warning_lines > 0 \
                         and os.path.exists(harmonized_name + '_1000G_merge3-merge.missnp'):
                     print(Fore.RED + Style.BRIGHT)
                     sys.exit("I'm sorry, the logfile still has warnings, even after removing snps that "
@@ -411,7 +611,7 @@ def merge1000g(harmonized_name, harmonized_path):
                              "even after flipping some and removing the ones that the flip didn't solve. You'll have "
                              "to manually deal with these using the merge3 log and the merge3-merge.missnp file.")
                 # Check to see if the logfile still has warnings
-                elif logfile[0].str.contains('Warning:').any():
+                elif warning_lines > 0:
                     print(Fore.RED + Style.BRIGHT)
                     sys.exit("I'm sorry, the logfile still has warnings, even after removing snps that threw errors in "
                              "the first two tries. You'll have to manually deal with these using the merge3 log file.")
@@ -1,6 +1,7 @@
 import platform
 import os
 import sys
+import signal
 import subprocess
 from os.path import expanduser
 try:
@@ -12,6 +13,20 @@ except ImportError:
 from colorama import init, Fore, Style
 init()
 
+try:
+    import pandas as pd
+except (ImportError, ModuleNotFoundError):
+    import genodownload
+    genodownload.getpandas()
+    import pandas as pd
+
+try:
+    import numpy as np
+except (ImportError, ModuleNotFoundError):
+    import genodownload
+    genodownload.getnumpy()
+    import numpy as np
+
 home = expanduser("~")
 bindir = os.path.join(home, 'software', 'bin')
 system_check = platform.system()
@@ -35,7 +50,163 @@ else:
     genodownload.plink()
 
 
+# Files shapeit -check can write next to its log, by their ending:
+#   .snp.strand.exclude - physical positions of all Case1 and Case3 problems, for --exclude-snp
+#   .ind.me, .snp.me - Mendel errors per person and per SNP
+#   .snp.hh, .ind.hh - haploid heterozygous genotypes per SNP and per person (chrX only)
+CHECK_OUTPUTS = ('.snp.strand.exclude', '.ind.me', '.snp.me', '.snp.hh', '.ind.hh')
+
+# The part of chrX outside the pseudoautosomal regions on GRCh37, the part guess-ploidy looks at.
+X_NONPAR = 'X:2699521-154931043'
+
+
+def reference_files(ref_path, i):
+    # The 1000G genetic map, hap and legend files for chromosome i + 1 (i = 22 is chrX) in ref_path.
+    if i < 22:
+        names = ['genetic_map_chr%d_combined_b37.txt', '1000GP_Phase3_chr%d.hap.gz', '1000GP_Phase3_chr%d.legend.gz']
+        return [os.path.join(ref_path, name % (i + 1)) for name in names]
+    return [os.path.join(ref_path, name) for name in ['genetic_map_chrX_nonPAR_combined_b37.txt',
+                                                      '1000GP_Phase3_chrX_NONPAR.hap.gz',
+                                                      '1000GP_Phase3_chrX_NONPAR.legend.gz']]
+
+
+def check_memory_mb(n_ref_variants, n_variants, n_samples):
+    # Roughly what shapeit -check needs: the 5008 reference haplotypes at every variant in the legend (a byte each for
+    # 8 of them, doubled for room to spare), plus the study genotypes.
+    return 512 + (2 * n_ref_variants * 5008 // 8 + n_variants * n_samples) // (1024 * 1024)
+
+
+def phase_check(i, geno_name, ref_path):
+    # Run shapeit -check on chromosome i + 1 (i = 22 is chrX) of the files in the Phasing folder, the same way it will
+    # be phased. Returns the check files it wrote (see CHECK_OUTPUTS) that the exclusion step needs to look at. This is
+    # one worker's job when phase() checks several chromosomes at once.
+    input_name = os.path.join('Phasing', geno_name + '.chr' + str(i + 1))
+    check_log_name = os.path.join('Phasing', geno_name + '_PhaseCheck.chr' + str(i + 1))
+    genetic_map_name, hap_name, legend_name = reference_files(ref_path, i)
+
+    # Files left over from an earlier check would look like problems found this time.
+    for ending in CHECK_OUTPUTS:
+        if os.path.exists(check_log_name + ending):
+            os.remove(check_log_name + ending)
+
+    command = ['shapeit', '-check', '--input-bed', input_name + '.bed', input_name + '.bim', input_name + '.fam',
+               '--input-map', genetic_map_name, '--input-ref', hap_name, legend_name,
+               os.path.join(ref_path, '1000GP_Phase3.sample'), '--output-log', check_log_name]
+    if i < 22:
+        subprocess.call(command, stdout=subprocess.DEVNULL)
+    else:
+        # Phasing chrX specifically considers all people unrelated. They might change this later.
+        subprocess.check_output(command[:2] + ['--chrX'] + command[2:])
+    print("Pre-phasing check done on chr" + str(i + 1))
+
+    return [check_log_name + ending for ending in CHECK_OUTPUTS if os.path.exists(check_log_name + ending)]
+
+
+def _read_check(file_name, columns, dtypes, header=None, skiprows=0):
+    # Some columns of a shapeit -check file as typed arrays (empty if the file is). Everything is read as text first,
+    # so IDs like 0042 stay as they are.
+    if os.path.getsize(file_name) == 0:
+        return [np.zeros(0, dtype=dtype) for dtype in dtypes]
+    check = pd.read_csv(file_name, sep='\s+', header=header, skiprows=skiprows, usecols=columns, dtype=str)
+    return [check[column].values.astype(dtype) for column, dtype in zip(columns, dtypes)]
+
+
+def phase_exclusions(check_outputs, mendel_threshold=0.05, hh_threshold=0.01):
+    # What to leave out of phasing on each chromosome, from the shapeit -check files in check_outputs (check_outputs[i]
+    # lists the ones chromosome i + 1 has, see phase_check):
+    #   SNPs - strand problems (.snp.strand.exclude), a Mendel error rate > mendel_threshold (.snp.me) or a haploid
+    #          heterozygous rate > hh_threshold (.snp.hh, chrX only). shapeit takes these by position.
+    #   people - a haploid heterozygous rate > hh_threshold (.ind.hh, chrX only), by ID.
+    # Every file is read once, into arrays, and the rates are compared as numbers. Where there is something to leave
+    # out, <check log>.ExcludeSnps and <check log>.ind.hh.exclude are written (one per line, no header). Returns a list
+    # of (SNP file, people file) per chromosome, with None where there is nothing to leave out, and the .ind.me files
+    # that have people with Mendel errors.
+    exclusions = []
+    mendel_files = []
+    for outputs in check_outputs:
+        positions = [np.zeros(0, dtype=np.int64)]
+        people = [np.zeros(0, dtype=object)]
+        for file_name in outputs:
+            check_log_name = [file_name[:-len(ending)] for ending in CHECK_OUTPUTS if file_name.endswith(ending)][0]
+            if file_name.endswith('.snp.strand.exclude'):
+                positions.extend(_read_check(file_name, [0], [np.int64]))
+            elif file_name.endswith('.snp.me') or file_name.endswith('.snp.hh'):
+                position, errors, total = _read_check(file_name, [1, 2, 3], [np.int64, np.float64, np.float64],
+                                                      skiprows=1)
+                threshold = mendel_threshold if file_name.endswith('.snp.me') else hh_threshold
+                positions.append(position[errors > threshold * total])
+            elif file_name.endswith('.ind.hh'):
+                iid, errors, total = _read_check(file_name, [1, 2, 3], [object, np.float64, np.float64], skiprows=1)
+                people.append(iid[errors > hh_threshold * total])
+            elif file_name.endswith('.ind.me'):
+                father, mother = _read_check(file_name, ['father_mendel', 'mother_mendel'], [np.float64, np.float64],
+                                             header=0)
+                if (father > 0).any() or (mother > 0).any():
+                    mendel_files.append(file_name)
+
+        positions = np.unique(np.concatenate(positions))
+        people = pd.unique(np.concatenate(people))
+        exclude_snps = exclude_people = None
+        if len(positions):
+            exclude_snps = check_log_name + '.ExcludeSnps'
+            with open(exclude_snps, 'w') as f:
+                f.writelines(str(position) + '\n' for position in positions)
+        if len(people):
+            exclude_people = check_log_name + '.ind.hh.exclude'
+            with open(exclude_people, 'w') as f:
+                f.writelines(str(person) + '\n' for person in people)
+        exclusions.append((exclude_snps, exclude_people))
+    return exclusions, mendel_files
+
+
+def phase_resources(n_variants, n_samples, cores=8):
+    # Memory (MB) and wall time (hours) to ask for to phase a chromosome with n_variants SNPs using shapeit with cores
+    # threads. shapeit keeps every reference and study haplotype at the study's SNPs in memory (give it 8 bytes each),
+    # and its run time grows with people x SNPs. These are rough, so they never go below what the phasing jobs have
+    # always been given and have finished in (30 hours, and 7GB for each of 8 cores); they only grow for bigger data.
+    import genojobs
+    mem_mb = max(7 * 1024 * 8, 1024 + 8 * n_variants * (5008 + 2 * n_samples) // (1024 * 1024))
+    return mem_mb, genojobs.walltime(600 + 2e-4 * n_samples * n_variants / cores, min_hours=30)
+
+
+def phase_job(geno_name, i, ref_path, n_variants, n_samples, chr_x=False, exclude_snps=None, exclude_people=None,
+              cores=8):
+    # genojobs.Job that phases chromosome i + 1 (i = 22 is chrX) of the files in the Phasing folder against 1000G with
+    # shapeit, leaving out the SNPs listed in exclude_snps and the people in exclude_people, and converts the result to
+    # VCF. It runs in the Phasing folder.
+    import genojobs
+    ref_path = os.path.abspath(ref_path)
+    genetic_map_name, hap_name, legend_name = reference_files(ref_path, i)
+    input_name = geno_name + '.chr' + str(i + 1)
+    output_name = geno_name + '_PhasedTo1000G.chr' + str(i + 1)
+
+    # Phasing chrX specifically considers all people unrelated, the autosomes use the family information (duoHMM).
+    options = ' --chrX' if chr_x else ' --duohmm'
+    if exclude_snps is not None:
+        options += ' --exclude-snp ' + os.path.basename(exclude_snps)
+    if exclude_people is not None:
+        options += ' --exclude-ind ' + os.path.basename(exclude_people)
+
+    mem_mb, hours = phase_resources(n_variants, n_samples, cores)
+    return genojobs.Job(geno_name + '_PhaseScript.chr' + str(i + 1), [
+        'shapeit --input-bed ' + input_name + '.bed ' + input_name + '.bim ' + input_name + '.fam' + options
+        + ' --input-map ' + genetic_map_name + ' --input-ref ' + hap_name + ' ' + legend_name + ' '
+        + os.path.join(ref_path, '1000GP_Phase3.sample') + ' --thread ' + str(cores) + ' --output-max '
+        + output_name + ' --output-log ' + output_name,
+        'shapeit -convert --input-haps ' + output_name + '.haps ' + output_name + '.sample --output-vcf '
+        + output_name + '.vcf --output-log ' + output_name + '.vcf.log'],
+        cores=cores, mem_mb=mem_mb, walltime_hours=hours, workdir='Phasing')
+
+
 def phase(geno_name, allocation_name):
+    # Each chromosome is phased as its own job, asking for the memory and time its number of SNPs needs (see
+    # phase_resources).
+    import genobed
+    import genojobs
+    import genolegend
+    import genopool
+    geno_name = genobed.bfile_name(geno_name)
+
     try:
         import pandas as pd
     except (ImportError, ModuleNotFoundError):
@@ -55,6 +226,9 @@ def phase(geno_name, allocation_name):
     on_cluster = input('Are you currently running this from the Penn State ACI-B cluster? If yes, I can submit the jobs'
                        ' for you. If not, you will need to submit the files yourself. (y/n): ').lower()
     print(Style.RESET_ALL)
+    # Find the scheduler now, so a missing one stops us before the phasing checks rather than after.
+    if on_cluster in ('y', 'yes'):
+        scheduler = genojobs.backend(None, allocation_name)
 
     # If it doesn't exist, create Phasing folder
     if not os.path.exists('Phasing'):
@@ -90,29 +264,9 @@ def phase(geno_name, allocation_name):
     else:
         sys.exit('Please answer yes or no. Quitting now because no hap/legend/sample files.')
 
-    # Names of files needed.
-    genetic_map_names = ['genetic_map_chr%d_combined_b37.txt' % x for x in range(1, 23)]
-    genetic_map_names.extend(['genetic_map_chrX_nonPAR_combined_b37.txt'])
-    hap_names = ['1000GP_Phase3_chr%d.hap.gz' % x for x in range(1,23)]
-    hap_names.extend(['1000GP_Phase3_chrX_NONPAR.hap.gz'])
-    legend_names = ['1000GP_Phase3_chr%d.legend.gz' % x for x in range(1,23)]
-    legend_names.extend(['1000GP_Phase3_chrX_NONPAR.legend.gz'])
-    geno_bed_names = ['Phasing/' + geno_name + '.chr%d.bed' % x for x in range(1,24)]
-    geno_bim_names = ['Phasing/' + geno_name + '.chr%d.bim' % x for x in range(1, 24)]
-    geno_fam_names = ['Phasing/' + geno_name + '.chr%d.fam' % x for x in range(1, 24)]
-    check_log_names = ['Phasing/' + geno_name + '_PhaseCheck.chr%d' % x for x in range(1, 24)]
-    strand_exclude_names = ['Phasing/' + geno_name + '_PhaseCheck.chr%d.snp.strand.exclude' % x for x in
-                                range(1,24)]
-    ind_me_names = ['Phasing/' + geno_name + '_PhaseCheck.chr%d.ind.me' % x for x in range(1, 24)]
-    snp_me_names = ['Phasing/' + geno_name + '_PhaseCheck.chr%d.snp.me' % x for x in range(1, 24)]
-    output_names = ['Phasing/' + geno_name + '_PhasedTo1000G.chr%d' % x for x in range(1,24)]
-    output_vcf_names = ['Phasing/' + geno_name + '_PhasedTo1000G.chr%d.vcf' % x for x in range(1,24)]
-    output_vcf_log = ['Phasing/' + geno_name + '_PhasedTo1000G.chr%d.vcf.log' % x for x in range(1,24)]
-
     # Make list of people with unspecified sex.
-    fam_file = pd.read_csv(geno_name + '.fam', sep=' ', header=None)
-    unknownsex = fam_file.loc[fam_file[4] == 0]
-    unknownsex[1].to_csv(geno_name + '_SexUnknown.txt', sep='\t', header=None, index=False)
+    geno = genobed.load(geno_name)
+    pd.Series(geno.iids[geno.sexes == 0]).to_csv(geno_name + '_SexUnknown.txt', sep='\t', header=None, index=False)
 
     # Use plink to set mendel errors to missing.
     if os.path.getsize(geno_name + '_SexUnknown.txt') > 0:
@@ -124,444 +278,63 @@ def phase(geno_name, allocation_name):
     # Remove old files
     subprocess.call(rm + '*~', shell=True)
 
-    # Perform phasing check per chromosome.
-    for i in range(0,23):
-        # Split the geno file into separate chromosomes and put it in the Phasing folder.
-        subprocess.check_output([plink, '--bfile', geno_name, '--chr', str(i + 1), '--make-bed', '--out',
-                                 'Phasing/' + geno_name + '.chr' + str(i+1)])
-        # If on autosomes
-        if i < 22:
-            # Perform phasing check.
-            subprocess.call(['shapeit', '-check', '--input-bed', geno_bed_names[i], geno_bim_names[i],
-                             geno_fam_names[i], '--input-map', os.path.join(ref_path, genetic_map_names[i]),
-                             '--input-ref', os.path.join(ref_path, hap_names[i]),
-                             os.path.join(ref_path, legend_names[i]), os.path.join(ref_path, '1000GP_Phase3.sample'),
-                             '--output-log', check_log_names[i]])
-            print("Pre-phasing check done on chr" + str(i + 1))
-
-        # If working on the X chromosome
-        if i == 22:
-            # In the 1000G sample file, need to change male to 1 and female to 2.
-            ref_sample = pd.read_csv(os.path.join(ref_path, '1000GP_Phase3.sample'), sep=" ", header = 0)
-            # Replace female with 2
-            ref_sample.iloc[:,3].replace('female', '2', inplace=True)
-            # Replace male with 1
-            ref_sample.iloc[:,3].replace('male', '1', inplace=True)
-            # Write file
-            ref_sample.to_csv(os.path.join(ref_path, '1000GP_Phase3.sample'), sep = " ", header = True, index = False)
-
-            # Perform phasing check. Phasing chrX specifically considers all people unrelated. They might change this
-            # later.
-            subprocess.check_output(['shapeit', '-check', '--chrX', '--input-bed', geno_bed_names[i], geno_bim_names[i],
-                                     geno_fam_names[i], '--input-map', os.path.join(ref_path, genetic_map_names[i]),
-                                     '--input-ref', os.path.join(ref_path, hap_names[i]),
-                                     os.path.join(ref_path, legend_names[i]),
-                                     os.path.join(ref_path, '1000GP_Phase3.sample'), '--output-log',
-                                     check_log_names[i]])
-            print("Pre-phasing check done on chr" + str(i + 1))
-
-    # Now that check is performed, we're on the lookout for these files:
-        #  myLogFile.snp.strand.exclude that  gives a list of the physical positions of all Case1 and Case3 problems
-            # found for easy exclusion using --exclude-snp option.
-        #  gwas.checks.ind.me contains the Mendel errors at the individual level (N lines).
-        #  gwas.checks.snp.me contains the Mendel errors at the SNP level (L lines).
-    # Additional files just for chrX:
-        # gwas.phased.snp.hh reports the number of haploid heterozygous per variant site.
-        # gwas.phased.ind.hh reports the number of haploid heterozygous per sample.
-    # The mendel errors should not happen because we set them as missing in plink, but putting them in here just in
-    # case.
-
-    # Prepare files for phasing and submit to cluster.
-    for i in range(0,23):
-        if i < 22:
-            # If a log file with snp.strand exclude is produced, then these SNPs need to be removed.
-            if os.path.exists(strand_exclude_names[i]):
-                # Read in strand_exclude file to just get positions to remove.
-                strand_exclude = pd.read_csv(strand_exclude_names[i], sep=" ", header=None)
-                log = ['a']
-            else:
-                log = []
-
-            # If a *.ind.me file is produced and the error rates are nonzero, tell the user because they should
-            # investigate these people. Could indicate that their family assignments are incorrect.
-            if os.path.exists(ind_me_names[i]):
-                # Read in ind file.
-                ind_me_file = pd.read_csv(ind_me_names[i], sep='\t', header = 0, dtype = {0:str,1:str,2:float,3:str,
-                                                                                           4:float,5:float,6:int})
-                father_me_errors = ind_me_file[ind_me_file['father_mendel'] > 0]
-                mother_me_errors = ind_me_file[ind_me_file['mother_mendel'] > 0]
-                if (len(father_me_errors) > 0) or (len(mother_me_errors) > 0):
-                    print("Your files have people with non-zero mendel errors. You should investigate the "
-                          + ind_me_names[i] + ' file and take a careful look at the people with high values in the '
-                                              'father_mendel & mother_mendel column. This result suggests that your '
-                                              'paternity/maternity assignment could be incorrect.')
-            else:
-                pass
-
-            # If a *.snp.me file is produced, see if there are any snps with high mendel error rates.
-            if os.path.exists(snp_me_names[i]):
-                # Read in snp.me file
-                snp_me_file = pd.read_csv(snp_me_names[i], sep='\t', header=None, skiprows=1,
-                                          dtype={0: str, 1: int, 2: float, 3: float})
-                # Create mendel error column where we see which snps have a error rate of > 0.05
-                snp_me_file['MendelError'] = np.where((snp_me_file[2] / snp_me_file[3]) > 0.05, 'Yes', 'No')
-                # Create new dataframe with only the positions where Mendel Error was yes
-                me_exclude = snp_me_file[snp_me_file['MendelError'] == 'Yes'][1]
-                # If this is non-empty, make note.
-                if len(me_exclude) > 0:
-                    log.extend(['b'])
-                # If it is empty (i.e. no Mendel Errors exist) do nothing.
-                else:
-                    pass
-            else:
-                pass
-
-            # If both snp.strand.exclude exists and there are mendel error snps:
-            if log == ['a', 'b']:
-                # Concatenate the two lists of snps to exclude
-                snp_exclude = pd.concat([strand_exclude, me_exclude], axis=0)
-                # Drop duplicates
-                snp_exclude.drop_duplicates(keep='first', inplace=True)
-                # Write file
-                snp_exclude.to_csv(check_log_names[i] + '.ExcludeSnps',
-                                   sep="\t", header=False, index=False)
-                # Save name of file we just created
-                snp_exclude_name = check_log_names[i] + '.ExcludeSnps'
-
-            # If just the snp.strand.exclude exists.
-            elif log == ['a']:
-                # Since it was just the strand problem log that was written, the exclude snp name is the same as that
-                # log file name
-                snp_exclude_name = strand_exclude_names[i]
-
-            # If just the snp.me errors exist.
-            elif log == ['b']:
-                # Write file
-                me_exclude.to_csv(check_log_names[i] + '.ExcludeSnps', sep="\t", header=False, index=False)
-                # Save name of file we just created.
-                snp_exclude_name = check_log_names[i] + '.ExcludeSnps'
-            # If these files don't exist, do nothing for now.
-            elif log == []:
-                pass
-            else:
-                sys.exit("I shouldn't have gotten here. There is something wrong with the way the script is checking "
-                         "for the phase check files.")
-
-            # If I just filled the snp_exclude_name variable with a name, then we have snps to remove.
-            if 'snp_exclude_name' in locals():
-                # Write pbs script
-                with open('Phasing/' + geno_name + '_PhaseScript.chr' + str(i + 1) + '.pbs', 'w') as file:
-                    file.write('#!/bin/bash\n'
-                               '#PBS -l walltime=30:00:00\n'
-                               '#PBS -l nodes=1:ppn=8\n'
-                               '#PBS -l pmem=7gb\n'
-                               '#PBS -A ' + allocation_name +
-                               '\n'
-                               '#PBS -o Phasing/\n'
-                               '#PBS -j oe\n'
-                               'cd $PBS_O_WORKDIR\n'
-                               '\n' +
-                               'shapeit --input-bed ' + geno_bed_names[i] + ' ' + geno_bim_names[i] + ' '
-                               + geno_fam_names[i] + ' --duohmm --input-map '
-                               + os.path.join(ref_path, genetic_map_names[i]) + ' --input-ref '
-                               + os.path.join(ref_path, hap_names[i]) + ' ' + os.path.join(ref_path, legend_names[i])
-                               + ' ' + os.path.join(ref_path, '1000GP_Phase3.sample') + ' --exclude-snp '
-                               + snp_exclude_name + ' --output-max ' + output_names[i] + ' --output-log '
-                               + output_names[i]
-                               + '\n'
-                               + 'shapeit -convert --input-haps ' + output_names[i] + '.haps '
-                               + output_names[i] + '.sample --output-vcf ' + output_vcf_names[i] + ' --output-log '
-                               + output_vcf_log[i])
-            # If snp_exclude_names isn't filled, then phase with all SNPs.
-            else:
-                # Write pbs file.
-                with open('Phasing/' + geno_name + '_PhaseScript.chr' + str(i+1) + '.pbs', 'w') as file:
-                    file.write('#!/bin/bash\n'
-                               '#PBS -l walltime=30:00:00\n'
-                               '#PBS -l nodes=1:ppn=8\n'
-                               '#PBS -l pmem=7gb\n'
-                               '#PBS -A ' + allocation_name +
-                               '\n'
-                               '#PBS -o Phasing/\n'
-                               '#PBS -j oe\n'
-                               'cd $PBS_O_WORKDIR\n'
-                               '\n' +
-                               'shapeit --input-bed ' + geno_bed_names[i] + ' ' + geno_bim_names[i] + ' '
-                               + geno_fam_names[i] + ' --duohmm --input-map '
-                               + os.path.join(ref_path, genetic_map_names[i]) + ' --input-ref '
-                               + os.path.join(ref_path, hap_names[i]) + ' ' + os.path.join(ref_path, legend_names[i])
-                               + ' ' + os.path.join(ref_path, '1000GP_Phase3.sample') + ' --output-max '
-                               + output_names[i] + ' --output-log ' + output_names[i]
-                               + '\n'
-                               + 'shapeit -convert --input-haps ' + output_names[i] + '.haps '
-                               + output_names[i] + '.sample --output-vcf ' + output_vcf_names[i] + ' --output-log '
-                               + output_vcf_log[i])
-            print("Done preparing chr" + str(i + 1) + " for phasing")
-
-        # Need to phase chrX specially.
-        if i == 22:
-            # If snp.strand.exclude exists:
-            if os.path.exists(strand_exclude_names[i]):
-                # Read in strand_exclude file to just get positions to remove.
-                strand_exclude = pd.read_csv(strand_exclude_names[i], sep=" ", header=None)
-                log = ['a']
-            else:
-                log = []
-
-            # If a *.ind.me file is produced and the error rates are nonzero, tell the user because they should
-            # investigate these people. Could indicate that their family assignments are incorrect.
-            if os.path.exists(ind_me_names[i]):
-                # Read in ind file.
-                ind_me_file = pd.read_csv(ind_me_names[i], sep='\t', header=0,
-                                           dtype={0: str, 1: str, 2: float, 3: str, 4: float, 5: float, 6: int})
-                father_me_errors = ind_me_file[ind_me_file['father_mendel'] > 0]
-                mother_me_errors = ind_me_file[ind_me_file['mother_mendel'] > 0]
-                if (len(father_me_errors) > 0) or (len(mother_me_errors) > 0):
-                    print("Your files have people with non-zero mendel errors. You should investigate the "
-                          + ind_me_names[i] + ' file and take a careful look at the people with high values in the '
-                                              'father_mendel & mother_mendel column. This result suggests that your '
-                                              'paternity/maternity assignment could be incorrect.')
-                else:
-                    pass
-
-            # If a *.snp.me file is produced, see if there are any snps with high mendel error rates.
-            if os.path.exists(snp_me_names[i]):
-                # Read in snp.me file
-                snp_me_file = pd.read_csv(snp_me_names[i], sep='\t', header=None, skiprows=1,
-                                          dtype={0: str, 1: int, 2: float, 3: float})
-                # Create mendel error column where we see which snps have a error rate of > 0.05
-                snp_me_file['MendelError'] = np.where((snp_me_file[2] / snp_me_file[3]) > 0.05, 'Yes', 'No')
-                # Create new dataframe with only the positions where Mendel Error was yes
-                me_exclude = snp_me_file[snp_me_file['MendelError'] == 'Yes'][1]
-                # If this is non-empty, make note.
-                if len(me_exclude) > 0:
-                    log.extend(['b'])
-                # If it is empty (i.e. no Mendel Errors exist) do nothing.
-                else:
-                    pass
-            else:
-                pass
-
-            # If a *.snp.hh file is produced, see if there are snps with high haploid heterozygosity rate.
-            if os.path.exists(check_log_names[i] + '.snp.hh'):
-                # Read in haploid het file
-                snp_hh_file = pd.read_csv(check_log_names[i] + '.snp.hh', sep='\t', header=None, skiprows=1,
-                                          dtype={0: str, 1: int, 2: float, 3: float})
-                # Create a new column with 'Yes' for snps with mendel error > 1%
-                snp_hh_file['HHError'] = np.where((snp_hh_file[2] / snp_hh_file[3]) > 0.01, 'Yes', 'No')
-                # Create new dataframe with only the positions with high HH rates
-                snp_hh_exclude = snp_hh_file[snp_hh_file['HHError'] == 'Yes'][1]
-                # If this is non-empty, make note:
-                if len(snp_hh_exclude) > 0:
-                    log.extend(['c'])
-                # If it is empty (i.e. no HH errors exist) do nothing
-                else:
-                    pass
-            else:
-                pass
-
-            # If a *.ind.hh file is produced, see if there are males with high haploid heterozygosity rate.
-            if os.path.exists(check_log_names[i] + '.ind.hh'):
-                # Read in file of people to check.
-                ind_hh_file = pd.read_csv(check_log_names[i] + '.ind.hh', sep = '\t', header = None, skiprows=1,
-                                          dtype={0: str, 1: int, 2: float, 3: float})
-                # Create new column with info on whether the ind has mendel error > 1%
-                ind_hh_file['HHError'] = np.where((ind_hh_file[2] / ind_hh_file[3]) > 0.01, 'Yes', 'No')
-                # Create new dataframe of people with high mendel errors.
-                ind_hh_exclude = ind_hh_file[ind_hh_file['HHError'] == 'Yes'][1]
-                # If this list is non-zero, write file of individuals to exclude.
-                if len(ind_hh_exclude) > 0:
-                    ind_hh_exclude.to_csv(check_log_names[i] + '.ind.hh.exclude')
-                # If not, then do nothing
-                else:
-                    ind_hh_exclude = []
-            else:
-                ind_hh_exclude = []
-
-            # If snp.strand.exclude, me.snp, and snp.hh exists:
-            if log == ['a', 'b', 'c']:
-                # Concatenate the three lists of snps to exclude
-                snp_exclude = pd.concat([strand_exclude, me_exclude, snp_hh_exclude], axis=0)
-                # Drop duplicates
-                snp_exclude.drop_duplicates(keep='first', inplace=True)
-                # Write file
-                snp_exclude.to_csv(check_log_names[i] + '.ExcludeSnps', sep="\t", header=False, index=False)
-                # Save name of file we just created
-                snp_exclude_name = check_log_names[i] + '.ExcludeSnps'
-
-            # If snp.strand.exclude and me.snp exist:
-            elif log == ['a', 'b']:
-                # Concatenate the two lists of snps to exclude
-                snp_exclude = pd.concat([strand_exclude, me_exclude], axis=0)
-                # Drop duplicates
-                snp_exclude.drop_duplicates(keep='first', inplace=True)
-                # Write file
-                snp_exclude.to_csv(check_log_names[i] + '.ExcludeSnps', sep="\t", header=False, index=False)
-                # Save name of file we just created
-                snp_exclude_name = check_log_names[i] + '.ExcludeSnps'
-
-            # If snp.strand.exclude and .snp.hh exist:
-            elif log == ['a', 'c']:
-                # Concatenate the two lists of snps to exclude
-                snp_exclude = pd.concat([strand_exclude, snp_hh_exclude], axis=0)
-                # Drop duplicates
-                snp_exclude.drop_duplicates(keep='first', inplace=True)
-                # Write file
-                snp_exclude.to_csv(check_log_names[i] + '.ExcludeSnps',sep="\t", header=False, index=False)
-                # Save name of file we just created
-                snp_exclude_name = check_log_names[i] + '.ExcludeSnps'
-
-            # If me.snp and snp.hh exist:
-            elif log == ['b', 'c']:
-                # Concatenate the two lists of snps to exclude
-                snp_exclude = pd.concat([strand_exclude, snp_hh_exclude], axis=0)
-                # Drop duplicates
-                snp_exclude.drop_duplicates(keep='first', inplace=True)
-                # Write file
-                snp_exclude.to_csv(check_log_names[i] + '.ExcludeSnps', sep="\t", header=False, index=False)
-                # Save name of file we just created
-                snp_exclude_name = check_log_names[i] + '.ExcludeSnps'
-
-            # If just the snp.strand.exclude exists.
-            elif log == ['a']:
-                # Since it was just the strand problem log that was written, the exclude snp name is the same as that
-                # log file name
-                snp_exclude_name = strand_exclude_names[i]
-
-            # If just the snp.me errors exist.
-            elif log == ['b']:
-                # Write file
-                me_exclude.to_csv(check_log_names[i] + '.ExcludeSnps', sep="\t", header=False, index=False)
-                # Save name of file we just created.
-                snp_exclude_name = check_log_names[i] + '.ExcludeSnps'
-
-            # If just the snp.hh errors exit.
-            elif log == ['c']:
-                # Write file
-                snp_hh_exclude.to_csv(check_log_names[i] + '.ExcludeSnps', sep="\t", header=False, index=False)
-                # Save name of file we just created.
-                snp_exclude_name = check_log_names[i] + '.ExcludeSnps'
-            # If these files don't exist, do nothing for now.
-            elif log == []:
-                pass
-            else:
-                sys.exit("I shouldn't have gotten here. There is something wrong with the way the script is checking "
-                         "for the phase check files.")
-
-            # If I just filled the snp_exclude_name variable, then we have snps to remove.
-            # If there are people in ind_hh_exclude, then we have people to remove.
-            if ('snp_exclude_name' in locals()) and (len(ind_hh_exclude) > 0):
-                # Write pbs script
-                with open('Phasing/' + geno_name + '_PhaseScript.chr' + str(i + 1) + '.pbs', 'w') as file:
-                    file.write('#!/bin/bash\n'
-                               '#PBS -l walltime=30:00:00\n'
-                               '#PBS -l nodes=1:ppn=8\n'
-                               '#PBS -l pmem=7gb\n'
-                               '#PBS -A ' + allocation_name +
-                               '\n'
-                               '#PBS -o Phasing/\n'
-                               '#PBS -j oe\n'
-                               'cd $PBS_O_WORKDIR\n'
-                               '\n' +
-                               'shapeit --input-bed ' + geno_bed_names[i] + ' ' + geno_bim_names[i] + ' '
-                               + geno_fam_names[i] + ' --chrX --input-map '
-                               + os.path.join(ref_path, genetic_map_names[i]) + ' --input-ref '
-                               + os.path.join(ref_path, hap_names[i]) + ' ' + os.path.join(ref_path, legend_names[i])
-                               + ' ' + os.path.join(ref_path, '1000GP_Phase3.sample') + ' --exclude-snp '
-                               + snp_exclude_name + ' --exclude-ind ' + check_log_names[i] + '.ind.hh.exclude'
-                               + ' --output-max ' + output_names[i] + ' --output-log ' + output_names[i]
-                               + '\n'
-                               + 'shapeit -convert --input-haps ' + output_names[i] + '.haps '
-                               + output_names[i] + '.sample --output-vcf ' + output_vcf_names[i] + ' --output-log '
-                               + output_vcf_log[i])
-
-            # If only snp_exclude_name variable is filled, then we have snps to remove.
-            elif 'snp_exclude_name' in locals():
-                # Write pbs script
-                with open('Phasing/' + geno_name + '_PhaseScript.chr' + str(i + 1) + '.pbs', 'w') as file:
-                    file.write('#!/bin/bash\n'
-                               '#PBS -l walltime=30:00:00\n'
-                               '#PBS -l nodes=1:ppn=8\n'
-                               '#PBS -l pmem=7gb\n'
-                               '#PBS -A ' + allocation_name +
-                               '\n'
-                               '#PBS -o Phasing/\n'
-                               '#PBS -j oe\n'
-                               'cd $PBS_O_WORKDIR\n'
-                               '\n' +
-                               'shapeit --input-bed ' + geno_bed_names[i] + ' ' + geno_bim_names[i] + ' '
-                               + geno_fam_names[i] + ' --chrX --input-map '
-                               + os.path.join(ref_path, genetic_map_names[i]) + ' --input-ref '
-                               + os.path.join(ref_path, hap_names[i]) + ' ' + os.path.join(ref_path, legend_names[i])
-                               + ' ' + os.path.join(ref_path, '1000GP_Phase3.sample') + ' --exclude-snp '
-                               + snp_exclude_name + ' --output-max ' + output_names[i] + ' --output-log '
-                               + output_names[i]
-                               + '\n'
-                               + 'shapeit -convert --input-haps ' + output_names[i] + '.haps '
-                               + output_names[i] + '.sample --output-vcf ' + output_vcf_names[i] + ' --output-log '
-                               + output_vcf_log[i])
-            # If there are only people in ind_hh_exclude, then we have people to remove.
-            elif len(ind_hh_exclude) > 0:
-                # Write pbs script
-                with open('Phasing/' + geno_name + '_PhaseScript.chr' + str(i + 1) + '.pbs', 'w') as file:
-                    file.write('#!/bin/bash\n'
-                               '#PBS -l walltime=30:00:00\n'
-                               '#PBS -l nodes=1:ppn=8\n'
-                               '#PBS -l pmem=7gb\n'
-                               '#PBS -A ' + allocation_name +
-                               '\n'
-                               '#PBS -o Phasing/\n'
-                               '#PBS -j oe\n'
-                               'cd $PBS_O_WORKDIR\n'
-                               '\n' +
-                               'shapeit --input-bed ' + geno_bed_names[i] + ' ' + geno_bim_names[i] + ' '
-                               + geno_fam_names[i] + ' --chrX --input-map '
-                               + os.path.join(ref_path, genetic_map_names[i]) + ' --input-ref '
-                               + os.path.join(ref_path, hap_names[i]) + ' ' + os.path.join(ref_path, legend_names[i])
-                               + ' ' + os.path.join(ref_path, '1000GP_Phase3.sample') + ' --exclude-ind '
-                               + check_log_names[i] + '.ind.hh.exclude' + ' --output-max ' + output_names[i]
-                               + ' --output-log ' + output_names[i]
-                               + '\n'
-                               + 'shapeit -convert --input-haps ' + output_names[i] + '.haps '
-                               + output_names[i] + '.sample --output-vcf ' + output_vcf_names[i] + ' --output-log '
-                               + output_vcf_log[i])
-            # If none of these are filled, then phase with all SNPs.
-            else:
-                # Write pbs file.
-                with open('Phasing/' + geno_name + '_PhaseScript.chr' + str(i + 1) + '.pbs', 'w') as file:
-                    file.write('#!/bin/bash\n'
-                               '#PBS -l walltime=30:00:00\n'
-                               '#PBS -l nodes=1:ppn=8\n'
-                               '#PBS -l pmem=7gb\n'
-                               '#PBS -A ' + allocation_name +
-                               '\n'
-                               '#PBS -o Phasing/\n'
-                               '#PBS -j oe\n'
-                               'cd $PBS_O_WORKDIR\n'
-                               '\n' +
-                               'shapeit --input-bed ' + geno_bed_names[i] + ' ' + geno_bim_names[i] + ' '
-                               + geno_fam_names[i] + ' --chrX --input-map '
-                               + os.path.join(ref_path, genetic_map_names[i]) + ' --input-ref '
-                               + os.path.join(ref_path, hap_names[i]) + ' ' + os.path.join(ref_path, legend_names[i])
-                               + ' ' + os.path.join(ref_path, '1000GP_Phase3.sample') + ' --output-max '
-                               + output_names[i] + ' --output-log ' + output_names[i]
-                               + '\n'
-                               + 'shapeit -convert --input-haps ' + output_names[i] + '.haps '
-                               + output_names[i] + '.sample --output-vcf ' + output_vcf_names[i] + ' --output-log '
-                               + output_vcf_log[i])
-
-            print("Done preparing chr" + str(i+1) + " for phasing")
-
-    # If the user is currently on the cluster, then submit the pbs files to start running.
+    # Number of SNPs on each chromosome, to size the phasing jobs.
+    geno = genobed.load(geno_name)
+    chr_sizes = [int(x) for x in np.bincount(geno.chromosomes, minlength=27)[1:24]]
+
+    # Split the geno file into separate chromosomes and put it in the Phasing folder, all in one read of it.
+    genobed.split_chromosomes(geno, range(1, 24), ['Phasing/' + geno_name + '.chr' + str(i + 1) for i in range(0, 23)])
+
+    # In the 1000G sample file, need to change male to 1 and female to 2 for chrX. This is done before any of the checks
+    # start so that none of them reads the file while it is being written.
+    ref_sample = pd.read_csv(os.path.join(ref_path, '1000GP_Phase3.sample'), sep=" ", header = 0)
+    # Replace female with 2
+    ref_sample.iloc[:,3].replace('female', '2', inplace=True)
+    # Replace male with 1
+    ref_sample.iloc[:,3].replace('male', '1', inplace=True)
+    # Write file
+    ref_sample.to_csv(os.path.join(ref_path, '1000GP_Phase3.sample'), sep = " ", header = True, index = False)
+
+    # Perform phasing check per chromosome. The checks don't depend on each other, so several run at once, as many as
+    # there is memory for (each one loads the whole reference panel for its chromosome). The biggest reference panels
+    # are started first. Their sizes come from the legend cache (see genolegend) if it's built, or the size of the
+    # legend files if not.
+    ref_sizes = [genolegend.variant_count(ref_path, i) for i in range(0, 23)]
+    workers = genopool.worker_count(mem_per_worker_mb=check_memory_mb(max(ref_sizes), max(chr_sizes), geno.n_samples),
+                                    max_workers=23)
+    check_outputs = genopool.run(phase_check, [(i, geno_name, ref_path) for i in range(0, 23)], workers=workers,
+                                 sizes=ref_sizes)
+
+    # Work out what to leave out of phasing on each chromosome from the check files, then make its phasing job.
+    exclusions, mendel_files = phase_exclusions(check_outputs)
+    # If a *.ind.me file has people with nonzero error rates, tell the user because they should investigate these
+    # people. Could indicate that their family assignments are incorrect.
+    for ind_me_name in mendel_files:
+        print("Your files have people with non-zero mendel errors. You should investigate the " + ind_me_name
+              + ' file and take a careful look at the people with high values in the father_mendel & mother_mendel '
+                'column. This result suggests that your paternity/maternity assignment could be incorrect.')
+    jobs = []
+    for i in range(0, 23):
+        exclude_snps, exclude_people = exclusions[i]
+        jobs.append(phase_job(geno_name, i, ref_path, chr_sizes[i], geno.n_samples, chr_x=(i == 22),
+                              exclude_snps=exclude_snps, exclude_people=exclude_people))
+        print("Done preparing chr" + str(i + 1) + " for phasing")
+
+    # If the user is currently on the cluster, then submit the jobs to start running. If not, write the pbs files for
+    # them to take there.
     if on_cluster in ('y', 'yes'):
-        for i in range(0, 23):
-            # Submit to cluster
-            subprocess.check_output(['qsub', 'Phasing/' + geno_name + '_PhaseScript.chr' + str(i+1) + '.pbs'])
+        for job in jobs:
+            scheduler.submit(job)
+        scheduler.wait()
     elif on_cluster in ('n', 'no'):
+        for job in jobs:
+            genojobs.write(genojobs.PBS(allocation_name), job)
         sys.exit('Since you are not on the Penn State cluster right now, you should transfer the genotype files, 1000G '
                  'genetic maps, 1000G legend files, 1000G hap files, and 1000G sample file, shapeit, and the phasing '
                  'pbs files to the cluster. You can submit the files by using qsub name_of_file.pbs')
     else:
+        for job in jobs:
+            genojobs.write(genojobs.PBS(allocation_name), job)
         sys.exit("You didn't answer 'yes' or 'no' when I asked whether you were on the cluster or not, so I'm assuming "
                  "you're not. You should transfer the genotype files, 1000G genetic maps, 1000G legend files, 1000G "
                  "hap files, and 1000G sample file, shapeit, and the phasing pbs files to the cluster. You can submit "
@@ -570,7 +343,76 @@ def phase(geno_name, allocation_name):
     print("Done")
 
 
-def impute():
+def pipeline(stages, stdout=None):
+    # Run the commands in stages as one shell style pipe (stages[0] | stages[1] | ...), with the last one writing to
+    # stdout (a file) if given. Raises CalledProcessError for the first stage that fails.
+    processes = []
+    for i, command in enumerate(stages):
+        last = i == len(stages) - 1
+        processes.append(subprocess.Popen(command, stdin=processes[-1].stdout if processes else None,
+                                          stdout=stdout if last else subprocess.PIPE))
+        # Close our copy of the pipe, so an earlier stage finds out if a later one dies.
+        if len(processes) > 1:
+            processes[-2].stdout.close()
+    for process in processes:
+        process.wait()
+    for command, process in zip(stages, processes):
+        # A stage killed by SIGPIPE only stopped because a later one did, so that one is the one to report.
+        if process.returncode not in (0, -signal.SIGPIPE):
+            raise subprocess.CalledProcessError(process.returncode, ' '.join(command))
+
+
+def sanger_vcf(vcf_list, out_vcf, chr_map, fasta_file, sex_file, x_vcf_list=None):
+    # Make the whole genome VCF for the Sanger Imputation Server out of the per chromosome phased VCFs in one streaming
+    # pass: concatenate, rename the chromosomes (chr_map, e.g. 23 to X), check the REF allele against fasta_file and
+    # fix the ploidy of chrX, passing uncompressed BCF (-Ou) between the bcftools steps. Only the final out_vcf
+    # (.vcf.gz) is written, under a temporary name until every step has finished, and it is indexed once at the end.
+    # fixploidy needs the sex of everyone before the stream starts, so that is guessed first (into sex_file) from the
+    # non-PAR chrX SNPs in the chrX VCFs (x_vcf_list, or all of them if it isn't known which ones those are), after
+    # the same renaming and REF check. guess-ploidy's --genome would need an index to find those, so they are picked
+    # out of the stream with view -t instead. As before, not being able to guess sex isn't fatal: ploidy just isn't
+    # fixed.
+    rename = ['bcftools', 'annotate', '--rename-chrs', chr_map, '-Ou', '-']
+    check_ref = ['bcftools', 'norm', '--check-ref', 'ws', '--rm-dup', 'both', '--fasta-ref', fasta_file]
+    try:
+        with open(sex_file, 'w') as f:
+            pipeline([['bcftools', 'concat', '-Ou'] + list(x_vcf_list or vcf_list), rename, check_ref + ['-Ou', '-'],
+                      ['bcftools', 'view', '-t', X_NONPAR, '-Ou', '-'],
+                      ['bcftools', '+guess-ploidy', '--tag', 'GT', '-']], stdout=f)
+        print("Done checking for sex")
+        finish = [check_ref + ['-Ou', '-'],
+                  ['bcftools', '+fixploidy', '-Oz', '-o', out_vcf + '.tmp', '-', '--', '--sex', sex_file]]
+    except subprocess.CalledProcessError as error:
+        print(Fore.RED + Style.BRIGHT + "I couldn't guess everyone's sex (" + str(error) + "), so I'm not fixing "
+              "the ploidy of chrX." + Style.RESET_ALL)
+        finish = [check_ref + ['-Oz', '-o', out_vcf + '.tmp', '-']]
+
+    try:
+        pipeline([['bcftools', 'concat', '-Ou'] + list(vcf_list), rename] + finish)
+    except subprocess.CalledProcessError:
+        # Don't leave a half written VCF behind.
+        if os.path.exists(out_vcf + '.tmp'):
+            os.remove(out_vcf + '.tmp')
+        raise
+    os.replace(out_vcf + '.tmp', out_vcf)
+    # Indexing also checks the VCF is sorted.
+    subprocess.check_output(['bcftools', 'index', '-f', out_vcf])
+
+
+def add_contigs(vcf, contigs_file):
+    # Add the ##contig lines in contigs_file to the header of vcf (in place), so bcftools can use it.
+    subprocess.check_output(['bcftools', 'annotate', '-h', contigs_file, vcf, '-Ov', '-o', vcf + '.contigs'])
+    os.replace(vcf + '.contigs', vcf)
+
+
+def compress_vcf(vcf, threads=1):
+    # bgzip and index vcf (it becomes vcf.gz), with threads compression threads.
+    subprocess.check_output(['bgzip', '--threads', str(threads), '--index', vcf])
+
+
+def impute(bgzip_threads=1):
+    # bgzip_threads - compression threads for each of the per chromosome VCFs being bgzipped at the end. More threads
+    # each means fewer of them at once.
     # Required by the sanger imputation server.
     # If not requesting pre-phasing, then all sites and samples should be phased with no missing data. - genophase
     # All alleles on the forward strand - genoharmonize
@@ -584,6 +426,7 @@ def impute():
 
     import glob
     import urllib.request
+    import genopool
     import subprocess
     from subprocess import Popen, PIPE
     import shutil
@@ -685,10 +528,6 @@ def impute():
         # Replace X with 23 in Contigs.txt file.
         sedstatement = str('s/ID=X/ID=23/g')
         subprocess.call(['sed', '-i', sedstatement, os.path.join(vcf_path, "Contigs.txt")])
-        # Use bcftools to add contigs to each vcf.
-        for vcf in vcf_list:
-            subprocess.check_output(['bcftools', 'annotate', '-h', os.path.join(vcf_path, 'Contigs.txt'), vcf,
-                                     '-Ov', '-o', vcf + '.contigs'])
     # If only a fasta.gz file exists, first see if samtools can read it.
     elif os.path.exists(os.path.join(fasta_path, 'human_g1k_v37.fasta.gz')):
         p = subprocess.Popen(['samtools', 'faidx', os.path.join(fasta_path, 'human_g1k_v37.fasta.gz')],
@@ -703,10 +542,6 @@ def impute():
             # Replace X with 23 in Contigs.txt file.
             sedstatement = str('s/ID=X/ID=23/g')
             subprocess.call(['sed', '-i', sedstatement, os.path.join(vcf_path, "Contigs.txt")])
-            # Use bcftools to add contigs to each vcf.
-            for vcf in vcf_list:
-                subprocess.check_output(['bcftools', 'annotate', '-h', os.path.join(vcf_path, 'Contigs.txt'), vcf,
-                                         '-Ov', '-o', vcf + '.contigs'])
         # If the error message is the fai_build3, then it is a gzipped fasta.gz file and we need to unzip it.
         # This is the last resort because it takes a long time.
         elif '[E::fai_build3]' in perror.decode('utf-8'):
@@ -735,69 +570,33 @@ def impute():
             # Replace X with 23 in Contigs.txt file.
             sedstatement = str('s/ID=X/ID=23/g')
             subprocess.call(['sed', '-i', sedstatement, os.path.join(vcf_path, "Contigs.txt")])
-            # Use bcftools to add contigs to each vcf.
-            for vcf in vcf_list:
-                subprocess.check_output(['bcftools', 'annotate', '-h', os.path.join(vcf_path, 'Contigs.txt'), vcf,
-                                         '-Ov', '-o', vcf + '.contigs'])
-
-    # Rename the .contigs vcf to be normal vcf names.
-    for vcf in vcf_list:
-        subprocess.call(['mv', vcf + '.contigs', vcf])
-
-    # Use bcftools to concatenate the per chromosome phased vcf files. Save this in SangerImputation
-    concat_vcf_list = str(" ".join(str(x) for x in vcf_list))
-    subprocess.call('bcftools concat -Ov ' + concat_vcf_list + ' > SangerImputation/' + vcf_name + '.vcf', shell=True)
 
-    # Bgzip this file
-    subprocess.check_output('bgzip ' + os.path.join('SangerImputation', vcf_name + '.vcf'), shell=True)
-
-    # Check VCF is sorted:
-    subprocess.check_output(['bcftools', 'index', os.path.join('SangerImputation', vcf_name + '.vcf.gz')])
+    # Use bcftools to add contigs to each vcf, several at once.
+    vcf_sizes = [os.path.getsize(vcf) for vcf in vcf_list]
+    workers = genopool.worker_count(max_workers=len(vcf_list))
+    if os.path.exists(os.path.join(vcf_path, 'Contigs.txt')):
+        genopool.run(add_contigs, [(vcf, os.path.join(vcf_path, 'Contigs.txt')) for vcf in vcf_list], workers,
+                     sizes=vcf_sizes)
+
+    # Concatenate the per chromosome phased vcf files, change the chromosome names to what Sanger wants, check that our
+    # data matches the reference allele of 1000G Phase 3 (fixing those that do not match), and double check sex and fix
+    # ploidy. This is all done in one go, streamed from one bcftools step to the next, so the whole genome VCF is only
+    # written once, to SangerImputation.
+    urllib.request.urlretrieve('https://imputation.sanger.ac.uk/www/plink2ensembl.txt',
+                               'SangerImputation/plink2ensembl.txt')
+    x_vcf_list = [vcf for vcf in vcf_list if re.search('chr(23|X)[._]', os.path.basename(vcf))]
+    sanger_vcf(vcf_list, os.path.join('SangerImputation', vcf_name + '.vcf.gz'), 'SangerImputation/plink2ensembl.txt',
+               os.path.join(fasta_path, 'human_g1k_v37.fasta'),
+               os.path.join('SangerImputation', vcf_name + '_SexEst.txt'), x_vcf_list)
+    print("Done checking chromosome names, if the reference allele matches 1000G Phase3 (and fixing those that don't "
+          "match), and for sex and fixing ploidy")
 
     # Save in phasing too.
     shutil.copy2('SangerImputation/' + vcf_name + '.vcf.gz', 'Phasing/' + vcf_name + '.vcf.gz')
 
-    # Use bcftools and bgzip to zip the vcf files so that they stop taking up space.
-    for file in vcf_list:
-        subprocess.check_output('bgzip --index ' + file, shell=True)
-
-    # Use bcftools to change the chromosome names, if needed.
-    urllib.request.urlretrieve('https://imputation.sanger.ac.uk/www/plink2ensembl.txt',
-                               'SangerImputation/plink2ensembl.txt')
-    subprocess.check_output(['bcftools', 'annotate', '--rename-chrs', 'SangerImputation/plink2ensembl.txt', '-Oz', '-o',
-                             os.path.join('SangerImputation', vcf_name + '_ChrUpdated.vcf.gz'),
-                             os.path.join('SangerImputation', vcf_name + '.vcf.gz')])
-    print("Done checking chromosome names")
-    subprocess.call(['mv', os.path.join('SangerImputation', vcf_name + '_ChrUpdated.vcf.gz'),
-                     os.path.join('SangerImputation', vcf_name + '.vcf.gz')])
-    # Reindex VCF file cause we just changed it:
-    subprocess.check_output(['bcftools', 'index', os.path.join('SangerImputation', vcf_name + '.vcf.gz')])
-
-    # Check that our data matches the reference allele of 1000G Phase 3. Fix those that do not match.
-    subprocess.check_output(['bcftools', 'norm', '--check-ref', 'ws', '--rm-dup', 'both', '--fasta-ref',
-                             os.path.join(fasta_path, 'human_g1k_v37.fasta'), '-Oz', '-o',
-                             os.path.join('SangerImputation', vcf_name + '_RefChecked.vcf.gz'),
-                             os.path.join('SangerImputation', vcf_name + '.vcf.gz')])
-    print("Done checking if reference allele matches 1000G Phase3 and fixing those that don't match")
-    subprocess.call(['mv', os.path.join('SangerImputation', vcf_name + '_RefChecked.vcf.gz'),
-                     os.path.join('SangerImputation', vcf_name + '.vcf.gz')])
-    # Reindex VCF file cause we just changed it:
-    subprocess.check_output(['bcftools', 'index', os.path.join('SangerImputation', vcf_name + '.vcf.gz')])
-
-    # Double check sex and fix ploidy
-    subprocess.call('bcftools +guess-ploidy --genome b37 --tag GT '
-                    + os.path.join('SangerImputation', vcf_name + '.vcf.gz') + ' > '
-                    + os.path.join('SangerImputation', vcf_name + '_SexEst.txt'), shell=True)
-
-    subprocess.check_output(['bcftools', '+fixploidy', '-Oz', '-o',
-                             os.path.join('SangerImputation', vcf_name + '_PloidyChecked.vcf.gz'),
-                             os.path.join('SangerImputation', vcf_name + '.vcf.gz'),
-                             '--', '--sex', os.path.join('SangerImputation', vcf_name + '_SexEst.txt')])
-    print("Done checking for sex and fixing ploidy")
-    subprocess.call(['mv', os.path.join('SangerImputation', vcf_name + '_PloidyChecked.vcf.gz'),
-                     os.path.join('SangerImputation', vcf_name + '.vcf.gz')])
-    # Reindex VCF file cause we just changed it:
-    subprocess.check_output(['bcftools', 'index', os.path.join('SangerImputation', vcf_name + '.vcf.gz')])
+    # Use bgzip to zip the vcf files so that they stop taking up space, several at once with bgzip_threads each.
+    workers = genopool.worker_count(threads_per_worker=bgzip_threads, max_workers=len(vcf_list))
+    genopool.run(compress_vcf, [(vcf, bgzip_threads) for vcf in vcf_list], workers, sizes=vcf_sizes)
 
     # Check that you have a valid vcf
     print("Checking to see if you have a valid vcf now.")
@@ -825,36 +624,32 @@ def getinfo(imputed_path, geno_name):
                        'computer very slow and will probably take several hours. (y/n): ').lower()
     print(Style.RESET_ALL)
 
+    # One array job with a task per chromosome. vcftools reads through each VCF once, so the time it needs goes with the
+    # size of the biggest one (roughly 10MB of gzipped VCF a second).
+    import genojobs
+    vcf_names = [os.path.join(imputed_path, geno_name + '_chr%d.vcf.gz' % x) for x in range(1, 24)]
+    vcf_sizes = [os.path.getsize(f) for f in vcf_names if os.path.exists(f)]
+    job = genojobs.Job('GetImputationInfo', ['vcftools --gzvcf ' + geno_name + '_chr$TASK.vcf.gz --get-INFO INFO '
+                                             '--get-INFO RefPanelAF --out ' + geno_name + '_chr${TASK}_InfoScoreAF'],
+                       cores=1, mem_mb=1024, walltime_hours=genojobs.walltime(600 + max(vcf_sizes + [0]) / 1e7),
+                       tasks=range(1, 24), workdir=imputed_path)
+
     if on_cluster in ("yes", "y"):
         # I based this formatting off of PSU cluster users, so they need to have a PSU cluster allocation.
         print(Fore.BLUE + Style.BRIGHT)
         allocation_name = input('Please enter the name of your cluster allocation: ')
         print(Style.RESET_ALL)
 
-        # Write pbs file
-        with open(os.path.join(imputed_path, 'GetImputationInfo.pbs'), 'w') as file:
-            file.write('#!/bin/bash\n'
-                       '#PBS -l walltime=24:00:00\n'
-                       '#PBS -l nodes=1:ppn=8\n'
-                       '#PBS -l pmem=7gb\n'
-                       '#PBS -A ' + allocation_name +
-                       '\n'
-                       '#PBS -j oe\n'
-                       'cd $PBS_O_WORKDIR\n'
-                       '\n' +
-                       'for i in {1..23}; do vcftools --gzvcf ' + geno_name
-                       + '_chr$i.vcf.gz --get-INFO INFO --get-INFO RefPanelAF --out ' + geno_name
-                       + '_chr$[i]_InfoScoreAF; done')
-        # Change directory into imputed path
-        os.chdir(imputed_path)
         # Submit to cluster
-        subprocess.check_output(['qsub', 'GetImputationInfo.pbs'])
-    # If they aren't on the cluster, then try to run this from their computer.
+        jobs = genojobs.backend(None, allocation_name)
+        jobs.submit(job)
+        jobs.wait()
+    # If they aren't on the cluster, then try to run this from their computer, as many chromosomes at once as the cores
+    # and memory allow.
     elif on_cluster in ('no', 'n'):
-        subprocess.check_output('for i in {1..23}; do vcftools --gzvcf '
-                                + os.path.join(imputed_path, geno_name + '_chr$i.vcf.gz')
-                                + ' --get-INFO INFO --get-INFO RefPanelAF --out '
-                                + os.path.join(imputed_path, geno_name + '_chr$[i]_InfoScoreAF') + '; done', shell=True)
+        jobs = genojobs.Local()
+        jobs.submit(job)
+        jobs.wait()
         print("Done. Your files have the ending .INFO and are in " + imputed_path)
 
     else:
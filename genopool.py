@@ -0,0 +1,70 @@
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# Helpers for running independent jobs (one per chromosome, one per file, etc.) side by side on one machine. The jobs
+# themselves are external programs (plink, java, shapeit, bcftools...), so each worker thread just babysits its own
+# subprocesses and Python never becomes the bottleneck.
+
+
+def cores():
+    # Number of cores we are allowed to use. On the cluster this respects the cpuset we were given.
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def available_memory_mb():
+    # How much memory is free right now, in MB. Returns None if I can't figure it out.
+    if os.path.exists('/proc/meminfo'):
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) // 1024
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_AVPHYS_PAGES') // (1024 * 1024)
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def worker_count(mem_per_worker_mb=None, threads_per_worker=1, max_workers=None):
+    # Work out how many jobs can run at once without running out of cores or memory.
+    workers = max(1, cores() // threads_per_worker)
+    if mem_per_worker_mb:
+        free_mem = available_memory_mb()
+        if free_mem is not None:
+            workers = min(workers, max(1, free_mem // mem_per_worker_mb))
+    if max_workers:
+        workers = min(workers, max_workers)
+    return workers
+
+
+def run(func, jobs, workers=1, sizes=None):
+    # Call func(*job) for every job in jobs and give back the results in the same order as jobs, no matter which order
+    # they finished in. If sizes are given, the biggest jobs are started first so that a big one (like chr1) doesn't
+    # end up running by itself at the very end.
+    results = [None] * len(jobs)
+
+    # With one worker just run them one after another, the same way we always have.
+    if workers <= 1:
+        for i in range(0, len(jobs)):
+            results[i] = func(*jobs[i])
+        return results
+
+    order = list(range(0, len(jobs)))
+    if sizes is not None:
+        order.sort(key=lambda x: sizes[x], reverse=True)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {}
+        for i in order:
+            futures[pool.submit(func, *jobs[i])] = i
+        for future in as_completed(futures):
+            try:
+                results[futures[future]] = future.result()
+            except Exception:
+                # Don't start anything new if one of the jobs failed.
+                for other in futures:
+                    other.cancel()
+                raise
+    return results
@@ -46,7 +46,9 @@ print(Fore.RED + Style.BRIGHT +
       '13) Prepare for imputation on the Sanger Imputation Server\n'
       '14) Extract imputation quality score and reference allele frequency from Sanger Imputation Server VCF files\n'
       '15) Plot imputation quality scores\n'
-      '16) Nothing.')
+      '16) Scan for missing call rates, sex problems and extreme heterozygosity values in one pass (nothing is '
+      'removed, you get the keep/remove lists)\n'
+      '17) Nothing.')
 to_do = input("Please enter the number that references the task you would like to perform above (i.e. 2): ")
 print(Style.RESET_ALL)
 
@@ -118,9 +120,23 @@ elif to_do == '5':
     print(Fore.BLUE + Style.BRIGHT)
     geno_name = input('Please enter the name of the genotype files to run an IBD on (without bed/bim/fam extension: ')
     print(Style.RESET_ALL)
+    # Ask if the user is on the cluster right now to determine if we should split this into jobs and submit them.
+    print(Fore.BLUE + Style.BRIGHT)
+    on_cluster = input('Are you currently running this from the Penn State ACI-B cluster? If yes, I will split the IBD '
+                       'into jobs that run at the same time and submit them. (y/n): ').lower()
+    print(Style.RESET_ALL)
     # Import module and call command.
     import genorelatives
-    genorelatives.ibd(geno_name)
+    if on_cluster in ('yes', 'y'):
+        # I based this formatting off of PSU cluster users, so they need to have a PSU cluster allocation.
+        print(Fore.MAGENTA + Style.BRIGHT)
+        allocation_name = input('Please enter the name of your cluster allocation: ')
+        shards = input('How many jobs would you like to split the IBD into? Press enter for 10: ')
+        print(Style.RESET_ALL)
+        shards = int(shards) if shards.strip().isdigit() and int(shards) > 0 else 10
+        genorelatives.ibd_cluster(geno_name, allocation_name, shards)
+    else:
+        genorelatives.ibd(geno_name)
 
 # GenoRelatives: Update FID or IID
 elif to_do == '6':
@@ -276,9 +292,21 @@ elif to_do == '8':
 
         # If they are not on the cluster, then run on their local machine.
         elif on_cluster in ('no', 'n'):
+            # Ask how many chromosomes to harmonize at the same time. Each one needs about 2GB of RAM (1GB for
+            # Genotype Harmonizer plus plink).
+            import genopool
+            print(Fore.MAGENTA + Style.BRIGHT)
+            workers = input('How many chromosomes would you like to harmonize at the same time? Each one needs about '
+                            '2GB of RAM. Press enter and I will pick based on your cores and memory: ')
+            print(Style.RESET_ALL)
+            if workers.strip().isdigit() and int(workers) > 0:
+                workers = min(int(workers), 23)
+            else:
+                workers = genopool.worker_count(mem_per_worker_mb=2048, max_workers=23)
+            print("Harmonizing " + str(workers) + " chromosome(s) at a time.")
             # Run harmonization script on their local machine.
             import genoharmonize
-            genoharmonize.local(geno_name, harmonizer_path, vcf_path, legend_path, fasta_path)
+            genoharmonize.local(geno_name, harmonizer_path, vcf_path, legend_path, fasta_path, workers=workers)
 
     # If they have not checked that they are on hg19, quit
     elif coord_check in ('no', 'n'):
@@ -332,12 +360,11 @@ elif to_do == '11':
           "1) You should perform the steps 2-10 BEFORE this one (in roughly that order).\n"
           "2) IT WILL TAKE A LONG TIME (~10 hrs) TO MERGE YOUR DATA WITH 1000G\n"
           "3) There should not be related individuals when you perform admixture. If you have related individuals in "
-          "your sample, you should create set lists so that the people in each set are unrelated (using information "
-          "from the IBD analysis\n"
+          "your sample, I will split them into sets of unrelated people for you using your IBD results (.genome)\n"
           "4) This will prepare files to run ADMIXTURE from k = 3 - 9. If you'd like other admixture runs performed, "
           "then you should (carefully) change the genoadmixture.py code, or the produced .pbs files, to reflect that.\n"
-          "5) You must have a Penn State ACI cluster allocation to perform this step. We are using the cluster because "
-          "ADMIXTURE takes a long time to run. I will ask you for your cluster name.\n")
+          "5) ADMIXTURE takes a long time to run, so you can use a Penn State ACI cluster allocation (I will ask you "
+          "for your allocation name) or, if you aren't on the cluster, run it on this computer instead.\n")
     print(Fore.BLUE + Style.BRIGHT)
     admixture_proceed_check = input("Are you sure you want to proceed? (y/n): ").lower()
     print(Style.RESET_ALL)
@@ -415,10 +442,16 @@ elif to_do == '12':
 elif to_do == '13':
     # The user should only do this after phasing.
     print("I will prepare files for imputation now. It is very important that you do this AFTER phasing.")
+    # Ask how many threads bgzip gets for each VCF it compresses at the end.
+    print(Fore.MAGENTA + Style.BRIGHT)
+    bgzip_threads = input('How many threads should bgzip use for each VCF it compresses? More threads each means '
+                          'fewer VCFs compressed at the same time. Press enter for 1: ')
+    print(Style.RESET_ALL)
+    bgzip_threads = int(bgzip_threads) if bgzip_threads.strip().isdigit() and int(bgzip_threads) > 0 else 1
     # Import module
     import genophaseimpute
     # Call function
-    genophaseimpute.impute()
+    genophaseimpute.impute(bgzip_threads=bgzip_threads)
 
 # Get info from imputed files.
 elif to_do == '14':
@@ -454,9 +487,21 @@ elif to_do == '15':
     # Call function
     genophaseimpute.qualscoreplot(info_path)
 
-# Nothing
+# GenoQC: Missing call rates, sex check and heterozygosity check in one pass, without making new files.
 elif to_do == '16':
+    # Get name of genotype file
+    print(Fore.BLUE + Style.BRIGHT)
+    geno_name = input("Please enter the name of the genotype files you'd like to scan "
+                      "(without bed/bim/fam extension: ")
+    print(Style.RESET_ALL)
+
+    # Import module and call command
+    import genoqc
+    genoqc.qc_scan(geno_name)
+
+# Nothing
+elif to_do == '17':
     sys.exit("You go, couch potato")
 
 else:
-    print("Please enter a number 1-16.")
+    print("Please enter a number 1-17.")
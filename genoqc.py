@@ -1,6 +1,7 @@
 import platform
 import os
 from os.path import expanduser
+import genobed
 home = expanduser("~")
 bindir = os.path.join(home, 'software', 'bin')
 
@@ -21,14 +22,18 @@ else:
     genodownload.plink()
 
 
+@genobed.takes_bfile
 def estimate_sex(geno_name):
     import subprocess
 
     print("This can take a while, so sit back for a bit and don't worry.")
 
-    # Checks the sex listed in the file against the chromosomal sex.
-    subprocess.check_output([plink, '--bfile', geno_name, '--indep-pairphase', '20000', '2000', '0.5', '--out',
-                             geno_name])
+    # Checks the sex listed in the file against the chromosomal sex. --check-sex only looks at chrX (and counts chrY
+    # calls with ycount), so those are the only chromosomes that need pruning, and plink prunes each chromosome on its
+    # own, so the result there is the same as pruning everything. This prune stays with plink rather than genold
+    # because --indep-pairphase uses phased haplotype r^2.
+    subprocess.check_output([plink, '--bfile', geno_name, '--chr', '23,24', '--indep-pairphase', '20000', '2000', '0.5',
+                             '--out', geno_name])
     subprocess.check_output([plink, '--bfile', geno_name, '--exclude', geno_name + '.prune.out', '--check-sex',
                              'ycount', '0.3', '0.8', '0', '0', '--out', geno_name])
 
@@ -36,6 +41,7 @@ def estimate_sex(geno_name):
           + ".sexcheck. You should check this file for any problems and decide if you want to update your file.")
 
 
+@genobed.takes_bfile
 def update_sex(geno_name, update_sex_filename):
     # File for updating sex should have:
     #   1) FID
@@ -49,28 +55,21 @@ def update_sex(geno_name, update_sex_filename):
     print("Finished. Your genotype files with sex updated will have the name " + geno_name + "_SexUpdated.")
 
 
-def missing_call_rate(geno_name):
-    # Exclude SNPs (geno) and people (mind) with missing call rates > 10%
-    import subprocess
-    subprocess.check_output([plink, '--bfile', geno_name, '--geno', '0.1', '--make-bed', '--out',
-                             geno_name + '_geno0.1'])
-    subprocess.check_output([plink, '--bfile', geno_name + '_geno0.1', '--mind', '0.1', '--make-bed', '--out',
-                             geno_name + '_geno0.1_mind0.1'])
-    subprocess.call(rm + geno_name + '_geno0.1.*', shell=True)
+def missing_call_rate(geno_name, geno=0.1, mind=0.1):
+    dataset = genobed.dataset(geno_name)
+    out = dataset.name + '_geno' + str(geno) + '_mind' + str(mind)
 
-    print("Finished. Your pruned genotype files will have the name " + geno_name + "_geno0.01_mind0.01")
+    # Exclude SNPs (geno) and then people (mind, over the SNPs that are left) with missing call rates > 10%. Both
+    # filters are worked out in memory, so only the final fileset is written. Allele order is kept as it is.
+    variants, samples = genobed.missing_filter(dataset, geno, mind)
+    dataset.subset(variants=variants, samples=samples, name=out).write(out)
 
+    print("Finished. " + str(int((~variants).sum())) + " SNPs and " + str(int((~samples).sum()))
+          + " people were removed. Your pruned genotype files will have the name " + out)
 
-def het(geno_name):
-    # Identifies individuals with extreme heterozygosity values (more than +- 3 SD)
-    # Getting extra required modules
-    try:
-        import pandas as pd
-    except (ImportError, ModuleNotFoundError):
-        import genodownload
-        genodownload.getpandas()
-        import pandas as pd
 
+def het_filter(het_file, geno_name, sd_cutoff=3):
+    # Label the people in a plink style .het table as Keep or Remove, and write the het files for geno_name.
     try:
         import numpy as np
     except (ImportError, ModuleNotFoundError):
@@ -78,15 +77,6 @@ def het(geno_name):
         genodownload.getnumpy()
         import numpy as np
 
-    import subprocess
-
-    # Use plink to calculate the heterozygosity, paying attention to geno and mind.
-    subprocess.check_output([plink, '--bfile', geno_name, '--geno', '0.1', '--mind', '0.1', '--het', '--out',
-                             geno_name])
-
-    # Read het file into pandas
-    het_file = pd.read_csv(geno_name + '.het', sep='\s+', header=0)
-
     # Create new column with formula: (N(NM)-O(HOM))/N(NM)
     het_file['HET'] = (het_file['N(NM)'] - het_file['O(HOM)']) / het_file['N(NM)']
 
@@ -94,9 +84,10 @@ def het(geno_name):
     het_sd = np.std(het_file['HET'])
     het_avg = np.mean(het_file['HET'])
 
-    # Add label 'keep' to people within 3*SD of the average het value, give 'remove' to everyone else.
+    # Add label 'keep' to people within sd_cutoff*SD of the average het value, give 'remove' to everyone else.
     het_file['HET_Filter'] = np.where(
-        (het_file['HET'] > het_avg - 3 * het_sd) & (het_file['HET'] < het_avg + 3 * het_sd), 'Keep', 'Remove')
+        (het_file['HET'] > het_avg - sd_cutoff * het_sd) & (het_file['HET'] < het_avg + sd_cutoff * het_sd), 'Keep',
+        'Remove')
     # Write this file so the user has it.
     het_file.to_csv(geno_name + '.het', sep='\t', header=True, index=False)
     # Make a list of the people who pass the filter.
@@ -108,9 +99,113 @@ def het(geno_name):
     # Write this to file so we have the record.
     het_rem.to_csv(geno_name + '_RemAfterHetCheck.txt', sep='\t', header=True, index=False)
 
-    # Make new plink file with people passing het check.
-    subprocess.check_output([plink, '--bfile', geno_name, '--keep', geno_name + '_KeptAfterHetCheck.txt', '--geno',
-                             '0.1', '--make-bed', '--out', geno_name + '_HetChecked'])
+
+def het(geno_name, sd_cutoff=3, mind=0.1, geno=0.1):
+    dataset = genobed.dataset(geno_name)
+    geno_name = dataset.name
+
+    # Identifies individuals with extreme heterozygosity values (more than +- sd_cutoff SD, 3 by default)
+
+    # Calculate the heterozygosity straight from the bed file, paying attention to geno and mind the same way plink
+    # --geno --mind --het does (people with missing call rates > mind first, then SNPs with missing call rates > geno).
+    # This gives the same table plink puts in the .het file.
+    dataset = dataset.subset(samples=~(genobed.sample_missing_rate(dataset) > mind))
+    het_file = genobed.heterozygosity(dataset, max_missing=geno)[0]
+
+    het_filter(het_file, geno_name, sd_cutoff)
+
+    # Make new plink file with people passing het check (and SNPs passing geno among them).
+    dataset.subset(samples=(het_file['HET_Filter'] == 'Keep').values).write(geno_name + '_HetChecked',
+                                                                             max_missing=geno)
 
     print("Done. Your new file of people with non-extreme heterozygosity values will be called "
           + geno_name + "_HetChecked")
+
+
+def qc_scan(geno_name, mind=0.1, geno=0.1, sd_cutoff=3, female_max_f=0.3, male_min_f=0.8, female_max_y=0,
+            male_min_y=0):
+    # Missing call rates, sex check and heterozygosity check from one pass over the bed file, instead of a plink run
+    # (or two) for each. Writes the files the user looks at to decide what to do next:
+    #   .imiss/.lmiss - missing call rates per person and per SNP (like plink --missing)
+    #   _KeptAfterMissingCheck.txt, _RemAfterMissingCheck.txt - people with missing call rates <= mind and > mind
+    #   _SNPsKeptAfterMissingCheck.txt, _SNPsRemAfterMissingCheck.txt - SNPs with missing call rates <= geno and > geno
+    #       (both over the whole dataset, so the SNP rates still count the people over mind)
+    #   .sexcheck - like plink --check-sex ycount female_max_f male_min_f female_max_y male_min_y, with the chrX
+    #       allele frequencies from the founders. Unlike estimate_sex(), chrX isn't LD pruned first, so F comes from
+    #       every chrX SNP and can sit a little higher than plink's.
+    #   _KeptAfterSexCheck.txt, _RemAfterSexCheck.txt - people with an OK and a PROBLEM sex check
+    #   .het, _KeptAfterHetCheck.txt, _RemAfterHetCheck.txt - the same as het(), with --mind mind --geno geno
+    # The Kept files are FID/IID lists for plink --keep (or --extract for SNPs), the Rem files are the rows that failed.
+    # No new genotype files are made, this is just the scan.
+    dataset = genobed.dataset(geno_name)
+    geno_name = dataset.name
+
+    try:
+        import pandas as pd
+    except (ImportError, ModuleNotFoundError):
+        import genodownload
+        genodownload.getpandas()
+        import pandas as pd
+
+    try:
+        import numpy as np
+    except (ImportError, ModuleNotFoundError):
+        import genodownload
+        genodownload.getnumpy()
+        import numpy as np
+
+    print("Scanning " + geno_name + ". This can take a while, so sit back for a bit and don't worry.")
+    scan = genobed.qc_scan(dataset, max_missing=geno)
+
+    # Missing call rates.
+    with np.errstate(invalid='ignore', divide='ignore'):
+        sample_rate = scan['sample_missing'] / scan['sample_total'].astype(np.float64)
+        variant_rate = scan['variant_missing'] / scan['variant_total'].astype(np.float64)
+    missing_pheno = np.where(np.isin(dataset.phenotypes, ['-9', '0']), 'Y', 'N')
+    imiss = pd.DataFrame({'FID': dataset.fids, 'IID': dataset.iids, 'MISS_PHENO': missing_pheno,
+                          'N_MISS': scan['sample_missing'], 'N_GENO': scan['sample_total'], 'F_MISS': sample_rate})
+    imiss.to_csv(geno_name + '.imiss', sep='\t', header=True, index=False, float_format='%.4g', na_rep='nan')
+    lmiss = pd.DataFrame({'CHR': dataset.chromosomes, 'SNP': dataset.snps, 'N_MISS': scan['variant_missing'],
+                          'N_GENO': scan['variant_total'], 'F_MISS': variant_rate})
+    lmiss.to_csv(geno_name + '.lmiss', sep='\t', header=True, index=False, float_format='%.4g', na_rep='nan')
+    people_kept = ~(sample_rate > mind)
+    snps_kept = ~(variant_rate > geno)
+    imiss[people_kept][['FID', 'IID']].to_csv(geno_name + '_KeptAfterMissingCheck.txt', sep='\t', header=False,
+                                              index=False)
+    imiss[~people_kept].to_csv(geno_name + '_RemAfterMissingCheck.txt', sep='\t', header=True, index=False,
+                               float_format='%.4g', na_rep='nan')
+    lmiss[snps_kept][['SNP']].to_csv(geno_name + '_SNPsKeptAfterMissingCheck.txt', sep='\t', header=False,
+                                     index=False)
+    lmiss[~snps_kept].to_csv(geno_name + '_SNPsRemAfterMissingCheck.txt', sep='\t', header=True, index=False,
+                             float_format='%.4g', na_rep='nan')
+
+    # Sex check. Female if F < female_max_f and there are <= female_max_y chrY calls, male if F > male_min_f and
+    # there are >= male_min_y chrY calls, otherwise we can't tell (0).
+    x_f = scan['x_f']
+    snp_sex = np.where((x_f < female_max_f) & (scan['y_count'] <= female_max_y), 2,
+                       np.where((x_f > male_min_f) & (scan['y_count'] >= male_min_y), 1, 0))
+    ped_sex = dataset.sexes.astype(int)
+    sex_ok = (ped_sex == snp_sex) & (snp_sex != 0)
+    sexcheck = pd.DataFrame({'FID': dataset.fids, 'IID': dataset.iids, 'PEDSEX': ped_sex, 'SNPSEX': snp_sex,
+                             'STATUS': np.where(sex_ok, 'OK', 'PROBLEM'), 'F': x_f, 'YCOUNT': scan['y_count']})
+    sexcheck.to_csv(geno_name + '.sexcheck', sep='\t', header=True, index=False, float_format='%.4g', na_rep='nan')
+    sexcheck[sex_ok][['FID', 'IID']].to_csv(geno_name + '_KeptAfterSexCheck.txt', sep='\t', header=False,
+                                            index=False)
+    sexcheck[~sex_ok].to_csv(geno_name + '_RemAfterSexCheck.txt', sep='\t', header=True, index=False,
+                             float_format='%.4g', na_rep='nan')
+
+    # Heterozygosity. plink takes out the people over mind before working out the SNP missing call rates for geno. If
+    # nobody is over mind (the usual case, once missing_call_rate has been run), the scan already has the answer.
+    # Otherwise the few people over mind change the SNP call rates, so go over the bed file again without them.
+    if people_kept.all():
+        het_file = scan['het']
+    else:
+        het_file = genobed.heterozygosity(dataset.subset(samples=people_kept), max_missing=geno)[0]
+    het_filter(het_file, geno_name, sd_cutoff)
+
+    print("Finished. " + str(int((~people_kept).sum())) + " people have missing call rates > " + str(mind) + ", "
+          + str(int((~snps_kept).sum())) + " SNPs have missing call rates > " + str(geno) + ", "
+          + str(int((~sex_ok).sum())) + " people have a sex problem, and "
+          + str(int((het_file['HET_Filter'] == 'Remove').sum())) + " people have extreme heterozygosity values. "
+          "The files are " + geno_name + ".imiss, .lmiss, .sexcheck and .het, and the people and SNPs to keep or "
+          "remove are in the " + geno_name + "_KeptAfter*/_RemAfter*/_SNPsKeptAfter*/_SNPsRemAfter* files.")
@@ -1,6 +1,7 @@
 import platform
 import os
 from os.path import expanduser
+import genobed
 home = expanduser("~")
 bindir = os.path.join(home, 'software', 'bin')
 
@@ -20,8 +21,29 @@ else:
     import genodownload
     genodownload.plink()
 
+try:
+    import pandas as pd
+except (ImportError, ModuleNotFoundError):
+    import genodownload
+    genodownload.getpandas()
+    import pandas as pd
+
+try:
+    import numpy as np
+except (ImportError, ModuleNotFoundError):
+    import genodownload
+    genodownload.getnumpy()
+    import numpy as np
+
+
+def ibd(geno_name, screen=None):
+    # screen: find candidate relatives with a kinship screen first and only work out PI_HAT for them (see
+    # genokinship), instead of running plink --genome on every pair of people. By default this is done for samples
+    # of more than genokinship.SCREEN_SAMPLES people.
+    import genold
+    dataset = genobed.dataset(geno_name)
+    geno_name = genobed.bfile_name(dataset)
 
-def ibd(geno_name):
     # Identity-by-descent in Plink
     # This part of the script will prune for LD, calculate IBD, and exclude individuals who have IBD < 0.2
     # The IBD results will have .genome appended to your file name. I have also included a line to convert the IBD
@@ -42,23 +64,139 @@ def ibd(geno_name):
     if not os.path.exists('IBD_Calculations'):
         os.makedirs('IBD_Calculations')
 
-    # Use plink to prune for LD
-    subprocess.check_output([plink, '--bfile', geno_name, '--indep', '50', '5', '2', '--out',
-                             'IBD_Calculations/' + geno_name])
+    # Prune for LD (the same as plink --indep 50 5 2)
+    kept = genold.write_prune(dataset, 'IBD_Calculations/' + geno_name, 'vif', 50, 5, 2)
     # Perform IBD calculation, filtering for a minimum of 0.1875. This is the halfway point between 2nd and 3rd degree
     # relatives.
-    subprocess.check_output([plink, '--bfile', geno_name, '--exclude', 'IBD_Calculations/' + geno_name + '.prune.out',
-                             '--genome', '--min', '0.1875', '--out', 'IBD_Calculations/' + geno_name])
+    import genokinship
+    if screen is None:
+        screen = dataset.n_samples > genokinship.SCREEN_SAMPLES
+    if screen:
+        genokinship.relatives(dataset, 'IBD_Calculations/' + geno_name, kept, min_pi_hat=0.1875)
+    else:
+        subprocess.check_output([plink, '--bfile', geno_name, '--exclude', 'IBD_Calculations/' + geno_name
+                                 + '.prune.out', '--genome', '--min', '0.1875', '--out', 'IBD_Calculations/'
+                                 + geno_name])
 
     # Finished
     print("Analysis finished. Your IBD results will have the name " + geno_name
           + ".genome and be in the folder 'IBD_Calculations'. You should use this file to investigate your "
             "relatives and possibly update the FID and IIDs in your file.\n"
-            "If you are planning on using these data for an admixture analysis you should make set lists of people who "
-            "are unrelated in each set. These lists should have Family ID / Individual ID pairs, one person per line "
-            "(tab or space delimited).")
+            "If you are planning on using these data for an admixture analysis, you don't need to make set lists of "
+            "unrelated people yourself. When you prepare for ADMIXTURE and tell me there are relatives in your sample, "
+            "I will use this file to make the sets for you.")
+
+
+def ibd_cluster(geno_name, allocation_name, shards=10, min_pi_hat=0.1875, scheduler=None, cores=8):
+    # The same IBD calculation as ibd(), but split into shards plink --genome jobs (plink's --parallel) that run on
+    # the cluster side by side, as one array job, and a merge job that waits for all of them and then puts the .genome
+    # shards back together. The job scripts and results go in the IBD_Calculations folder. scheduler is 'pbs', 'slurm'
+    # or 'local' (see genojobs.backend), by default whichever this machine has.
+    import genojobs
+    import genold
+    jobs = genojobs.backend(scheduler, allocation_name)
+    dataset = genobed.dataset(geno_name)
+    geno_name = genobed.bfile_name(dataset)
+
+    import os
+
+    # Make a folder to put IBD calculations in
+    if not os.path.exists('IBD_Calculations'):
+        os.makedirs('IBD_Calculations')
+
+    # Prune for LD here, once, for every shard to use (the same as plink --indep 50 5 2)
+    bfile = os.path.abspath(geno_name)
+    out = os.path.basename(geno_name)
+    kept = genold.write_prune(dataset, 'IBD_Calculations/' + out, 'vif', 50, 5, 2)
+
+    # Each shard has 1/shards of the pairs of people to do. plink holds the genotypes (2 bits each) in memory, and gets
+    # through something like 10^9 pairs x SNPs a second per core; both are rough, with room to spare.
+    pairs = dataset.n_samples * (dataset.n_samples - 1) // 2
+    mem_mb = 1024 + dataset.n_samples * int(kept.sum()) // (2 * 1024 * 1024)
+    shard = genojobs.Job(out + '_IBD', [
+        plink + ' --bfile ' + bfile + ' --exclude ' + out + '.prune.out --genome --min ' + str(min_pi_hat)
+        + ' --parallel $TASK ' + str(shards) + ' --threads ' + str(cores) + ' --memory ' + str(mem_mb) + ' --out '
+        + out],
+        cores=cores, mem_mb=mem_mb + 256, tasks=range(1, shards + 1), workdir='IBD_Calculations',
+        walltime_hours=genojobs.walltime(600 + 1e-9 * pairs * int(kept.sum()) / (shards * cores)))
+
+    # Only the first shard has the header line, so the shards just need to go end to end (in order), keeping the pairs
+    # with PI_HAT (column 10) >= min_pi_hat.
+    merge = genojobs.Job(out + '_IBD_Merge', [
+        'for k in {1..' + str(shards) + '}; do cat ' + out + '.genome.$k; done | awk \'NR==1 || $10>='
+        + str(min_pi_hat) + '\' > ' + out + '.genome && rm ' + out + '.genome.*'],
+        cores=1, mem_mb=1024, walltime_hours=1, workdir='IBD_Calculations')
+
+    # Submit the shards, then the merge job so that it only starts once every shard has finished.
+    jobs.submit(merge, after=[jobs.submit(shard)])
+
+    print("Your " + str(shards) + " IBD jobs and the job that merges them have been submitted. You can check their "
+          "status using qstat -u usrname. Your IBD results will have the name " + out + ".genome and be in the folder "
+          "'IBD_Calculations'.")
+    jobs.wait()
+
+
+def related_graph(genome_file, geno, min_pi_hat=0.1875):
+    # Read a plink .genome file into a graph of who is related to whom (PI_HAT >= min_pi_hat), in compressed sparse row
+    # form over the people in geno (a fileset name or genobed.PlinkDataset), by their row in the .fam:
+    #   person i's relatives are indices[indptr[i]:indptr[i + 1]]
+    # Pairs with someone who isn't in geno are left out.
+    geno = genobed.dataset(geno)
+    genome = pd.read_csv(genome_file, sep='\s+', usecols=['FID1', 'IID1', 'FID2', 'IID2', 'PI_HAT'],
+                         dtype={'FID1': str, 'IID1': str, 'FID2': str, 'IID2': str})
+    genome = genome[genome['PI_HAT'] >= min_pi_hat]
+
+    # Person -> row number, looked up through an index on FID + IID.
+    people = pd.Index(pd.Series(geno.fids).astype(str) + ' ' + pd.Series(geno.iids).astype(str))
+    first = people.get_indexer(genome['FID1'] + ' ' + genome['IID1'])
+    second = people.get_indexer(genome['FID2'] + ' ' + genome['IID2'])
+    found = (first >= 0) & (second >= 0) & (first != second)
+    first, second = first[found], second[found]
+
+    # Each pair goes in both ways round, once.
+    edges = np.unique(np.concatenate([np.column_stack([first, second]), np.column_stack([second, first])]), axis=0)
+    indptr = np.zeros(geno.n_samples + 1, dtype=np.int64)
+    np.cumsum(np.bincount(edges[:, 0], minlength=geno.n_samples), out=indptr[1:])
+    return indptr, edges[:, 1].astype(np.int64)
+
+
+def unrelated_sets(indptr, indices):
+    # Split everybody into sets with nobody related to each other inside a set (a colouring of the related_graph).
+    # Greedy: people with the most relatives go first, and each person goes into the smallest set that doesn't have any
+    # of their relatives yet, with a new set only started when every set has one. Since the unrelated people go last,
+    # they end up evening out the set sizes. Returns each person's set number (0, 1, ...).
+    n_samples = len(indptr) - 1
+    degrees = np.diff(indptr)
+    sets = np.full(n_samples, -1, dtype=np.int64)
+    sizes = []
+    for person in np.argsort(-degrees, kind='mergesort'):
+        taken = set(sets[indices[indptr[person]:indptr[person + 1]]]) if degrees[person] else set()
+        allowed = [x for x in range(0, len(sizes)) if x not in taken]
+        if allowed:
+            chosen = min(allowed, key=lambda x: sizes[x])
+        else:
+            chosen = len(sizes)
+            sizes.append(0)
+        sets[person] = chosen
+        sizes[chosen] += 1
+    return sets
+
+
+def maximal_unrelated(indptr, indices):
+    # A set of people where nobody is related to anybody else in it, and nobody else can be added (boolean mask).
+    # Greedy: people with the fewest relatives are picked first, and their relatives are ruled out.
+    n_samples = len(indptr) - 1
+    degrees = np.diff(indptr)
+    keep = np.zeros(n_samples, dtype=bool)
+    ruled_out = np.zeros(n_samples, dtype=bool)
+    for person in np.argsort(degrees, kind='mergesort'):
+        if not ruled_out[person]:
+            keep[person] = True
+            ruled_out[indices[indptr[person]:indptr[person + 1]]] = True
+    return keep
 
 
+@genobed.takes_bfile
 def update_id(geno_name, update_id_filename):
     # File for updating FID should have four fields
     #  1) Old FID
@@ -72,6 +210,7 @@ def update_id(geno_name, update_id_filename):
     print("Finished. Your genotype files with the ID updated will have the name " + geno_name + "_IDUpdated")
 
 
+@genobed.takes_bfile
 def update_parental(geno_name, update_parents_filename):
     # File for updating parents should have four fields:
     #   1) FID
@@ -40,6 +40,10 @@ except ImportError:
     from colorama import init, Fore, Style
     init()
 
+import genoafcheck
+import genolegend
+import genobed
+
 home = expanduser("~")
 bindir = os.path.join(home, 'software', 'bin')
 
@@ -64,6 +68,10 @@ parser.add_argument("geno_name", help="Name of the genotype files to be harmoniz
                                       "bed/bim/fam extension)")
 parser.add_argument("legend_path", help="Path to 1000G hg19 legend files")
 parser.add_argument("fasta_path", help="Path to 1000G hg19 fasta file")
+parser.add_argument("--af-threshold", type=float, default=0.2, help="Largest allowed allele frequency difference "
+                                                                     "between the dataset and a 1000G superpopulation")
+parser.add_argument("--af-min-pops", type=int, default=5, help="Remove a SNP when its allele frequency difference is "
+                                                               "too large in at least this many superpopulations")
 args = parser.parse_args()
 
 # Make sure current working directory is Harmonized_To_1000G
@@ -84,7 +92,6 @@ id_updates = [s + '_idUpdates.txt' for s in harmonized_geno_names]
 id_update_names = [s + '_idUpdates.txt' for s in harmonized_geno_names]
 snp_logs = [s + '_snpLog.log' for s in harmonized_geno_names]
 snp_log_names = [s + '_snpLog.log' for s in harmonized_geno_names]
-freq_file_names = [args.geno_name + '_chr%d_Harmonized.frq' % x for x in range(1, 24)]
 af_diff_removed_by_chr = ['chr%d_SNPsRemoved_AFDiff' % x for x in range(1, 24)]
 final_snps_by_chr = ['chr%d_SNPsKept' % x for x in range(1, 24)]
 final_snp_lists = ['chr%d_SNPsKept.txt' % x for x in range(1, 24)]
@@ -129,12 +136,9 @@ if os.path.getsize('Harmonization_SNP_Logs.txt') > 0:
 # of any superpopulation frequency, keep variant. Frequency file is expected to be a Plink frequency file with the
 # same number of variants as the bim file.
 for i in range(0, len(harmonized_geno_names)):
-    # Create plink file
-    subprocess.check_output([plink, '--bfile', harmonized_geno_names[i], '--freq', '--out',
-                             harmonized_geno_names[i]])
-    # Read freq file into python
-    freq_file = pd.read_csv(freq_file_names[i], sep='\s+', header=0, usecols=[0, 1, 2, 3, 4],
-                            dtype={'CHR': int, 'SNP': str, 'A1': str, 'A2': str, 'MAF': float})
+    # Allele frequencies, computed straight from the bed file instead of running plink --freq and reading the .frq
+    # file back in. Same columns as the .frq file, and A1 is the minor allele like in plink.
+    freq_file = genobed.frequencies(harmonized_geno_names[i]).drop(columns='NCHROBS')
     # Rename columns of freq file.
     freq_file.rename(columns={'A1': 'dataset_a1', 'A2': 'dataset_a2', 'MAF': 'dataset_a1_frq'}, inplace=True)
     # Calculate the frequency of the second allele, since it's not given in the freq file.
@@ -144,107 +148,28 @@ for i in range(0, len(harmonized_geno_names)):
                            names=['CHR', 'SNP', 'position'])
     # Merge frequency file with bim file to get position for each SNP
     freq_file_with_position = pd.merge(left=freq_file, right=bim_file, how='inner', on=['CHR', 'SNP'])
-    # Read in legend file.
-    legend_file = pd.read_csv(os.path.join(args.legend_path, legend_file_names[i]), compression="gzip", sep=" ",
-                              header=0, dtype={'id': str, 'position': int, 'a0': str, 'a1': str, 'TYPE': str,
-                                               'AFR': float, 'AMR': float, 'EAS': float, 'EUR': float, 'SAS': float,
-                                               'ALL': float})
-    # Rename columns of legend file
-    legend_file.rename(columns={'id': 'reference_id', 'a0': 'reference_a0', 'a1': 'reference_a1'}, inplace=True)
-
-    # To Remove A/T or G/C SNPs in reference file that have an MAF > 40%, first identify which are AT/GC SNPs.
-    legend_file['ATGC_SNP'] = np.where(
-        ((legend_file['reference_a0'] == 'A') & (legend_file['reference_a1'] == 'T')) |
-        ((legend_file['reference_a0'] == 'T') & (legend_file['reference_a1'] == 'A')) |
-        ((legend_file['reference_a0'] == 'C') & (legend_file['reference_a1'] == 'G')) |
-        ((legend_file['reference_a0'] == 'G') & (legend_file['reference_a1'] == 'C')), 'ATGC', 'Fine')
-    # For each superpopulation, create a new column with the MAF. If the AF in that column is less than 0.5, then
-    # that is the MAF, if not then 1-AF is MAF
-    legend_file['AFR_MAF'] = np.where(legend_file['AFR'] < 0.5, legend_file['AFR'], 1 - legend_file['AFR'])
-    legend_file['AMR_MAF'] = np.where(legend_file['AMR'] < 0.5, legend_file['AMR'], 1 - legend_file['AMR'])
-    legend_file['EAS_MAF'] = np.where(legend_file['EAS'] < 0.5, legend_file['EAS'], 1 - legend_file['EAS'])
-    legend_file['EUR_MAF'] = np.where(legend_file['EUR'] < 0.5, legend_file['EUR'], 1 - legend_file['EUR'])
-    legend_file['SAS_MAF'] = np.where(legend_file['SAS'] < 0.5, legend_file['SAS'], 1 - legend_file['SAS'])
-
-    # Create column in legend file with decision about whether to keep or remove SNP, if it is an ATGC SNP where
-    # the MAF in all superpopulations is greater than 40%, then remove it.
-    legend_file['MAF_Decision'] = np.where((legend_file['ATGC_SNP'] == 'ATGC') & (legend_file['AFR_MAF'] > 0.4) &
-                                           (legend_file['AMR_MAF'] > 0.4) & (legend_file['EAS_MAF'] > 0.4) &
-                                           (legend_file['EUR_MAF'] > 0.4) & (legend_file['SAS_MAF'] > 0.4),
-                                           'Remove', 'Keep')
-
-    # Make new legend file with just the SNPs that pass this threshold.
-    legend_file = legend_file[legend_file['MAF_Decision'] == 'Keep']
-
-    legend_file.drop(labels=['ATGC_SNP', 'AFR_MAF', 'AMR_MAF', 'EAS_MAF', 'EUR_MAF', 'SAS_MAF', 'MAF_Decision'],
-                     axis=1, inplace=True)
-
-    # Merge freq file with positions with legend file to get overlap. This file contains only SNPs with matches in
+    # Match on position with the legend for this chromosome, using the sorted position index in the legend cache
+    # (built once from the legend.gz files). The legend cache only has biallelic SNPs, and A/T or G/C SNPs with an
+    # MAF > 40% in all superpopulations have already been taken out. This file contains only SNPs with matches in
     # 1000G
-    merged_file = pd.merge(left=freq_file_with_position, right=legend_file, how='inner', on='position')
-    merged_file = merged_file[merged_file['TYPE'] == 'Biallelic_SNP']
+    merged_file = genolegend.join(freq_file_with_position, args.legend_path, i)
 
     # The MAF column in the frq file is the allele frequency of the A1 allele (which is usually minor, but
     # possibly not in my case because I just updated the reference to match 1000G.
     # The AF columns in the legend file are the allele frequencies of the a1 allele in that file.
-    # Need to match based on A1 alleles (hopefully this has already been done in the harmonization step, then
-    # calculate the allele frequency difference.
-    # For each population group, match the alleles where they aren't flipped (i.e. in the same order in house and
-    # ref datasets..
-    merged_file['AFR_Match_Diff'] = np.where((merged_file['dataset_a1'] == merged_file['reference_a1']) &
-                                             (merged_file['dataset_a2'] == merged_file['reference_a0']),
-                                             abs(merged_file['dataset_a1_frq'] - merged_file['AFR']), '')
-    merged_file['AMR_Match_Diff'] = np.where((merged_file['dataset_a1'] == merged_file['reference_a1']) &
-                                             (merged_file['dataset_a2'] == merged_file['reference_a0']),
-                                             abs(merged_file['dataset_a1_frq'] - merged_file['AMR']), '')
-    merged_file['EAS_Match_Diff'] = np.where((merged_file['dataset_a1'] == merged_file['reference_a1']) &
-                                             (merged_file['dataset_a2'] == merged_file['reference_a0']),
-                                             abs(merged_file['dataset_a1_frq'] - merged_file['EAS']), '')
-    merged_file['EUR_Match_Diff'] = np.where((merged_file['dataset_a1'] == merged_file['reference_a1']) &
-                                             (merged_file['dataset_a2'] == merged_file['reference_a0']),
-                                             abs(merged_file['dataset_a1_frq'] - merged_file['EUR']), '')
-    merged_file['SAS_Match_Diff'] = np.where((merged_file['dataset_a1'] == merged_file['reference_a1']) &
-                                             (merged_file['dataset_a2'] == merged_file['reference_a0']),
-                                             abs(merged_file['dataset_a1_frq'] - merged_file['SAS']), '')
-    # For each population group, match the flipped alleles.
-    merged_file['AFR_FlipMatch_Diff'] = np.where((merged_file['dataset_a1'] == merged_file['reference_a0']) &
-                                                 (merged_file['dataset_a2'] == merged_file['reference_a1']),
-                                                 abs(merged_file['dataset_a2_frq'] - merged_file['AFR']), '')
-    merged_file['AMR_FlipMatch_Diff'] = np.where((merged_file['dataset_a1'] == merged_file['reference_a0']) &
-                                                 (merged_file['dataset_a2'] == merged_file['reference_a1']),
-                                                 abs(merged_file['dataset_a2_frq'] - merged_file['AMR']), '')
-    merged_file['EAS_FlipMatch_Diff'] = np.where((merged_file['dataset_a1'] == merged_file['reference_a0']) &
-                                                 (merged_file['dataset_a2'] == merged_file['reference_a1']),
-                                                 abs(merged_file['dataset_a2_frq'] - merged_file['EAS']), '')
-    merged_file['EUR_FlipMatch_Diff'] = np.where((merged_file['dataset_a1'] == merged_file['reference_a0']) &
-                                                 (merged_file['dataset_a2'] == merged_file['reference_a1']),
-                                                 abs(merged_file['dataset_a2_frq'] - merged_file['EUR']), '')
-    merged_file['SAS_FlipMatch_Diff'] = np.where((merged_file['dataset_a1'] == merged_file['reference_a0']) &
-                                                 (merged_file['dataset_a2'] == merged_file['reference_a1']),
-                                                 abs(merged_file['dataset_a2_frq'] - merged_file['SAS']), '')
-    # Add the nonflipped and flipped columns together to find out which files have an allele frequency
-    # difference > 0.2
-    merged_file['AFR_Diff'] = merged_file['AFR_Match_Diff'] + merged_file['AFR_FlipMatch_Diff']
-    merged_file['AMR_Diff'] = merged_file['AMR_Match_Diff'] + merged_file['AMR_FlipMatch_Diff']
-    merged_file['EAS_Diff'] = merged_file['EAS_Match_Diff'] + merged_file['EAS_FlipMatch_Diff']
-    merged_file['EUR_Diff'] = merged_file['EUR_Match_Diff'] + merged_file['EUR_FlipMatch_Diff']
-    merged_file['SAS_Diff'] = merged_file['SAS_Match_Diff'] + merged_file['SAS_FlipMatch_Diff']
-
-    # Delete these columns because we don't need them anymore
-    merged_file.drop(labels=['AFR_Match_Diff', 'AFR_FlipMatch_Diff', 'AMR_Match_Diff', 'AMR_FlipMatch_Diff',
-                             'EAS_Match_Diff', 'EAS_FlipMatch_Diff', 'EUR_Match_Diff', 'EUR_FlipMatch_Diff',
-                             'SAS_Match_Diff', 'SAS_FlipMatch_Diff'], axis=1, inplace=True)
-
-    # Make allele freuqency columns numeric.
-    merged_file[['AFR_Diff', 'AMR_Diff', 'EAS_Diff', 'EUR_Diff', 'SAS_Diff']] = \
-        merged_file[['AFR_Diff', 'AMR_Diff', 'EAS_Diff', 'EUR_Diff', 'SAS_Diff']].apply(pd.to_numeric,
-                                                                                        errors='coerce')
-
-    # Make new column 'AF_Decision' where you remove alleles that have allele frequency differences > 0.2 from all
-    # population groups.
-    merged_file['AF_Decision'] = np.where((merged_file['AFR_Diff'] > 0.2) & (merged_file['AMR_Diff'] > 0.2) &
-                                          (merged_file['EAS_Diff'] > 0.2) & (merged_file['EUR_Diff'] > 0.2) &
-                                          (merged_file['SAS_Diff'] > 0.2), 'Remove', 'Keep')
+    # Match on the A1 alleles (either in the same order or flipped) and calculate the allele frequency difference
+    # for every superpopulation at once, using integer coded alleles.
+    _, af_remove, af_diffs = genoafcheck.af_check(
+        genoafcheck.encode_alleles(merged_file['dataset_a1']), genoafcheck.encode_alleles(merged_file['dataset_a2']),
+        merged_file['dataset_a1_frq'].values, genoafcheck.encode_alleles(merged_file['reference_a0']),
+        genoafcheck.encode_alleles(merged_file['reference_a1']), merged_file[genoafcheck.POPULATIONS].values,
+        threshold=args.af_threshold, min_pops=args.af_min_pops)
+    for j in range(0, len(genoafcheck.POPULATIONS)):
+        merged_file[genoafcheck.POPULATIONS[j] + '_Diff'] = af_diffs[:, j]
+
+    # Make new column 'AF_Decision' where you remove alleles that have allele frequency differences > the
+    # threshold in all (or the chosen number of) population groups.
+    merged_file['AF_Decision'] = np.where(af_remove, 'Remove', 'Keep')
 
     # Drop duplicate SNPs
     merged_file.drop_duplicates(subset=['SNP'], keep=False, inplace=True)